@@ -0,0 +1,95 @@
+import posixpath
+import re
+from urllib.parse import unquote
+import html_stream
+
+CSS_URL = re.compile(rb'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^)'"\s]+))\s*\)|@import\s+(?:"([^"]*)"|'([^']*)')''')
+SRCSET_URL = re.compile(rb'(?:^|,)\s*([^\s,]+)')
+SCHEME = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+
+# A quoted path into one of the site's asset folders.
+EMBEDDED_PATH = re.compile(rb'''(?:["']|&quot;)(/?(?:img|dist|videos)/[^"'?#&\\\s]+)''')
+
+# Attributes that hold a single URL.
+URL_ATTRIBUTES = {'src', 'href', 'poster'}
+
+# <meta> tags whose content is an image URL.
+META_IMAGES = {'og:image', 'og:image:url', 'og:image:secure_url', 'twitter:image'}
+
+
+def resolve_ref(url, base_path='/'):
+    """
+    Turns a URL found in the file at base_path into a path from the site
+    root, like '/img/a.png'. Returns None for anchors, data: URIs and
+    anything on another host.
+    """
+    url = url.strip()
+    if not url or url.startswith(('#', '//')) or SCHEME.match(url):
+        return None
+    path = url.split('#', 1)[0].split('?', 1)[0]
+    if not path:
+        return None
+    if not path.startswith('/'):
+        path = posixpath.join(posixpath.dirname(base_path), path)
+    return posixpath.normpath(unquote(path))
+
+
+def rename_url(url, new_name):
+    """
+    Swaps the file name at the end of the path part of url for new_name,
+    keeping the directory, query and fragment exactly as they were written.
+    """
+    cut = min([i for i in (url.find('?'), url.find('#')) if i != -1] or [len(url)])
+    path, rest = url[:cut], url[cut:]
+    return path[:path.rfind('/') + 1] + new_name + rest
+
+
+def css_refs(data, offset=0):
+    """
+    Yields (start, end, url) for every url() and @import in CSS bytes.
+    Offsets are shifted by offset, for CSS embedded in a larger buffer.
+    """
+    for match in CSS_URL.finditer(data):
+        group = next(g for g in range(1, 6) if match.group(g) is not None)
+        yield match.start(group) + offset, match.end(group) + offset, match.group(group).decode('utf-8', 'replace')
+
+
+def html_refs(data):
+    """
+    Yields (start, end, url, kind) for every URL in the markup: src, href
+    and poster attributes, srcset candidates, image <meta> tags and url()
+    in style attributes and <style> blocks. Offsets point at the raw bytes
+    of the URL in data.
+    """
+    for token in html_stream.iter_tags(data):
+        if not isinstance(token, html_stream.StartTag):
+            continue
+        for attr in token.attrs:
+            if attr.raw_value is None:
+                continue
+            if attr.name in URL_ATTRIBUTES:
+                yield attr.value_start, attr.value_end, attr.value, attr.name
+            elif attr.name == 'content' and token.name == 'meta' and \
+                    (token.get('property') or token.get('name')) in META_IMAGES:
+                yield attr.value_start, attr.value_end, attr.value, 'meta'
+            elif attr.name == 'srcset':
+                for match in SRCSET_URL.finditer(attr.raw_value):
+                    yield (attr.value_start + match.start(1), attr.value_start + match.end(1),
+                           match.group(1).decode('utf-8', 'replace'), 'srcset')
+            elif attr.name == 'style':
+                for start, end, url in css_refs(attr.raw_value, attr.value_start):
+                    yield start, end, url, 'style'
+        if token.name == 'style' and token.content_end is not None:
+            for start, end, url in css_refs(token.content, token.end):
+                yield start, end, url, 'style'
+
+
+def embedded_refs(data):
+    """
+    Yields (start, end, url) for site paths quoted inside JSON or script
+    text, like "img/a.png", "/dist/b.js" or &quot;img/a.png&quot; in an
+    attribute. Used where the text is too large or too loosely structured
+    to parse, such as ServerData.
+    """
+    for match in EMBEDDED_PATH.finditer(data):
+        yield match.start(1), match.end(1), match.group(1).decode('utf-8', 'replace')
@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from fix_metrics import PHASES
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Sizes of generated exports. "readymag" matches the exported site this
+# repository holds: about 17 pages of 840 KB, most of it inline state.
+SCENARIOS = {
+    'small': {'pages': 5, 'state_kb': 50, 'preloads': 20, 'images': 10},
+    'readymag': {'pages': 17, 'state_kb': 780, 'preloads': 224, 'images': 30},
+    'large': {'pages': 60, 'state_kb': 1500, 'preloads': 400, 'images': 120},
+}
+
+# The fixer entry points, as (module, function) pairs.
+ENTRY_POINTS = {
+    'fix_all_html_files': ('final_fix', 'fix_all_html_files'),
+    'remove_srcset_from_html': ('remove_srcset', 'remove_srcset_from_html'),
+}
+
+# How much slower or hungrier a run may get before it counts as a regression.
+DEFAULT_THRESHOLD = 0.25
+
+# Committed results of the default scenarios (small and readymag, every entry
+# point, 3 runs), used by a bare --baseline.
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+HEAD = """<!DOCTYPE html>
+<html lang="en"><head>
+<meta charset="utf-8"/>
+<title>{title}</title>
+<meta content="width=device-width, initial-scale=1" name="viewport"/>
+<meta content="https://st-p.rmcdn1.net/8a678eb9/img/og-{n}.png" property="og:image"/>
+<link href="https://st-p.rmcdn1.net/8a678eb9/dist/viewer.css" rel="stylesheet"/>
+<link href="/dist/css/custom_fonts.css" rel="stylesheet"/>
+<script type="importmap">{{"imports": {{"https://st-p.rmcdn1.net/8a678eb9/": "/"}}}}</script>
+{preloads}
+<script src="https://use.typekit.net/abc1def.js"></script>
+<script src="https://screenshoter.readymag.com/stats.js"></script>
+<script src="/dist/config.js"></script>
+<script src="https://st-p.rmcdn1.net/8a678eb9/dist/viewer.js" type="module"></script>
+</head>
+"""
+
+BODY = """<body>
+<div id="root"><style> html, body {{ width: 100%; height: 100%; }} </style></div><div id="mags"></div>
+{images}
+<iframe src="https://www.youtube.com/embed/{video}" frameborder="0"></iframe>
+<script>window.ServerData = {state};</script>
+</body></html>
+"""
+
+
+def random_id(rng, length=21):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_') for _ in range(length))
+
+
+def generate_state(rng, page_ids, size):
+    """
+    Returns a ServerData-like JSON string of about size bytes: a mag with
+    pages of widgets pointing at images under img/.
+    """
+    pages = [{'_id': page_id, 'uri': f"page-{index}", 'wids': []} for index, page_id in enumerate(page_ids)]
+    state = {'mags': {'mag': {'title': 'Generated', 'pages': pages}}, 'opts': {'ga_id': 'G-TEST', 'lang': 'en'}}
+    length = len(json.dumps(state))
+    while length < size:
+        name = random_id(rng)
+        widget = {'_id': random_id(rng, 24), 'type': 'picture', 'x': rng.randint(0, 1200), 'y': rng.randint(0, 4000),
+                  'w': rng.randint(100, 1200), 'h': rng.randint(100, 900),
+                  'picture': {'url': f"img/6666f57326be89003f9494ae/{name}.jpg",
+                              'finalUrl': f"img/6666f57326be89003f9494ae/{name}_w-800.jpg",
+                              'lqipUrl': f"img/6666f57326be89003f9494ae/{name}_w-40_q-50.jpg"}}
+        rng.choice(pages)['wids'].append(widget)
+        length += len(json.dumps(widget)) + 1
+    return json.dumps(state, separators=(',', ':'))
+
+
+def generate_site(root_dir, pages=17, state_kb=780, preloads=224, images=30, seed=1):
+    """
+    Writes a synthetic Readymag-style export to root_dir: index.html plus
+    pages-1 more pages sharing one head, with modulepreload links, <img>
+    tags with CDN srcsets and an inline ServerData of about state_kb KB.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root_dir, exist_ok=True)
+    page_ids = [random_id(rng, 24) for _ in range(pages)]
+    chunks = [f"c-{random_id(rng, 8).upper().replace('-', 'X').replace('_', 'Y')}.js" for _ in range(preloads)]
+    preload_links = '\n'.join(f'<link href="https://st-p.rmcdn1.net/8a678eb9/dist/c/{c}" rel="modulepreload"/>'
+                              for c in chunks)
+    state = generate_state(rng, page_ids, state_kb * 1024)
+    for n in range(pages):
+        tags = '\n'.join(
+            f'<img alt="" src="img/6666f57326be89003f9494ae/{name}.jpg" '
+            f'srcset="https://c-p.rmcdn1.net/{name}_w-400.jpg 400w, https://c-p.rmcdn1.net/{name}_w-800.jpg 800w"/>'
+            for name in (random_id(rng) for _ in range(images)))
+        html = HEAD.format(title=f"Page {n}", n=n, preloads=preload_links) + \
+            BODY.format(images=tags, video=random_id(rng, 11), state=state)
+        filename = 'index.html' if n == 0 else f"page-{n}.html"
+        with open(os.path.join(root_dir, filename), 'w', encoding='utf-8') as f:
+            f.write(html)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_entry_point(name, site_dir):
+    """
+    Runs one entry point over site_dir in this process and returns its
+    measurements. Meant to run in a fresh process so peak RSS is its own.
+    """
+    module_name, function_name = ENTRY_POINTS[name]
+    module = __import__(module_name)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pages = getattr(module, function_name)(site_dir) or []
+    wall = time.perf_counter() - start
+    times = sorted(page.elapsed for page in pages)
+    return {
+        'wall_s': round(wall, 4),
+        'pages': len(pages),
+        'errors': sum(1 for page in pages if page.error is not None),
+        'per_file_ms': {'mean': round(sum(times) / len(times) * 1000, 2) if times else 0,
+                        'p50': round(times[len(times) // 2] * 1000, 2) if times else 0,
+                        'max': round(times[-1] * 1000, 2) if times else 0},
+        'phases_s': {phase: round(sum(page.phases[phase] for page in pages), 4) for phase in PHASES},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def measure(name, site_dir, repeat):
+    """
+    Runs an entry point repeat times, each on a fresh copy of the site and
+    in its own process, and keeps the fastest run.
+    """
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_dir:
+            copy = os.path.join(work_dir, 'site')
+            shutil.copytree(site_dir, copy)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', name, copy],
+                                    capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if output.returncode != 0:
+            raise RuntimeError(f"{name} failed: {output.stderr.strip().splitlines()[-1:]}")
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        if best is None or result['wall_s'] < best['wall_s']:
+            best = result
+    return best
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how results changed against baseline and returns the list of
+    regressions beyond threshold in wall time or peak RSS.
+    """
+    regressions = []
+    print(f"\nCompared with the baseline (threshold {threshold:.0%}):")
+    for scenario, entries in results['scenarios'].items():
+        for name, result in entries['results'].items():
+            old = baseline.get('scenarios', {}).get(scenario, {}).get('results', {}).get(name)
+            if not old:
+                print(f"  - {scenario}/{name}: not in the baseline")
+                continue
+            for key in ('wall_s', 'peak_rss_mb'):
+                if not old.get(key) or result.get(key) is None:
+                    continue
+                change = result[key] / old[key] - 1
+                flag = ''
+                if change > threshold:
+                    regressions.append(f"{scenario}/{name} {key}")
+                    flag = '  REGRESSION'
+                print(f"  - {scenario}/{name} {key}: {old[key]} -> {result[key]} ({change:+.0%}){flag}")
+    return regressions
+
+
+def bench(scenarios, entries, repeat=3, baseline_path=None, threshold=DEFAULT_THRESHOLD, save_baseline=None,
+          output=None, keep_sites=None):
+    results = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+               'repeat': repeat, 'scenarios': {}}
+    for scenario, params in scenarios.items():
+        with tempfile.TemporaryDirectory() as work_dir:
+            site_dir = os.path.join(keep_sites, scenario) if keep_sites else os.path.join(work_dir, 'site')
+            generate_site(site_dir, **params)
+            size = sum(os.path.getsize(os.path.join(site_dir, f)) for f in os.listdir(site_dir))
+            print(f"\nScenario {scenario}: {params['pages']} page(s), {params['state_kb']} KB of state, "
+                  f"{params['preloads']} preload(s), {params['images']} image(s), {size / 1024 / 1024:.1f} MB")
+            entry = results['scenarios'][scenario] = {'params': params, 'results': {}}
+            for name in entries:
+                result = entry['results'][name] = measure(name, site_dir, repeat)
+                print(f"  - {name}: {result['wall_s']:.2f}s, {result['per_file_ms']['mean']:.0f} ms per file "
+                      f"(max {result['per_file_ms']['max']:.0f}), "
+                      f"{', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in result['phases_s'].items())}, "
+                      f"peak RSS {result['peak_rss_mb']} MB"
+                      f"{', ' + str(result['errors']) + ' error(s)' if result['errors'] else ''}")
+
+    regressions = []
+    if baseline_path:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), threshold)
+    for path in (output, save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=1)
+            print(f"\nResults saved to {path}.")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+    return results, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the HTML fixers on generated Readymag-style exports.")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="Export size to generate; can be given several times (default: small and readymag).")
+    parser.add_argument('--pages', type=int, help="Run a custom scenario with this many pages.")
+    parser.add_argument('--state-kb', type=int, default=780, help="Inline state per page in the custom scenario.")
+    parser.add_argument('--preloads', type=int, default=224, help="modulepreload links in the custom scenario.")
+    parser.add_argument('--images', type=int, default=30, help="<img> tags per page in the custom scenario.")
+    parser.add_argument('--entry', action='append', choices=sorted(ENTRY_POINTS),
+                        help="Entry point to time; can be given several times (default: all).")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per measurement, the fastest is kept (default: 3).")
+    parser.add_argument('--baseline', nargs='?', const=BASELINE, metavar='PATH',
+                        help="Compare with this results file and fail on regressions; without PATH, use the "
+                             "committed bench_baseline.json, made with the default scenarios. Regenerate it "
+                             "with --save-baseline bench_baseline.json on the machine that runs the check.")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Allowed slowdown before failing, as a fraction (default: {DEFAULT_THRESHOLD}).")
+    parser.add_argument('--save-baseline', metavar='PATH', help="Write the results as the new baseline.")
+    parser.add_argument('--output', '-o', help="Save the results as JSON here.")
+    parser.add_argument('--keep-sites', metavar='DIR', help="Generate the exports here and keep them.")
+    parser.add_argument('--run-one', nargs=2, metavar=('ENTRY', 'SITE'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        print(json.dumps(run_entry_point(*args.run_one)))
+        return 0
+
+    if args.pages:
+        scenarios = {'custom': {'pages': args.pages, 'state_kb': args.state_kb, 'preloads': args.preloads,
+                                'images': args.images}}
+    else:
+        scenarios = {name: SCENARIOS[name] for name in (args.scenario or ['small', 'readymag'])}
+    results, regressions = bench(scenarios, args.entry or list(ENTRY_POINTS), args.repeat, args.baseline,
+                                 args.threshold, args.save_baseline, args.output, args.keep_sites)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,551 @@
+import argparse
+import hashlib
+import html
+import io
+import json
+import os
+import posixpath
+import re
+import html_stream
+from extract_server_data import FRAGMENT_REF, SHARED_PREFIX, entry_page_id, project_pages
+from fix_pipeline import CRITICAL_CSS_ID, find_html_files
+
+CACHE_NAME = '.critical_css.json'
+
+# Bump this whenever the selection changes, so every cached subset is redone.
+CACHE_VERSION = 1
+
+FALLBACK_ID = 'critical-css-fallback'
+
+# The full sheet is fetched without blocking rendering and applied once it arrives.
+ONLOAD = "this.onload=null;this.rel='stylesheet'"
+
+# States that only exist after the visitor interacts with the page.
+INTERACTIVE = re.compile(r':(?:hover|focus|focus-visible|focus-within|active|visited)\b')
+
+# Arguments of functional pseudo-classes are not required for a match:
+# :not(.x) and :is(.a, .b) are kept whatever the page contains.
+FUNCTIONAL_PSEUDO = re.compile(r':[\w-]+\([^()]*\)')
+ATTRIBUTE_SELECTOR = re.compile(r'\[\s*((?:[\w-]|\\.)+)[^\]]*\]')
+PSEUDO = re.compile(r'::?[\w-]+')
+CLASS_SELECTOR = re.compile(r'\.((?:[\w-]|\\.)+)')
+ID_SELECTOR = re.compile(r'#((?:[\w-]|\\.)+)')
+TYPE_SELECTOR = re.compile(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)')
+
+# Block at-rules whose body is more rules rather than declarations.
+NESTED_AT_RULES = ('@media', '@supports', '@layer', '@container', '@document')
+
+COMMENT_OR_STRING = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|/\*.*?\*/''', re.S)
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+FONT_FAMILY = re.compile(r'font-family\s*:\s*([^;}]+)', re.I)
+
+# Classes the viewer renders around the widgets of a page, whether or not
+# the export prerendered that markup.
+VIEWER_CLASSES = {'mag', 'mag-pages-container', 'page', 'page-content-container', 'content-scroll-wrapper',
+                  'content-bounds', 'animation-container', 'rmwidget'}
+
+KEYFRAMES = re.compile(r'@(?:-[a-z]+-)?keyframes\s+(\S+)', re.I)
+
+# A widget "type" in ServerData, inline or entity-encoded in an attribute.
+WIDGET_TYPE = re.compile(rb'(?:"|&quot;)type(?:"|&quot;)\s*:\s*(?:"|&quot;)([\w-]+)')
+
+
+def strip_comments(text):
+    return COMMENT_OR_STRING.sub(lambda m: m.group(1) or '', text)
+
+
+def skip_string(text, pos):
+    quote = text[pos]
+    pos += 1
+    while pos < len(text) and text[pos] != quote:
+        pos += 2 if text[pos] == '\\' else 1
+    return pos + 1
+
+
+def matching_brace(text, pos):
+    depth = 0
+    while pos < len(text):
+        char = text[pos]
+        if char in '"\'':
+            pos = skip_string(text, pos)
+            continue
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return pos
+        pos += 1
+    return len(text)
+
+
+def parse_css(text):
+    """
+    Splits comment-free CSS into a list of (prelude, body) blocks. body is
+    the declarations of a style rule or of an at-rule like @font-face, the
+    list of nested blocks of @media and the like, or None for statements
+    such as @import.
+    """
+    blocks = []
+    start = pos = 0
+    while pos < len(text):
+        char = text[pos]
+        if char in '"\'':
+            pos = skip_string(text, pos)
+        elif char == ';':
+            if text[start:pos].strip():
+                blocks.append((text[start:pos].strip(), None))
+            pos += 1
+            start = pos
+        elif char == '{':
+            prelude = text[start:pos].strip()
+            close = matching_brace(text, pos)
+            inner = text[pos + 1:close]
+            nested = prelude.lower().startswith(NESTED_AT_RULES)
+            blocks.append((prelude, parse_css(inner) if nested else inner))
+            pos = close + 1
+            start = pos
+        elif char == '}':
+            pos += 1
+            start = pos
+        else:
+            pos += 1
+    return blocks
+
+
+def serialize_css(blocks):
+    parts = []
+    for prelude, body in blocks:
+        if body is None:
+            parts.append(f"{prelude};")
+        elif isinstance(body, list):
+            parts.append(f"{prelude}{{{serialize_css(body)}}}")
+        else:
+            parts.append(f"{prelude}{{{body}}}")
+    return ''.join(parts)
+
+
+def split_selectors(prelude):
+    """
+    Splits a selector list on its top-level commas.
+    """
+    selectors, depth, start = [], 0, 0
+    for pos, char in enumerate(prelude):
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            selectors.append(prelude[start:pos].strip())
+            start = pos + 1
+    selectors.append(prelude[start:].strip())
+    return selectors
+
+
+def unescape_identifier(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def selector_needs(selector):
+    """
+    Returns what an element structure must contain for selector to match
+    somewhere: (tags, classes, ids, attributes). Combinators are ignored,
+    so this over-approximates. Returns None for selectors that only match
+    after an interaction, like :hover.
+    """
+    while True:
+        stripped = FUNCTIONAL_PSEUDO.sub('', selector)
+        if stripped == selector:
+            break
+        selector = stripped
+    if INTERACTIVE.search(selector):
+        return None
+    attributes = {unescape_identifier(name).lower() for name in ATTRIBUTE_SELECTOR.findall(selector)}
+    selector = PSEUDO.sub('', ATTRIBUTE_SELECTOR.sub('', selector))
+    classes = {unescape_identifier(name) for name in CLASS_SELECTOR.findall(selector)}
+    ids = {unescape_identifier(name) for name in ID_SELECTOR.findall(selector)}
+    bare = ID_SELECTOR.sub('', CLASS_SELECTOR.sub('', selector))
+    tags = {name.lower() for name in TYPE_SELECTOR.findall(bare)}
+    return tags, classes, ids, attributes
+
+
+class PageFeatures:
+    """
+    What a page can match at first paint: the tags, classes, ids and
+    attribute names of its markup, plus the classes the viewer gives the
+    widgets of its ServerData (widget-<type>, VIEWER_CLASSES), and its text
+    for fonts.
+    """
+
+    def __init__(self, tags, classes, ids, attributes, widget_types, text):
+        self.tags = tags | {'html', 'head', 'body'}
+        self.classes = classes | VIEWER_CLASSES if widget_types else classes
+        self.ids = ids
+        self.attributes = attributes
+        self.widget_prefixes = tuple(f"widget-{name}" for name in sorted(widget_types))
+        self.text = text
+
+    def has_class(self, name):
+        return name in self.classes or name.startswith(self.widget_prefixes)
+
+    def matches(self, selector):
+        needs = selector_needs(selector)
+        if needs is None:
+            return False
+        tags, classes, ids, attributes = needs
+        return (tags <= self.tags and ids <= self.ids and attributes <= self.attributes
+                and all(self.has_class(name) for name in classes))
+
+    def key(self):
+        """
+        A hash of everything the critical subset depends on besides the CSS.
+        The text is part of it, since it decides which fonts are kept.
+        """
+        parts = [sorted(self.tags), sorted(self.classes), sorted(self.ids), sorted(self.attributes),
+                 list(self.widget_prefixes), self.text]
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def state_bytes(root_dir, data):
+    """
+    Returns the page with the page fragments of dist/pages it points at,
+    where extract_server_data.py moves the widgets of its ServerData.
+    """
+    chunks = [data]
+    for match in FRAGMENT_REF.finditer(data):
+        path = os.path.join(root_dir, 'dist', 'pages', match.group(1).decode('ascii'))
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                chunks.append(f.read())
+    return chunks
+
+
+def shared_state_widgets(root_dir, filepath, src):
+    """
+    Returns the widgets of the page filepath renders out of the shared
+    state file src, or all of them when the page is not found in it.
+    """
+    path = os.path.join(root_dir, src.lstrip('/'))
+    if not os.path.exists(path):
+        return b''
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        state = json.loads(text[text.index('=') + 1:].strip().rstrip(';'))
+    except ValueError:
+        return text.encode('utf-8')
+    pages = project_pages(state)
+    if not pages:
+        return text.encode('utf-8')
+    page_id = entry_page_id(root_dir, filepath, pages)
+    widgets = [page['wids'] for page in pages if page_id is None or page['_id'] == page_id]
+    return json.dumps(widgets).encode('utf-8')
+
+
+def page_features(root_dir, filepath, data):
+    tags, classes, ids, attributes = set(), set(), set(), set()
+    chunks = state_bytes(root_dir, data)
+    for token in html_stream.iter_tags(data):
+        if not isinstance(token, html_stream.StartTag):
+            continue
+        tags.add(token.name)
+        attributes.update(attr.name for attr in token.attrs)
+        classes.update(token.get('class', '').split())
+        if token.get('id'):
+            ids.add(token.get('id'))
+        src = token.get('src') or ''
+        if token.name == 'script' and os.path.basename(src).startswith(SHARED_PREFIX):
+            chunks.append(shared_state_widgets(root_dir, filepath, src))
+    widget_types = {match.decode('ascii') for chunk in chunks for match in WIDGET_TYPE.findall(chunk)}
+    text = html.unescape(b''.join(chunks).decode('utf-8', 'replace'))
+    return PageFeatures(tags, classes, ids, attributes, widget_types, text)
+
+
+def absolutize_urls(css, sheet_path):
+    """
+    Rewrites relative url()s, which resolve against the stylesheet, to
+    paths from the site root so they still work inlined in a page.
+    """
+    base = posixpath.dirname(sheet_path)
+
+    def rewrite(match):
+        quote, url = match.group(1), match.group(2).strip()
+        if url.startswith(('/', '#', 'data:')) or re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', url):
+            return match.group(0)
+        return f"url({quote}{posixpath.normpath(posixpath.join(base, url))}{quote})"
+    return CSS_URL.sub(rewrite, css)
+
+
+def font_families(declarations):
+    families = set()
+    for value in FONT_FAMILY.findall(declarations):
+        families.update(name.strip().strip('"\'') for name in value.split(','))
+    return families
+
+
+def select_rules(blocks, features):
+    """
+    Returns the blocks a page needs at first paint: style rules with at
+    least one selector that can match it, narrowed to those selectors, and
+    @media or @supports blocks holding any. @font-face and @keyframes are
+    left for critical_subset to decide once the rules are known.
+    """
+    selected = []
+    for prelude, body in blocks:
+        lower = prelude.lower()
+        if isinstance(body, list):
+            children = select_rules(body, features)
+            if children:
+                selected.append((prelude, children))
+        elif lower.startswith('@font-face') or KEYFRAMES.match(prelude):
+            selected.append((prelude, body))
+        elif lower.startswith(('@charset', '@page')):
+            continue
+        elif prelude.startswith('@'):
+            selected.append((prelude, body))
+        else:
+            selectors = [s for s in split_selectors(prelude) if features.matches(s)]
+            if selectors:
+                selected.append((','.join(selectors), body))
+    return selected
+
+
+def drop_unused(blocks, used_text, page_text):
+    """
+    Keeps @font-face rules for families the critical rules or the page
+    mention and @keyframes the critical rules run.
+    """
+    kept = []
+    for prelude, body in blocks:
+        lower = prelude.lower()
+        if isinstance(body, list):
+            children = drop_unused(body, used_text, page_text)
+            if children:
+                kept.append((prelude, children))
+        elif lower.startswith('@font-face'):
+            if any(family and (family in used_text or family in page_text) for family in font_families(body)):
+                kept.append((prelude, body))
+        elif KEYFRAMES.match(prelude):
+            name = re.escape(KEYFRAMES.match(prelude).group(1))
+            if re.search(r'(?<![\w-])' + name + r'(?![\w-])', used_text):
+                kept.append((prelude, body))
+        else:
+            kept.append((prelude, body))
+    return kept
+
+
+def drop_at_rules(blocks):
+    """
+    Returns blocks without @font-face and @keyframes, at any depth.
+    """
+    kept = []
+    for prelude, body in blocks:
+        if isinstance(body, list):
+            kept.append((prelude, drop_at_rules(body)))
+        elif not (prelude.lower().startswith('@font-face') or KEYFRAMES.match(prelude)):
+            kept.append((prelude, body))
+    return kept
+
+
+def critical_subset(sheets, features):
+    """
+    Returns the critical CSS of a page out of sheets, a list of parsed
+    stylesheets.
+    """
+    selected = [select_rules(blocks, features) for blocks in sheets]
+    used_text = ''.join(serialize_css(drop_at_rules(blocks)) for blocks in selected)
+    return ''.join(serialize_css(drop_unused(blocks, used_text, features.text)) for blocks in selected)
+
+
+def load_cache(root_dir):
+    path = os.path.join(root_dir, CACHE_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache.get('entries', {}) if cache.get('version') == CACHE_VERSION else {}
+
+
+def save_cache(root_dir, entries):
+    path = os.path.join(root_dir, CACHE_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'version': CACHE_VERSION, 'entries': entries}, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def is_deferred_link(token):
+    return token.get('rel', '').lower() == 'preload' and token.get('as') == 'style' and token.get('onload') == ONLOAD
+
+
+def find_stylesheets(root_dir, data, edits):
+    """
+    Returns the local stylesheets of a page in document order, and records
+    in edits the removal of their links and of what an earlier run added.
+    The first returned value is where the new block goes.
+    """
+    sheets, insert_at, fallback_start = [], None, None
+    for token in html_stream.iter_tags(data, edits):
+        if isinstance(token, html_stream.EndTag):
+            if token.name == 'noscript' and fallback_start is not None:
+                edits.append((fallback_start, token.end, b''))
+                fallback_start = None
+            continue
+        if token.name == 'noscript' and token.get('id') == FALLBACK_ID:
+            fallback_start = token.start
+            continue
+        if fallback_start is not None:
+            continue
+        if token.name == 'style' and token.get('id') == CRITICAL_CSS_ID:
+            insert_at = token.start if insert_at is None else insert_at
+            token.remove()
+            continue
+        if token.name != 'link':
+            continue
+        href = token.get('href') or ''
+        is_sheet = token.get('rel', '').lower() == 'stylesheet' or is_deferred_link(token)
+        if not is_sheet or not href.startswith('/') or href.startswith('//') or token.has('media'):
+            continue
+        if not os.path.isfile(os.path.join(root_dir, href.lstrip('/').split('?')[0])):
+            continue
+        insert_at = token.start if insert_at is None else insert_at
+        token.remove()
+        sheets.append(href)
+    return insert_at, sheets
+
+
+def insert_block(edits, pos, markup):
+    """
+    Puts markup in place of the element removed at pos; apply_edits would
+    drop a separate insertion that falls inside the removed range.
+    """
+    for index, (start, end, replacement) in enumerate(edits):
+        if start == pos:
+            edits[index] = (start, end, markup + replacement)
+            return
+
+
+def build_block(critical, sheets):
+    """
+    The markup that replaces the stylesheet links: the critical CSS inline,
+    the full sheets preloaded and applied when they arrive, and plain links
+    for visitors without JavaScript.
+    """
+    style = critical.replace('</', '<\\/')
+    preloads = ''.join(f'<link as="style" href="{html.escape(href)}" onload="{ONLOAD}" rel="preload"/>'
+                       for href in sheets)
+    fallback = ''.join(f'<link href="{html.escape(href)}" rel="stylesheet"/>' for href in sheets)
+    return (f'<style id="{CRITICAL_CSS_ID}">{style}</style>{preloads}'
+            f'<noscript id="{FALLBACK_ID}">{fallback}</noscript>').encode('utf-8')
+
+
+def load_sheets(root_dir, hrefs, parsed):
+    """
+    Returns (hash, parsed sheets) for hrefs, parsing each file once per run.
+    """
+    digest = hashlib.sha256(str(CACHE_VERSION).encode('ascii'))
+    sheets = []
+    for href in hrefs:
+        if href not in parsed:
+            path = href.split('?')[0]
+            with open(os.path.join(root_dir, path.lstrip('/')), 'rb') as f:
+                raw = f.read()
+            text = absolutize_urls(strip_comments(raw.decode('utf-8', 'replace')), path)
+            parsed[href] = (hashlib.sha256(raw).hexdigest(), parse_css(text), len(raw))
+        digest.update(f"{href}:{parsed[href][0]}\n".encode('utf-8'))
+        sheets.append(parsed[href][1])
+    return digest.hexdigest()[:16], sheets
+
+
+def inline_critical_css(root_dir, dry_run=False, force=False):
+    """
+    Inlines the CSS each page needs at first paint and loads its local
+    stylesheets without blocking rendering. Subsets are cached per
+    (stylesheets hash, page features hash) in .critical_css.json.
+    """
+    cache = {} if force else load_cache(root_dir)
+    used = {}
+    parsed = {}
+    for filepath in find_html_files(root_dir):
+        print(f"\nProcessing: {filepath}")
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            edits = []
+            insert_at, hrefs = find_stylesheets(root_dir, data, edits)
+            if not hrefs:
+                print("  - No local stylesheets.")
+                continue
+            css_hash, sheets = load_sheets(root_dir, hrefs, parsed)
+            # Read the page without what an earlier run added, so reruns match.
+            features = page_features(root_dir, filepath, apply_edits(data, edits))
+            key = f"{css_hash}:{features.key()}"
+            hit = key in cache
+            critical = cache[key] if hit else critical_subset(sheets, features)
+            used[key] = critical
+
+            insert_block(edits, insert_at, build_block(critical, hrefs))
+            full = sum(parsed[href][2] for href in hrefs)
+            print(f"  - {len(critical.encode('utf-8')) / 1024:,.1f} KB of {full / 1024:,.1f} KB inlined from "
+                  f"{len(hrefs)} stylesheet(s){' (cached)' if hit else ''}.")
+
+            new_data = apply_edits(data, edits)
+            if new_data == data:
+                print(f"  - No changes were made to {os.path.basename(filepath)}.")
+            elif dry_run:
+                print(f"  - Dry run, changes not saved to {os.path.basename(filepath)}.")
+            else:
+                html_stream.write_atomic(filepath, new_data)
+                print(f"  - Changes saved to {os.path.basename(filepath)}.")
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+
+    if not dry_run:
+        save_cache(root_dir, used)
+    return used
+
+
+def restore_stylesheets(root_dir, dry_run=False):
+    """
+    Puts plain blocking <link rel="stylesheet"> tags back in place of the
+    critical CSS blocks.
+    """
+    for filepath in find_html_files(root_dir):
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        edits = []
+        insert_at, hrefs = find_stylesheets(root_dir, data, edits)
+        if not any(is_deferred_link(token) for token in html_stream.iter_tags(data)
+                   if isinstance(token, html_stream.StartTag) and token.name == 'link'):
+            continue
+        links = ''.join(f'<link href="{html.escape(href)}" rel="stylesheet"/>' for href in hrefs)
+        insert_block(edits, insert_at, links.encode('utf-8'))
+        print(f"Processing: {filepath}\n  - Restored {len(hrefs)} stylesheet link(s).")
+        if not dry_run:
+            html_stream.write_atomic(filepath, data=apply_edits(data, edits))
+
+
+def apply_edits(data, edits):
+    out = io.BytesIO()
+    html_stream.apply_edits(data, edits, out)
+    return out.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inline each page's critical CSS and load the full stylesheets async.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--dry-run', action='store_true', help="Report the critical CSS sizes without writing anything.")
+    parser.add_argument('--force', action='store_true', help="Ignore the cache and recompute every subset.")
+    parser.add_argument('--restore', action='store_true', help="Put the plain stylesheet links back.")
+    args = parser.parse_args(argv)
+
+    if args.restore:
+        restore_stylesheets(args.root, args.dry_run)
+    else:
+        inline_critical_css(args.root, dry_run=args.dry_run, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
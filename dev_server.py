@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import email.utils
+import mimetypes
+import os
+import time
+from collections import OrderedDict
+from server_rules import RULE_SETS, Request, load_rules, site_file, split_target
+
+# Types the site needs that mimetypes does not know everywhere.
+CONTENT_TYPES = {'.js': 'text/javascript', '.mjs': 'text/javascript', '.json': 'application/json',
+                 '.svg': 'image/svg+xml', '.woff2': 'font/woff2', '.woff': 'font/woff', '.webp': 'image/webp',
+                 '.avif': 'image/avif', '.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+TEXT_TYPES = ('text/', 'application/json', 'application/vnd.apple.mpegurl', 'image/svg+xml')
+
+SIDECARS = {'br': '.br', 'gzip': '.gz'}
+
+REASONS = {200: 'OK', 206: 'Partial Content', 301: 'Moved Permanently', 302: 'Found', 303: 'See Other',
+           304: 'Not Modified', 307: 'Temporary Redirect', 308: 'Permanent Redirect', 400: 'Bad Request',
+           403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 410: 'Gone',
+           416: 'Range Not Satisfiable', 500: 'Internal Server Error'}
+
+
+class FileCache:
+    """
+    An LRU cache of file bytes, bounded by their total size and checked
+    against the file's size and mtime on every hit so edits show up at
+    once. Files over a quarter of the budget are read each time instead.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, filepath):
+        """
+        Returns (stat, data, hit) for filepath.
+        """
+        stat = os.stat(filepath)
+        entry = self.entries.get(filepath)
+        if entry and entry[0].st_mtime_ns == stat.st_mtime_ns and entry[0].st_size == stat.st_size:
+            self.entries.move_to_end(filepath)
+            self.hits += 1
+            return entry[0], entry[1], True
+        self.misses += 1
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        if entry:
+            self.used -= len(entry[1])
+            del self.entries[filepath]
+        if len(data) <= self.max_bytes // 4:
+            self.entries[filepath] = (stat, data)
+            self.used += len(data)
+            while self.used > self.max_bytes:
+                old_stat, old_data = self.entries.popitem(last=False)[1]
+                self.used -= len(old_data)
+        return stat, data, False
+
+
+def content_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    guessed = CONTENT_TYPES.get(ext) or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    return f"{guessed}; charset=utf-8" if guessed.startswith(TEXT_TYPES) else guessed
+
+
+def accepts(header, encoding):
+    """
+    True when an Accept-Encoding header allows encoding (q > 0).
+    """
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip().lower() in (encoding, '*'):
+            q = params.strip()
+            return not (q.startswith('q=') and float(q[2:] or 0) == 0)
+    return False
+
+
+def is_fresh(sidecar, source):
+    """
+    True unless source changed after its precompressed sidecar was made.
+    """
+    return not os.path.exists(source) or os.path.getmtime(sidecar) >= os.path.getmtime(source)
+
+
+def etag_for(stat):
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def not_modified(headers, etag, mtime):
+    if 'if-none-match' in headers:
+        tags = [t.strip().removeprefix('W/') for t in headers['if-none-match'].split(',')]
+        return '*' in tags or etag in tags
+    since = headers.get('if-modified-since')
+    if since:
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_range(header, size):
+    """
+    Returns (start, end) inclusive for a single bytes range, None when the
+    header asks for something else, or 'unsatisfiable'.
+    """
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if not first:
+            length = int(last)
+            if length == 0:
+                return 'unsatisfiable'
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return 'unsatisfiable'
+    return start, end
+
+
+def respond(root_dir, route, request, cache):
+    """
+    Turns a route into (status, headers, body, note) for one request.
+    """
+    if route.location is not None:
+        return route.status, [('Location', route.location)], b'', ''
+    if route.status is not None:
+        body = f"{route.status} {REASONS.get(route.status, '')}\n".encode('utf-8')
+        return route.status, [('Content-Type', 'text/plain; charset=utf-8')], body, ''
+
+    filepath = site_file(root_dir, route.path)
+    if filepath is None or not os.path.isfile(filepath):
+        return 404, [('Content-Type', 'text/plain; charset=utf-8')], f"404 {REASONS[404]}\n".encode('utf-8'), ''
+    headers = list(route.headers)
+    stale = ''
+    source = next((filepath[:-len(ext)] for ext in SIDECARS.values() if filepath.endswith(ext)), None)
+    if source and not is_fresh(filepath, source):
+        # The rules picked a sidecar some later stage made stale; send the file it was made from.
+        filepath, stale = source, 'stale sidecar skipped'
+        route.path = route.path[:route.path.rfind('.')]
+        route.content_type = None
+        headers = [(h, v) for h, v in headers if h.lower() != 'content-encoding']
+    wants_range = 'range' in request.headers
+    encoding = None
+    # Ranges are served from the file itself, so offsets mean what the client thinks.
+    if route.encodings and not wants_range:
+        for name in route.encodings:
+            if accepts(request.headers.get('accept-encoding', ''), name) and os.path.isfile(filepath + SIDECARS[name]):
+                if not is_fresh(filepath + SIDECARS[name], filepath):
+                    stale = 'stale sidecar skipped'
+                    continue
+                encoding = name
+                break
+        headers.append(('Vary', 'Accept-Encoding'))
+    stat, data, hit = cache.get(filepath + SIDECARS[encoding] if encoding else filepath)
+    note = f"{'hit' if hit else 'miss'}{f' {encoding}' if encoding else ''}{f' {stale}' if stale else ''}"
+
+    etag = etag_for(stat)
+    headers += [('Content-Type', route.content_type or content_type(route.path)), ('ETag', etag),
+                ('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True)), ('Accept-Ranges', 'bytes')]
+    if encoding:
+        headers.append(('Content-Encoding', encoding))
+    if route.file_status == 200 and not_modified(request.headers, etag, stat.st_mtime):
+        return 304, [h for h in headers if h[0] != 'Content-Type'], b'', note
+
+    if wants_range and route.file_status == 200:
+        if_range = request.headers.get('if-range')
+        if if_range is None or if_range == etag or if_range == email.utils.formatdate(stat.st_mtime, usegmt=True):
+            span = parse_range(request.headers['range'], len(data))
+            if span == 'unsatisfiable':
+                return 416, [('Content-Range', f"bytes */{len(data)}")], b'', note
+            if span:
+                start, end = span
+                headers.append(('Content-Range', f"bytes {start}-{end}/{len(data)}"))
+                return 206, headers, data[start:end + 1], note + f" range {start}-{end}"
+    return route.file_status, headers, data, note
+
+
+class DevServer:
+    """
+    Serves root_dir over HTTP/1.1 the way the chosen rule set would route
+    it, logging the rules behind every response. The rules are reloaded
+    whenever their config file changes.
+    """
+
+    def __init__(self, root_dir, rules_name, cache_bytes, quiet=False):
+        self.root_dir = root_dir
+        self.rules_name = rules_name
+        self.cache = FileCache(cache_bytes)
+        self.quiet = quiet
+        self.config_path = os.path.join(root_dir, RULE_SETS[rules_name][1])
+        self.config_mtime = None
+        self.rules = None
+
+    def current_rules(self):
+        mtime = os.stat(self.config_path).st_mtime_ns
+        if mtime != self.config_mtime:
+            self.rules = load_rules(self.root_dir, self.rules_name)
+            if self.config_mtime is not None:
+                print(f"  - {os.path.basename(self.config_path)} changed, rules reloaded.")
+            self.config_mtime = mtime
+        return self.rules
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                started = time.perf_counter()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await self.send(writer, 'HTTP/1.1', 400, [], b'', False)
+                    break
+                method, target, version = parts
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                route = None
+                if method not in ('GET', 'HEAD'):
+                    status, out_headers, body, note, trail = 405, [('Allow', 'GET, HEAD')], b'', '', []
+                else:
+                    try:
+                        path, query = split_target(target)
+                    except ValueError as e:
+                        await self.send(writer, version, 400, [], b'', False)
+                        if not self.quiet:
+                            print(f"{method} {target} 400\n    {e}")
+                        break
+                    request = Request(method, path, query, headers)
+                    try:
+                        route = self.current_rules().route(request)
+                        status, out_headers, body, note = respond(self.root_dir, route, request, self.cache)
+                        trail = route.trail
+                    except Exception as e:
+                        status, out_headers, body, note, trail = 500, [], f"{e}\n".encode('utf-8'), '', [str(e)]
+                await self.send(writer, version, status, out_headers, body if method != 'HEAD' else b'',
+                                keep_alive, len(body))
+                if not self.quiet:
+                    served = f" -> {route.path}" if route and route.path and status in (200, 206, 304) else ''
+                    print(f"{method} {target} {status} {len(body):,}B {(time.perf_counter() - started) * 1000:.1f}ms"
+                          f"{served}{f' [{note}]' if note else ''}\n    {' > '.join(trail) or 'no rule matched, served as is'}")
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer, version, status, headers, body, keep_alive, length=None):
+        lines = [f"{version} {status} {REASONS.get(status, '')}",
+                 f"Date: {email.utils.formatdate(usegmt=True)}",
+                 f"Content-Length: {len(body) if length is None else length}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        self.current_rules()
+        server = await asyncio.start_server(self.handle, host, port)
+        address = server.sockets[0].getsockname()
+        print(f"Serving {os.path.abspath(self.root_dir)} at http://{address[0]}:{address[1]}/ "
+              f"with the {self.rules_name} rules. Press Ctrl+C to stop.")
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the site locally with the routing of one of its server configs.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--rules', choices=sorted(RULE_SETS), default='nginx',
+                        help="Which config to emulate (default: nginx).")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on (default: 8000, 0 picks one).")
+    parser.add_argument('--cache-mb', type=float, default=64, help="Memory for cached file bytes (default: 64 MB).")
+    parser.add_argument('--quiet', action='store_true', help="Do not log each request.")
+    args = parser.parse_args(argv)
+
+    server = DevServer(args.root, args.rules, int(args.cache_mb * 1024 * 1024), quiet=args.quiet)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        return 1
+    except KeyboardInterrupt:
+        print(f"\nStopped. Cache: {server.cache.hits} hit(s), {server.cache.misses} miss(es).")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,366 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import html_stream
+from fix_pipeline import PAGE_STATE_ID, find_html_files
+
+# Where the inline state starts inside the big Readymag bootstrap script.
+SERVER_DATA_START = re.compile(rb'window\.ServerData\s*=\s*')
+
+SHARED_DIR = 'dist'
+SHARED_PREFIX = 'server-data.'
+
+# Per-page widget lists, loaded on demand when the viewer opens another page.
+FRAGMENT_DIR = 'dist/pages'
+FRAGMENT_REF = re.compile(rb'/dist/pages/([0-9a-f]+\.[0-9a-f]+\.json)')
+
+# Deep-merges the page's own state into the shared window.ServerData.
+MERGE_SCRIPT = ("(function m(t,s){for(var k in s){var v=s[k];"
+                "if(v&&typeof v==='object'&&!Array.isArray(v)&&t[k]&&typeof t[k]==='object'&&!Array.isArray(t[k]))m(t[k],v);"
+                "else t[k]=v}})(window.ServerData=window.ServerData||{},{});")
+
+# Appended to the shared file when pages are split. Each page's widget list
+# becomes a getter over a cache: the entry page's copy is inline, and the
+# others are fetched in the background once the page has loaded, or straight
+# away when a pointer or focus lands on a link to them. The viewer reads the
+# widgets synchronously, so a page opened before its fetch lands still falls
+# back to a blocking request.
+LAZY_PAGES_SCRIPT = ("(function(pages){var inline=window.ServerDataPages||{},byPath={},queue=[];"
+                     "function key(s){return(s||'').replace(/^\\/+|\\/+$/g,'')}"
+                     "(pages||[]).forEach(function(p){var url=p.widsUrl,wids=inline[p._id],pending;if(!url)return;"
+                     "delete p.widsUrl;function load(){if(wids===undefined&&!pending&&window.fetch)"
+                     "pending=fetch(url).then(function(r){return r.json()}).then(function(v){if(wids===undefined)wids=v},"
+                     "function(){pending=null})}"
+                     "Object.defineProperty(p,'wids',{configurable:true,enumerable:true,"
+                     "get:function(){if(wids===undefined){var x=new XMLHttpRequest();x.open('GET',url,false);"
+                     "x.send();wids=JSON.parse(x.responseText)}return wids},set:function(v){wids=v}});"
+                     "byPath[key(p.pagePath||p.uri)]=byPath[key(p.uri)]=load;queue.push(load)});"
+                     "function near(e){var a=e.target&&e.target.closest&&e.target.closest('a[href]');"
+                     "if(a&&a.origin===location.origin&&byPath[key(a.pathname)])byPath[key(a.pathname)]()}"
+                     "['pointerover','touchstart','focusin'].forEach(function(t){"
+                     "document.addEventListener(t,near,{capture:true,passive:true})});"
+                     "function idle(){(window.requestIdleCallback||function(f){setTimeout(f,200)})(function(d){"
+                     "while(queue.length&&!(d&&d.timeRemaining&&d.timeRemaining()<1))queue.shift()();if(queue.length)idle()})}"
+                     "if(document.readyState==='complete')idle();else window.addEventListener('load',idle)})"
+                     "(window.ServerData.mags&&window.ServerData.mags.mag&&window.ServerData.mags.mag.pages);\n")
+
+# Project style lists in mags.mag, referenced from widget text by name.
+STYLE_KEYS = ('textStyles', 'linkStyles', 'listStyles')
+
+# Marks a value that is not shared by every page.
+MISSING = object()
+
+
+def find_server_data(data, edits=None):
+    """
+    Finds the inline script that assigns window.ServerData and returns
+    (tag, prefix, state, suffix): the script code before and after the
+    assignment and the decoded state. Returns None when the page has no
+    inline state or already loads the shared file. Edits made through the
+    tag are recorded in edits.
+    """
+    for token in html_stream.iter_tags(data, edits):
+        if not isinstance(token, html_stream.StartTag) or token.name != 'script':
+            continue
+        src = token.get('src') or ''
+        if os.path.basename(src).startswith(SHARED_PREFIX):
+            return None
+        if token.has('src') or token.content_end is None:
+            continue
+        body = token.content
+        match = SERVER_DATA_START.search(body)
+        if not match:
+            continue
+        text = body.decode('utf-8')
+        json_start = len(body[:match.end()].decode('utf-8'))
+        state, json_end = json.JSONDecoder().raw_decode(text, json_start)
+        suffix = text[json_end:]
+        if suffix.lstrip().startswith(';'):
+            suffix = suffix.lstrip()[1:]
+        return token, text[:match.start()], state, suffix
+    return None
+
+
+def split_shared(values):
+    """
+    Splits one value per page into the part every page has in common and
+    what is left over for each page. Dicts are compared key by key; lists
+    and scalars are shared only when they are equal on every page. Returns
+    (shared, overlays), with MISSING where nothing is shared or left over.
+    """
+    first = values[0]
+    if all(v == first for v in values[1:]):
+        return first, [MISSING] * len(values)
+    if not all(isinstance(v, dict) for v in values):
+        return MISSING, values
+
+    common = [k for k in first if all(k in v for v in values[1:])]
+    shared = {}
+    overlays = [{k: v for k, v in value.items() if k not in common} for value in values]
+    for key in common:
+        key_shared, key_overlays = split_shared([v[key] for v in values])
+        if key_shared is not MISSING:
+            shared[key] = key_shared
+        for overlay, key_overlay in zip(overlays, key_overlays):
+            if key_overlay is not MISSING:
+                overlay[key] = key_overlay
+    return shared, [overlay or MISSING for overlay in overlays]
+
+
+def to_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def project_pages(state):
+    """
+    Returns the list of pages in a ServerData state, or [] if it has none.
+    """
+    mag = state.get('mags', {}).get('mag', {}) if isinstance(state, dict) else {}
+    pages = mag.get('pages') if isinstance(mag, dict) else None
+    if not isinstance(pages, list):
+        return []
+    return [p for p in pages if isinstance(p, dict) and isinstance(p.get('wids'), list) and p.get('_id')]
+
+
+def entry_page_id(root_dir, filepath, pages):
+    """
+    Works out which project page an HTML file renders: index.html is the page
+    without a uri, any other file is matched on its uri or page path.
+    """
+    name = os.path.splitext(os.path.relpath(filepath, root_dir).replace(os.sep, '/'))[0]
+    for page in pages:
+        uri = page.get('uri') or ''
+        if (name == 'index' and not uri) or name in (uri, page.get('pagePath')):
+            return page['_id']
+    return None
+
+
+def split_pages(root_dir, pages, dry_run=False):
+    """
+    Moves the widget list of every page into dist/pages/<id>.<hash>.json
+    and leaves a widsUrl in its place. Returns {page id: widgets} and the
+    total size of the fragments.
+    """
+    widgets = {}
+    total = 0
+    for page in pages:
+        content = to_json(page['wids']).encode('utf-8')
+        filename = f"{page['_id']}.{hashlib.sha256(content).hexdigest()[:10]}.json"
+        if not dry_run:
+            os.makedirs(os.path.join(root_dir, FRAGMENT_DIR), exist_ok=True)
+            with open(os.path.join(root_dir, FRAGMENT_DIR, filename), 'wb') as f:
+                f.write(content)
+        widgets[page['_id']] = page.pop('wids')
+        page['widsUrl'] = f"/{FRAGMENT_DIR}/{filename}"
+        total += len(content)
+    return widgets, total
+
+
+def prune_styles(shared, used_in):
+    """
+    Drops the project styles that nothing in used_in mentions by name and
+    returns how many went and their size. The viewer turns the whole list
+    into CSS once, at boot, and pages opened later reuse it, so one list
+    has to serve every page: only styles no page uses can go.
+    """
+    mag = shared.get('mags', {}).get('mag', {}) if isinstance(shared, dict) else {}
+    if not isinstance(mag, dict):
+        return 0, 0
+    text = to_json(used_in)
+    removed = size = 0
+    for key in STYLE_KEYS:
+        styles = mag.get(key) if isinstance(mag.get(key), dict) else {}
+        project = styles.get('project')
+        if not isinstance(project, list):
+            continue
+        kept = [style for style in project if not isinstance(style, dict) or not style.get('name')
+                or style['name'] in text]
+        removed += len(project) - len(kept)
+        size += len(to_json(project)) - len(to_json(kept))
+        styles['project'] = kept
+    return removed, size
+
+
+def style_usage(state, widgets):
+    """
+    Returns how many of the project text and link styles the widgets use.
+    """
+    mag = state.get('mags', {}).get('mag', {})
+    names = [style.get('name') for key in ('textStyles', 'linkStyles')
+             for style in (mag.get(key) or {}).get('project', []) if isinstance(style, dict)]
+    names = [name for name in names if name]
+    text = to_json(widgets)
+    return sum(1 for name in names if name in text), len(names)
+
+
+def write_shared_file(root_dir, shared, dry_run=False, split=False):
+    """
+    Writes the shared state to dist/server-data.<hash>.js and returns its
+    path from the site root and its size in bytes.
+    """
+    content = f"window.ServerData = {to_json(shared)};\n".encode('utf-8')
+    if split:
+        content += LAZY_PAGES_SCRIPT.encode('utf-8')
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    filename = f"{SHARED_PREFIX}{digest}.js"
+    if not dry_run:
+        os.makedirs(os.path.join(root_dir, SHARED_DIR), exist_ok=True)
+        with open(os.path.join(root_dir, SHARED_DIR, filename), 'wb') as f:
+            f.write(content)
+    return f"/{SHARED_DIR}/{filename}", len(content)
+
+
+def build_loader(prefix, suffix, shared_src, overlay, page_widgets=None):
+    """
+    Returns the markup that replaces the inline script: the code the script
+    ran before the assignment, the shared file, the page's own state if it
+    has any, then the code it ran after, once ServerData is complete.
+    page_widgets is {page id: widgets} for the page the file renders.
+    """
+    parts = []
+    if prefix.strip():
+        parts.append(f"<script>\n{prefix.strip()}\n</script>")
+    parts.append(f'<script src="{shared_src}"></script>')
+    page_code = []
+    if page_widgets:
+        page_code.append('window.ServerDataPages=' + to_json(page_widgets).replace('</', '<\\/') + ';')
+    if overlay is not MISSING:
+        page_code.append(MERGE_SCRIPT.replace(',{});', ',' + to_json(overlay).replace('</', '<\\/') + ');'))
+    if page_code:
+        parts.append(f'<script id="{PAGE_STATE_ID}">{"".join(page_code)}</script>')
+    if suffix.strip():
+        parts.append(f"<script>\n{suffix.strip()}\n</script>")
+    return '\n'.join(parts).encode('utf-8')
+
+
+def remove_stale_files(root_dir, keep):
+    """
+    Deletes shared state files that no page loads anymore, then the page
+    fragments that no remaining shared file points at.
+    """
+    fragments = set()
+    for path in glob.glob(os.path.join(root_dir, SHARED_DIR, SHARED_PREFIX + '*.js')):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+            html_stream.remove_sidecars(path)
+            print(f"  - Removed stale {os.path.relpath(path, root_dir)}.")
+            continue
+        with open(path, 'rb') as f:
+            fragments.update(m.group(1).decode('ascii') for m in FRAGMENT_REF.finditer(f.read()))
+    for path in glob.glob(os.path.join(root_dir, FRAGMENT_DIR, '*.json')):
+        if os.path.basename(path) not in fragments:
+            os.remove(path)
+            html_stream.remove_sidecars(path)
+            print(f"  - Removed stale {os.path.relpath(path, root_dir)}.")
+
+
+def referenced_shared_files(html_files):
+    names = set()
+    for filepath in html_files:
+        with open(filepath, 'rb') as f:
+            for match in re.finditer(rb'/' + SHARED_DIR.encode() + rb'/(' + re.escape(SHARED_PREFIX.encode()) + rb'[0-9a-f]+\.js)', f.read()):
+                names.add(match.group(1).decode('ascii'))
+    return names
+
+
+def extract_server_data(root_dir, dry_run=False, split=False):
+    """
+    Moves the window.ServerData state that every page repeats into one
+    content-hashed file under dist/ and leaves only page-specific state
+    inline. With split, the widgets of each project page go to their own
+    fragment and every HTML file only inlines the widgets of the page it
+    renders. Prints the bytes saved across the site.
+    """
+    html_files = find_html_files(root_dir)
+    pages = []
+    for filepath in html_files:
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            edits = []
+            found = find_server_data(data, edits)
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+            continue
+        if found is None:
+            print(f"Skipping {filepath}: no inline ServerData.")
+            continue
+        pages.append((filepath, data, edits) + found)
+
+    if not pages:
+        print("No inline ServerData found. Nothing to extract.")
+        return
+
+    shared, overlays = split_shared([page[5] for page in pages])
+    if shared is MISSING:
+        shared = {}
+
+    widgets, fragments_size = {}, 0
+    project = project_pages(shared) if split else []
+    if project:
+        widgets, fragments_size = split_pages(root_dir, project, dry_run)
+        print(f"Split the widgets of {len(project)} project page(s) into {FRAGMENT_DIR}/ ({fragments_size:,} bytes)")
+    elif split:
+        print("The pages differ between files or there are none; nothing to split.")
+    mag = shared.get('mags', {}).get('mag', {}) if isinstance(shared, dict) else {}
+    others = {k: v for k, v in mag.items() if k not in STYLE_KEYS} if isinstance(mag, dict) else {}
+    removed, removed_size = prune_styles(shared, [others, widgets, [o for o in overlays if o is not MISSING]])
+    if removed:
+        print(f"Dropped {removed} project style(s) no page uses ({removed_size:,} bytes)")
+    shared_src, shared_size = write_shared_file(root_dir, shared, dry_run, split=bool(project))
+    print(f"Shared state: {shared_src} ({shared_size:,} bytes)")
+
+    bytes_before = bytes_after = 0
+    for (filepath, data, edits, tag, prefix, state, suffix), overlay in zip(pages, overlays):
+        print(f"\nProcessing: {filepath}")
+        page_id = entry_page_id(root_dir, filepath, project) if project else None
+        page_widgets = {page_id: widgets[page_id]} if page_id else None
+        loader = build_loader(prefix, suffix, shared_src, overlay, page_widgets)
+        tag.replace(loader)
+        bytes_before += tag.element_end - tag.start
+        bytes_after += len(loader)
+        if page_widgets:
+            used, total = style_usage(state, page_widgets[page_id])
+            print(f"  - Inlined {len(widgets[page_id])} widget(s) of its own page "
+                  f"({len(to_json(page_widgets)):,} bytes, {used} of {total} project styles).")
+        elif project:
+            print("  - Renders no project page; every page is loaded on demand.")
+        elif overlay is MISSING:
+            print("  - No page-specific state, only the shared file is loaded.")
+        if overlay is not MISSING:
+            print(f"  - Kept {len(to_json(overlay)):,} bytes of page-specific state inline.")
+        if dry_run:
+            continue
+        try:
+            html_stream.write_atomic(filepath, edits=edits, source=data)
+            print(f"  - Inline ServerData replaced in {os.path.basename(filepath)}.")
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+
+    if not dry_run:
+        remove_stale_files(root_dir, referenced_shared_files(html_files))
+
+    saved = bytes_before - bytes_after - shared_size - fragments_size
+    print(f"\n{len(pages)} page(s): {bytes_before:,} bytes of inline state became "
+          f"{bytes_after:,} bytes of loaders plus one {shared_size:,} byte shared file.")
+    if project:
+        print(f"First load of a page: {(bytes_after // len(pages)) + shared_size:,} bytes of state on average, "
+              f"was {bytes_before // len(pages):,}.")
+    print(f"Saved {saved:,} bytes across the site.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move the ServerData state repeated on every page into one cacheable file.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--dry-run', action='store_true', help="Report the savings without writing anything.")
+    parser.add_argument('--split-pages', action='store_true',
+                        help="Only inline the widgets of the page each file renders and load the others on demand.")
+    args = parser.parse_args(argv)
+    extract_server_data(args.root, dry_run=args.dry_run, split=args.split_pages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import argparse
+import glob
+import io
+import os
+import posixpath
+import re
+import html_stream
+from asset_refs import css_refs, embedded_refs, html_refs, rename_url, resolve_ref
+from fix_manifest import hash_bytes
+from fix_pipeline import find_html_files
+from module_graph import import_spans, load_import_map, resolve
+from server_config import (HTACCESS, NGINX_CONFIG, NGINX_SERVER_LEVEL, WEB_CONFIG, after_first, before_first,
+                           ensure_element, set_block, update_file)
+
+HASH_LENGTH = 10
+
+# name.<hash>.ext -- the same scheme extract_server_data.py uses.
+FINGERPRINTED = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[A-Za-z0-9]+)$' % HASH_LENGTH)
+
+# Assets with stable names, as paths from the site root before fingerprinting.
+ASSET_FILES = ('/dist/viewer.css', '/dist/css/custom_fonts.css', '/dist/config.js', '/dist/viewer.js')
+
+# Every file in these folders is fingerprinted. img/ is not: Readymag gives
+# each upload a fresh random name, and the viewer builds the names of size
+# variants (_256, _w-180...) from the ones in ServerData at runtime, so those
+# files must keep their names. They never change under a name either, so
+# they are cached like fingerprinted files.
+ASSET_DIRS = ('/dist/fonts',)
+
+# The state files extract_server_data.py writes. They are already named by
+# hash, but change when the images they mention are renamed.
+STATE_FILES = ('/dist/pages/*.json', '/dist/server-data.*.js')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+# What may be cached forever: fingerprinted names, the bundler's hashed
+# chunks and the images, derivatives included, but not the derivative index
+# image_derivatives.py rewrites on every build.
+IMMUTABLE_PATHS = (r'\.[0-9a-f]{%d}\.[A-Za-z0-9]+$' % HASH_LENGTH, r'^/dist/c/c-[A-Z0-9]{8}\.js$',
+                   r'^/img/(?!responsive/index\.json$)')
+
+# Pages, and the precompressed copies of them servers may send instead.
+PAGE_FILES = r'\.html(\.br|\.gz)?$'
+
+
+def disk_path(root_dir, path):
+    return os.path.join(root_dir, path.lstrip('/'))
+
+
+def site_path(root_dir, filepath):
+    return '/' + os.path.relpath(filepath, root_dir).replace(os.sep, '/')
+
+
+def fingerprinted_name(path, content):
+    """
+    Returns the file name path should have for content: the name with any
+    earlier hash taken out and the hash of content put in.
+    """
+    name = posixpath.basename(path)
+    match = FINGERPRINTED.match(name)
+    stem, ext = (match.group('stem'), match.group('ext')) if match else posixpath.splitext(name)
+    return f"{stem}.{hash_bytes(content)[:HASH_LENGTH]}{ext}"
+
+
+def current_path(root_dir, path):
+    """
+    Finds the file a stable asset name refers to now: the plain name, or
+    the fingerprinted copy an earlier run left.
+    """
+    if os.path.exists(disk_path(root_dir, path)):
+        return path
+    stem, ext = posixpath.splitext(path)
+    for candidate in sorted(glob.glob(disk_path(root_dir, f"{stem}.*{ext}"))):
+        match = FINGERPRINTED.match(os.path.basename(candidate))
+        if match and match.group('stem') == posixpath.basename(stem):
+            return site_path(root_dir, candidate)
+    return None
+
+
+def find_binaries(root_dir):
+    paths = []
+    for folder in ASSET_DIRS:
+        for subdir, dirs, files in os.walk(disk_path(root_dir, folder)):
+            dirs.sort()
+            paths.extend(site_path(root_dir, os.path.join(subdir, f)) for f in sorted(files))
+    return paths
+
+
+def rewrite(data, spans, base_path, renames, resolver=resolve_ref):
+    """
+    Returns data with every reference in spans to a renamed file pointing at
+    its new name. spans yields (start, end, url, ...) tuples.
+    """
+    edits = []
+    for start, end, url, *rest in spans:
+        target = resolver(url, base_path)
+        if target in renames:
+            raw = data[start:end].decode('utf-8')
+            edits.append((start, end, rename_url(raw, posixpath.basename(renames[target])).encode('utf-8')))
+    if not edits:
+        return data
+    out = io.BytesIO()
+    html_stream.apply_edits(data, edits, out)
+    return out.getvalue()
+
+
+def rewrite_asset(data, path, renames, import_map):
+    """
+    Points the references inside one asset at renamed files: url() in CSS,
+    import specifiers in JavaScript and quoted paths in JSON and scripts.
+    Quoted paths in state files are relative to the site root, like the
+    page that holds them.
+    """
+    if path.endswith('.css'):
+        return rewrite(data, css_refs(data), path, renames)
+    if path.endswith('.js'):
+        data = rewrite(data, list(import_spans(data)), path, renames,
+                       resolver=lambda url, base: resolve(url, base, import_map))
+    return rewrite(data, embedded_refs(data), '/', renames)
+
+
+def fingerprint_file(root_dir, path, renames, import_map, dry_run=False):
+    """
+    Rewrites the references in one asset, then gives it the name of its new
+    content. Records the move in renames and returns True if there was one.
+    """
+    with open(disk_path(root_dir, path), 'rb') as f:
+        data = f.read()
+    new_data = rewrite_asset(data, path, renames, import_map) if not path.startswith(ASSET_DIRS) else data
+    new_path = posixpath.join(posixpath.dirname(path), fingerprinted_name(path, new_data))
+    if new_path == path and new_data == data:
+        return False
+    renames[path] = new_path
+    print(f"  - {path} -> {new_path}")
+    if dry_run:
+        return True
+    with open(disk_path(root_dir, new_path) + '.tmp', 'wb') as f:
+        f.write(new_data)
+    os.replace(disk_path(root_dir, new_path) + '.tmp', disk_path(root_dir, new_path))
+    html_stream.remove_sidecars(disk_path(root_dir, new_path))
+    if new_path != path:
+        os.remove(disk_path(root_dir, path))
+        html_stream.remove_sidecars(disk_path(root_dir, path))
+    return True
+
+
+def rewrite_page(root_dir, filepath, renames, import_map, dry_run=False):
+    print(f"\nProcessing: {filepath}")
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    path = site_path(root_dir, filepath)
+    new_data = rewrite(data, list(html_refs(data)), path, renames)
+    new_data = rewrite(new_data, list(embedded_refs(new_data)), path, renames)
+    # Inline module scripts import by specifier too.
+    spans = [(start + token.end, end + token.end, url)
+             for token in html_stream.iter_tags(new_data)
+             if isinstance(token, html_stream.StartTag) and token.name == 'script' and token.get('type') == 'module'
+             and token.content_end is not None and not token.has('src')
+             for start, end, url, dynamic in import_spans(token.content)]
+    new_data = rewrite(new_data, spans, path, renames, resolver=lambda url, base: resolve(url, base, import_map))
+    if new_data == data:
+        print(f"  - No changes were made to {os.path.basename(filepath)}.")
+    elif not dry_run:
+        html_stream.write_atomic(filepath, new_data)
+        print(f"  - Changes saved to {os.path.basename(filepath)}.")
+
+
+def nginx_cache_rules(text):
+    cases = ''.join(f'  "~{pattern}" "{IMMUTABLE}";\n' for pattern in IMMUTABLE_PATHS)
+    cache_map = (f"map $uri $rm_cache_control {{\n  default \"\";\n{cases}"
+                 f"  \"~{PAGE_FILES}\" \"{REVALIDATE}\";\n}}\n")
+    text = set_block(text, 'cache-control map', cache_map, insert_at=before_first(r'^server\s*\{'))
+    return set_block(text, 'cache-control', "  add_header Cache-Control $rm_cache_control;\n", indent='  ',
+                     insert_at=before_first(NGINX_SERVER_LEVEL))
+
+
+def htaccess_cache_rules(text):
+    pattern = '|'.join(IMMUTABLE_PATHS)
+    block = (f"<IfModule mod_headers.c>\n"
+             f"  <If \"%{{REQUEST_URI}} =~ m#{pattern}#\">\n    Header set Cache-Control \"{IMMUTABLE}\"\n  </If>\n"
+             f"  <FilesMatch \"{PAGE_FILES}\">\n    Header set Cache-Control \"{REVALIDATE}\"\n  </FilesMatch>\n"
+             f"</IfModule>\n")
+    return set_block(text, 'cache-control', block, insert_at=before_first(r'^RewriteEngine'))
+
+
+def web_config_cache_rules(text):
+    pattern = '|'.join(IMMUTABLE_PATHS)
+    pad = ' ' * 16
+    block = (f'{pad}<rule name="cache fingerprinted assets for a year">\n'
+             f'{pad}    <match serverVariable="RESPONSE_Cache_Control" pattern=".*"/>\n'
+             f'{pad}    <conditions>\n'
+             f'{pad}        <add input="{{URL}}" pattern="{pattern}" ignoreCase="false"/>\n'
+             f'{pad}    </conditions>\n'
+             f'{pad}    <action type="Rewrite" value="{IMMUTABLE}"/>\n'
+             f'{pad}</rule>\n'
+             f'{pad}<rule name="revalidate pages">\n'
+             f'{pad}    <match serverVariable="RESPONSE_Cache_Control" pattern=".*"/>\n'
+             f'{pad}    <conditions logicalGrouping="MatchAny">\n'
+             f'{pad}        <add input="{{RESPONSE_CONTENT_TYPE}}" pattern="^text/html"/>\n'
+             f'{pad}        <add input="{{URL}}" pattern="{PAGE_FILES}"/>\n'
+             f'{pad}    </conditions>\n'
+             f'{pad}    <action type="Rewrite" value="{REVALIDATE}"/>\n'
+             f'{pad}</rule>\n')
+    text = ensure_element(text, 'outboundRules', r'</rules>', ' ' * 12)
+    return set_block(text, 'cache-control', block, comment=('<!-- ', ' -->'), indent=pad,
+                     insert_at=after_first(r'<outboundRules>'))
+
+
+def write_cache_rules(root_dir):
+    for name, update in ((NGINX_CONFIG, nginx_cache_rules), (HTACCESS, htaccess_cache_rules),
+                         (WEB_CONFIG, web_config_cache_rules)):
+        if update_file(os.path.join(root_dir, name), update):
+            print(f"  - Cache-Control rules written to {name}.")
+        else:
+            print(f"  - {name} already has the Cache-Control rules or does not exist.")
+
+
+def fingerprint_assets(root_dir, dry_run=False):
+    """
+    Renames the site's assets after their content and points every
+    reference at the new names, then makes the server configs cache them
+    for good. Leaves first: images and fonts, then the state files and
+    stylesheets that mention them, then the scripts, then the pages.
+    """
+    index_path = os.path.join(root_dir, 'index.html')
+    import_map = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            import_map = load_import_map(f.read())
+
+    renames = {}
+    moved = 0
+    print("Fingerprinting assets:")
+    groups = [find_binaries(root_dir),
+              [site_path(root_dir, p) for pattern in STATE_FILES for p in sorted(glob.glob(disk_path(root_dir, pattern)))],
+              [current_path(root_dir, path) for path in ASSET_FILES]]
+    for group in groups:
+        for path in group:
+            if path is None:
+                continue
+            try:
+                moved += fingerprint_file(root_dir, path, renames, import_map, dry_run)
+            except Exception as e:
+                print(f"  - ERROR processing file {path}: {e}")
+
+    # Pages saved before an earlier run may still use the plain names.
+    for path in ASSET_FILES:
+        current = current_path(root_dir, path)
+        if current and current != path:
+            renames.setdefault(path, renames.get(current, current))
+
+    for filepath in find_html_files(root_dir):
+        try:
+            rewrite_page(root_dir, filepath, renames, import_map, dry_run)
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+
+    print(f"\n{moved} asset(s) renamed.")
+    if not dry_run:
+        write_cache_rules(root_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rename assets after their content and cache them for good.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--dry-run', action='store_true', help="List the renames without touching any file.")
+    args = parser.parse_args(argv)
+    fingerprint_assets(args.root, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
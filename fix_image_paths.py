@@ -1,5 +1,6 @@
 import os
 from bs4 import BeautifulSoup
+import html_stream
 
 def convert_to_relative_paths(root_dir):
     """
@@ -31,6 +32,7 @@ def convert_to_relative_paths(root_dir):
                         
                         with open(filepath, 'w', encoding='utf-8') as f:
                             f.write(new_content)
+                        html_stream.remove_sidecars(filepath)
                         
                         print(f"  - Converted image paths in {filename}")
                     else:
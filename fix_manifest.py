@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+
+import html_stream
+
+MANIFEST_NAME = '.fix_manifest.json'
+
+# Bump this whenever a rule changes what it writes, so every page is redone.
+RULES_VERSION = 3
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(filepath):
+    with open(filepath, 'rb') as f:
+        return hash_bytes(f.read())
+
+
+def rules_signature(rules, stream=False):
+    """
+    A short hash of the rule configuration: the rule names, the mode and
+    RULES_VERSION. Any change to it invalidates every page.
+    """
+    mode = 'stream' if stream else 'tree'
+    key = f"{RULES_VERSION}:{mode}:{','.join(r.name for r in rules)}"
+    return hash_bytes(key.encode('utf-8'))[:16]
+
+
+def head_template_hash(root_dir):
+    """
+    Hashes the bytes of the <head> element of index.html, found with the
+    streaming tokenizer so the page is not parsed. Returns '' when there is
+    no index.html or no head.
+    """
+    index_path = os.path.join(root_dir, 'index.html')
+    if not os.path.exists(index_path):
+        return ''
+    with open(index_path, 'rb') as f:
+        data = f.read()
+
+    start = None
+    for token in html_stream.iter_tags(data):
+        if start is None and isinstance(token, html_stream.StartTag) and token.name == 'head':
+            start = token.start
+        elif start is not None and isinstance(token, html_stream.EndTag) and token.name == 'head':
+            return hash_bytes(data[start:token.end])[:16]
+    return hash_bytes(data[start:])[:16] if start is not None else ''
+
+
+def manifest_key(root_dir, filepath):
+    return os.path.relpath(filepath, root_dir).replace(os.sep, '/')
+
+
+def load_manifest(root_dir):
+    """
+    Returns the page entries of the manifest in root_dir, or an empty dict if
+    there is none or it cannot be read.
+    """
+    manifest_path = os.path.join(root_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read {manifest_path} ({e}). Every page will be processed.")
+        return {}
+    if manifest.get('version') != RULES_VERSION:
+        return {}
+    return manifest.get('pages', {})
+
+
+def save_manifest(root_dir, pages):
+    manifest_path = os.path.join(root_dir, MANIFEST_NAME)
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': RULES_VERSION, 'pages': pages}, f, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def is_unchanged(entry, content_hash, rules_key, head_hash):
+    return (entry is not None and entry.get('hash') == content_hash
+            and entry.get('rules') == rules_key and entry.get('head') == head_hash)
@@ -0,0 +1,151 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+METRICS_NAME = '.fix_metrics.json'
+
+# Where a page's time goes, in the order the work happens. In streaming mode
+# the edits are written straight into the file, so "serialize" covers the
+# write and "write" only the manifest hash.
+PHASES = ('read', 'parse', 'rewrite', 'serialize', 'write')
+
+# How many functions and allocation sites a profile report lists.
+PROFILE_LINES = 25
+MEMORY_LINES = 10
+
+# Log levels for fix_site.
+QUIET, NORMAL, VERBOSE = 0, 1, 2
+
+
+@contextlib.contextmanager
+def timed(page, phase):
+    """
+    Adds the time spent in the block to page.phases[phase]. While memory is
+    being traced for the page, also keeps the snapshot taken at the end of
+    the phase that held the most memory.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        page.phases[phase] += time.perf_counter() - start
+        if page.memory is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            page.memory['phases'][phase] = max(page.memory['phases'].get(phase, 0), peak)
+            tracemalloc.reset_peak()
+            if current > page.memory['held']:
+                page.memory['held'] = current
+                page.memory['snapshot'] = (phase, tracemalloc.take_snapshot())
+
+
+@contextlib.contextmanager
+def profiled(page, modes):
+    """
+    Runs the block under cProfile ('cpu') and/or tracemalloc ('memory') and
+    leaves a text report in page.profile. With no modes it does nothing.
+    """
+    if not modes:
+        yield
+        return
+    profiler = cProfile.Profile() if 'cpu' in modes else None
+    if 'memory' in modes:
+        page.memory = {'phases': {}, 'held': 0, 'snapshot': None}
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        reports = []
+        if profiler:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).strip_dirs().sort_stats('cumulative').print_stats(PROFILE_LINES)
+            reports.append(f"CPU profile of {page.filename}, by cumulative time:\n{out.getvalue().strip()}")
+        if page.memory is not None:
+            tracemalloc.stop()
+            reports.append(memory_report(page))
+            # Snapshots do not pickle and are of no use once reported.
+            page.memory = None
+        page.profile = '\n\n'.join(reports)
+
+
+def memory_report(page):
+    lines = [f"Memory of {page.filename}, peak per phase:"]
+    for phase in PHASES:
+        if phase in page.memory['phases']:
+            lines.append(f"  {phase:10} {page.memory['phases'][phase] / 1024 / 1024:8.1f} MB")
+    if page.memory['snapshot']:
+        phase, snapshot = page.memory['snapshot']
+        lines.append(f"Largest allocation sites still held after {phase} "
+                     f"({page.memory['held'] / 1024 / 1024:.1f} MB in total):")
+        # Leave out what the tracing itself allocated.
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, filename)
+                                           for filename in (tracemalloc.__file__, contextlib.__file__, __file__)])
+        for stat in snapshot.statistics('lineno')[:MEMORY_LINES]:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size / 1024:10,.0f} KB in {stat.count:7,} block(s)  "
+                         f"{os.path.basename(frame.filename)}:{frame.lineno}")
+    return '\n'.join(lines)
+
+
+def page_summary(page, root_dir):
+    return {
+        'path': os.path.relpath(page.filepath, root_dir).replace(os.sep, '/'),
+        'elapsed_s': round(page.elapsed, 6),
+        'cpu_s': round(page.cpu_time, 6),
+        'phases_s': {phase: round(seconds, 6) for phase, seconds in page.phases.items()},
+        'rules': {name: {'time_s': round(page.rule_times.get(name, 0.0), 6),
+                         'changes': page.change_counts.get(name, 0)}
+                  for name in sorted(set(page.rule_times) | set(page.change_counts))},
+        'changes': sum(page.change_counts.values()),
+        'written': page.written,
+        'error': page.error,
+    }
+
+
+def summarize(pages, root_dir, rules, mode, jobs, wall_time, skipped, prefiltered=None, prefilter_time=0.0):
+    """
+    Returns the totals of a run per phase and per rule, with every page's
+    own numbers under 'files'. skipped counts the pages the manifest skipped
+    and prefiltered those the prefilter did, None when it was not used.
+    """
+    rule_totals = {entry.name: {'time_s': 0.0, 'changes': 0, 'pages_changed': 0} for entry in rules}
+    phase_totals = dict.fromkeys(PHASES, 0.0)
+    for page in pages:
+        for phase, seconds in page.phases.items():
+            phase_totals[phase] += seconds
+        for name, total in rule_totals.items():
+            total['time_s'] += page.rule_times.get(name, 0.0)
+            total['changes'] += page.change_counts.get(name, 0)
+            total['pages_changed'] += 1 if page.change_counts.get(name) else 0
+    for total in rule_totals.values():
+        total['time_s'] = round(total['time_s'], 6)
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'root': os.path.abspath(root_dir),
+        'mode': mode,
+        'jobs': jobs,
+        'wall_s': round(wall_time, 6),
+        'cpu_s': round(sum(page.cpu_time for page in pages), 6),
+        'prefilter_s': round(prefilter_time, 6),
+        'pages': {'processed': len(pages), 'skipped': skipped, 'prefiltered': prefiltered,
+                  'written': sum(1 for page in pages if page.written),
+                  'errors': sum(1 for page in pages if page.error is not None)},
+        'phases_s': {phase: round(seconds, 6) for phase, seconds in phase_totals.items()},
+        'rules': rule_totals,
+        'files': [page_summary(page, root_dir) for page in pages],
+    }
+
+
+def save_summary(path, summary):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=1)
+    os.replace(temp_path, path)
@@ -0,0 +1,1018 @@
+import argparse
+import copy
+import json
+import mmap
+import os
+import re
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, NavigableString
+import fix_metrics
+import html_stream
+from fix_metrics import NORMAL, PHASES, QUIET, VERBOSE, timed
+from fix_manifest import (hash_bytes, hash_file, head_template_hash, is_unchanged, load_manifest,
+                          manifest_key, rules_signature, save_manifest)
+
+# Folders that only hold assets. HTML found in here is never rewritten.
+SKIP_DIRS = {'.git', 'dist', 'img', 'videos', 'snippets'}
+
+# Top-level folders of the export whose relative links must become absolute.
+LOCAL_ASSET_DIRS = ('dist/', 'img/', 'videos/')
+
+# Anything that already has a scheme (http:, data:, mailto:...), is rooted or is an anchor.
+NOT_RELATIVE = re.compile(r'^(/|#|[a-zA-Z][a-zA-Z0-9+.-]*:)')
+
+# Prefilter triggers of absolute-paths: a src that is not rooted, an anchor or
+# a URL with a scheme, and an href into one of LOCAL_ASSET_DIRS.
+RELATIVE_SRC = re.compile(rb'''src\s*=\s*'''
+                          rb'''(?:["'](?![/#]|[a-z][a-z0-9+.-]*:)|(?![/#"'>]|[a-z][a-z0-9+.-]*:))''')
+RELATIVE_ASSET_HREF = re.compile(rb'''href\s*=\s*["']?(?:dist|img|videos)/''')
+
+
+def attribute_triggers(names, needle):
+    """
+    Prefilter triggers for needle inside the value of one of the named
+    attributes, so the same text in inline state or scripts does not count.
+    There is one regex per name: each then starts with a literal, which re
+    can skip ahead to quickly.
+    """
+    needle = re.escape(needle)
+    value = rb'''(?:"[^"]*''' + needle + rb'''|'[^']*''' + needle + rb'''|[^\s"'>]*''' + needle + rb')'
+    return tuple(re.compile(name + rb'\s*=\s*' + value) for name in names)
+
+
+# The shared ServerData file and the page's own state, as written by extract_server_data.py.
+SHARED_STATE_SRC = re.compile(r'^/dist/server-data\.[0-9a-f]+\.js$')
+PAGE_STATE_ID = 'server-data-page'
+
+# The <style> critical_css.py inlines into each page's <head>.
+CRITICAL_CSS_ID = 'critical-css'
+
+# What analytics-bootstrap merges: gtag.js loaders, the inline scripts that
+# set up and configure gtag(), and the GTM container snippet.
+ANALYTICS_ID = 'analytics-bootstrap'
+ANALYTICS_OPTS = re.compile(r'"(ga_id|gtm_id)"\s*:\s*"([^"]+)"')
+GTAG_SRC = re.compile(r'^(?:https?:)?//www\.googletagmanager\.com/gtag/js\?id=([\w-]+)')
+GTAG_PREAMBLE = ("window.dataLayer = window.dataLayer || [];", "function gtag(){dataLayer.push(arguments);}")
+GTAG_PREAMBLE_CODE = re.compile(r'window\.dataLayer\s*=\s*window\.dataLayer\s*\|\|\s*\[\s*\]\s*;?'
+                                r'|function\s+gtag\s*\(\s*\)\s*\{\s*dataLayer\.push\(\s*arguments\s*\)\s*;?\s*\}')
+GTAG_CALL = re.compile(r'\bgtag\((?:[^()]|\([^()]*\))*\)')
+GTAG_CONFIG_ID = re.compile(r"gtag\(\s*'config'\s*,\s*'([^']+)'")
+GTM_SNIPPET = re.compile(r"\(function\(w,d,s,l,i\)\{.*?\}\)\(window,document,'script','dataLayer','(GTM-\w+)'\)",
+                         re.S)
+ANALYTICS_LOADER_CODE = (
+    "(function(w,d,ids){"
+    "function add(src){var s=d.createElement('script');s.async=true;s.src=src;d.head.appendChild(s);}"
+    "function load(){"
+    "if(ids.gtag)add('https://www.googletagmanager.com/gtag/js?id='+encodeURIComponent(ids.gtag));"
+    "ids.gtm.forEach(function(id){w.dataLayer.push({'gtm.start':new Date().getTime(),event:'gtm.js'});"
+    "add('https://www.googletagmanager.com/gtm.js?id='+encodeURIComponent(id));});}"
+    "function idle(){if(w.requestIdleCallback)w.requestIdleCallback(load,{timeout:2000});else setTimeout(load,200);}"
+    "if(d.readyState==='complete')idle();else w.addEventListener('load',idle);"
+    "})(window,document,")
+ANALYTICS_LOADER = re.compile(re.escape(ANALYTICS_LOADER_CODE) + r'(\{.*?\})\);')
+
+Rule = namedtuple('Rule', ['name', 'func', 'description', 'default', 'stream', 'triggers'])
+
+# Every rewrite rule, in the order they run over a page.
+RULES = {}
+
+# Filled in once per worker process by init_worker, so the head template is
+# shipped to each worker a single time instead of being pickled with every page.
+_worker_state = {}
+
+
+def rule(name, description, default=True, triggers=None):
+    """
+    Registers a rewrite rule. A rule is a function taking the parsed page and
+    its PageContext; it edits the tree in place and reports each change with
+    page.log().
+
+    triggers are lowercase byte strings or compiled bytes regexes, at least
+    one of which matches the raw file, lowercased, whenever the rule would
+    change a page. Pages matching none of the triggers of the rules being
+    run are never parsed. A rule without triggers can apply anywhere.
+    """
+    def register(func):
+        RULES[name] = Rule(name, func, description, default, None, triggers)
+        return func
+    return register
+
+
+def stream_rule(name):
+    """
+    Registers the streaming version of an existing rule. It is called with
+    each html_stream.StartTag instead of a parsed tree, so it can only edit
+    attributes or drop whole void/raw-text elements.
+    """
+    def register(func):
+        RULES[name] = RULES[name]._replace(stream=func)
+        return func
+    return register
+
+
+class PageContext:
+    """
+    What a rule knows about the page it is working on, plus what the rules
+    have done to it so far: a count of changes per rule, and the messages
+    themselves when keep_messages is set.
+    """
+
+    def __init__(self, filepath, root_dir, head_template=None, keep_messages=True):
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.root_dir = root_dir
+        self.head_template = head_template
+        self.keep_messages = keep_messages
+        self.current_rule = None
+        self.changes = []
+        self.change_counts = Counter()
+        self.rule_times = {}
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.changed = False
+        self.written = False
+        self.error = None
+        self.elapsed = 0.0
+        self.cpu_time = 0.0
+        self.output_hash = None
+        self.memory = None
+        self.profile = None
+        self.diff = None
+
+    @property
+    def is_template(self):
+        return os.path.abspath(self.filepath) == os.path.abspath(os.path.join(self.root_dir, 'index.html'))
+
+    @property
+    def change_count(self):
+        return sum(self.change_counts.values())
+
+    def log(self, message):
+        self.change_counts[self.current_rule] += 1
+        if self.keep_messages:
+            self.changes.append((self.current_rule, message))
+
+    def add_rule_time(self, name, seconds):
+        self.rule_times[name] = self.rule_times.get(name, 0.0) + seconds
+
+
+def is_relative_asset(path):
+    return bool(path) and not NOT_RELATIVE.match(path) and path.startswith(LOCAL_ASSET_DIRS)
+
+
+@rule('wrap-fragment', "Wrap pages saved without <html> in <html>, <head> and <body> tags.")
+def wrap_fragment(soup, page):
+    if soup.find('html'):
+        return
+    html = soup.new_tag('html')
+    body = soup.new_tag('body')
+    for node in list(soup.contents):
+        body.append(node.extract())
+    html.append(soup.new_tag('head'))
+    html.append(body)
+    soup.append(html)
+    page.log("Wrapped incomplete HTML in <html> and <body> tags.")
+
+
+def is_font_preload(tag):
+    return tag.name == 'link' and tag.get('as') == 'font' and 'preload' in tag.get('rel', [])
+
+
+def is_style_tag(tag):
+    return tag.name == 'style' or (tag.name == 'link' and (
+        'stylesheet' in tag.get('rel', []) or tag.get('as') == 'style'))
+
+
+@rule('head-sync', "Copy the <head> of index.html into every page, keeping the page's own <title>.")
+def sync_head(soup, page):
+    if page.head_template is None or page.is_template or not soup.html:
+        return
+
+    # Earlier scripts inserted the page title on top of the template's titles
+    # every run, so pages collect empty <title> tags. Keep exactly one.
+    old_titles = soup.head.find_all('title') if soup.head else []
+    page_title = next((t for t in old_titles if t.get_text(strip=True)), None)
+    new_head = copy.copy(page.head_template)
+    template_titles = new_head.find_all('title')
+    if page_title is None:
+        page_title = next((t for t in template_titles if t.get_text(strip=True)), None)
+    if page_title is None and template_titles:
+        page_title = template_titles[0]
+    if page_title is not None:
+        page_title = copy.copy(page_title)
+    for title in template_titles:
+        title.decompose()
+    if page_title is not None:
+        new_head.insert(0, page_title)
+
+    # The state extract_server_data.py left inline belongs to the page, not to index.html.
+    page_state = soup.head.find('script', id=PAGE_STATE_ID) if soup.head else None
+    for script in new_head.find_all('script', id=PAGE_STATE_ID):
+        script.decompose()
+    if page_state is not None:
+        loader = new_head.find('script', src=SHARED_STATE_SRC)
+        if loader is not None:
+            loader.insert_after(copy.copy(page_state))
+
+    # So is its critical CSS; pages without their own keep the template's.
+    page_css = soup.head.find('style', id=CRITICAL_CSS_ID) if soup.head else None
+    template_css = new_head.find('style', id=CRITICAL_CSS_ID)
+    if page_css is not None and template_css is not None:
+        template_css.replace_with(copy.copy(page_css))
+
+    # font_subset.py preloads the fonts each page renders, before its styles.
+    for link in new_head.find_all(is_font_preload):
+        link.decompose()
+    page_fonts = soup.head.find_all(is_font_preload) if soup.head else []
+    if page_fonts:
+        anchor = new_head.find(is_style_tag)
+        for link in page_fonts:
+            if anchor is not None:
+                anchor.insert_before(copy.copy(link))
+            else:
+                new_head.append(copy.copy(link))
+
+    if soup.head is None:
+        soup.html.insert(0, new_head)
+        page.log("Added missing <head> section.")
+    elif str(soup.head) != str(new_head):
+        soup.head.replace_with(new_head)
+        page.log("Replaced existing <head> section.")
+
+
+@rule('strip-rmcdn', "Remove scripts, links and og:image tags that still point at Readymag's CDN.",
+      triggers=attribute_triggers([b'src', b'href', b'content'], b'rmcdn'))
+def strip_rmcdn(soup, page):
+    for script in soup.find_all('script', src=True):
+        if 'rmcdn' in script['src']:
+            script.decompose()
+            page.log("Removed a problematic Readymag script link.")
+
+    for link_tag in soup.find_all('link', href=True):
+        if 'rmcdn' in link_tag['href']:
+            link_tag.decompose()
+            page.log("Removed a problematic Readymag link.")
+
+    for meta_tag in soup.find_all('meta', property='og:image'):
+        if meta_tag.get('content') and 'rmcdn' in meta_tag['content']:
+            meta_tag.decompose()
+            page.log("Removed a problematic Open Graph meta tag.")
+
+
+@stream_rule('strip-rmcdn')
+def stream_strip_rmcdn(tag, page):
+    if tag.name == 'script' and 'rmcdn' in tag.get('src', ''):
+        tag.remove()
+        page.log("Removed a problematic Readymag script link.")
+    elif tag.name == 'link' and 'rmcdn' in tag.get('href', ''):
+        tag.remove()
+        page.log("Removed a problematic Readymag link.")
+    elif tag.name == 'meta' and tag.get('property') == 'og:image' and 'rmcdn' in tag.get('content', ''):
+        tag.remove()
+        page.log("Removed a problematic Open Graph meta tag.")
+
+
+@rule('strip-screenshoter', "Remove Readymag's screenshoter.js script.",
+      triggers=attribute_triggers([b'src'], b'screenshoter.js'))
+def strip_screenshoter(soup, page):
+    for script in soup.find_all('script', src=lambda src: src and 'screenshoter.js' in src):
+        script.decompose()
+        page.log("Removed screenshoter.js script.")
+
+
+@stream_rule('strip-screenshoter')
+def stream_strip_screenshoter(tag, page):
+    if tag.name == 'script' and 'screenshoter.js' in tag.get('src', ''):
+        tag.remove()
+        page.log("Removed screenshoter.js script.")
+
+
+@rule('strip-typekit', "Remove the broken Typekit stylesheet and loader.",
+      triggers=attribute_triggers([b'href', b'src'], b'typekit'))
+def strip_typekit(soup, page):
+    for link_tag in soup.find_all('link', href=lambda href: href and 'typekit' in href):
+        link_tag.decompose()
+        page.log("Removed broken Typekit link.")
+    for script in soup.find_all('script', src=lambda src: src and 'typekit' in src):
+        script.decompose()
+        page.log("Removed broken Typekit script.")
+
+
+@stream_rule('strip-typekit')
+def stream_strip_typekit(tag, page):
+    if tag.name == 'link' and 'typekit' in tag.get('href', ''):
+        tag.remove()
+        page.log("Removed broken Typekit link.")
+    elif tag.name == 'script' and 'typekit' in tag.get('src', ''):
+        tag.remove()
+        page.log("Removed broken Typekit script.")
+
+
+@rule('absolute-paths', "Make relative image, script and stylesheet paths absolute from the site root.",
+      triggers=(RELATIVE_SRC, RELATIVE_ASSET_HREF))
+def absolutize_paths(soup, page):
+    for tag in soup.find_all(['img', 'script', 'link']):
+        if tag.name == 'img' and tag.get('src'):
+            # Images are always local to the export, whatever folder they sit in.
+            if not NOT_RELATIVE.match(tag['src']):
+                tag['src'] = '/' + tag['src']
+                page.log(f"Converted relative image path to absolute: {tag['src']}")
+        elif tag.name == 'script' and is_relative_asset(tag.get('src')):
+            tag['src'] = '/' + tag['src']
+            page.log(f"Converted relative script path to absolute: {tag['src']}")
+        elif tag.name == 'link' and is_relative_asset(tag.get('href')):
+            tag['href'] = '/' + tag['href']
+            page.log(f"Converted relative link path to absolute: {tag['href']}")
+
+
+@stream_rule('absolute-paths')
+def stream_absolutize_paths(tag, page):
+    if tag.name == 'img' and tag.get('src') and not NOT_RELATIVE.match(tag.get('src')):
+        tag.set('src', '/' + tag.get('src'))
+        page.log(f"Converted relative image path to absolute: /{tag.get('src')}")
+    elif tag.name == 'script' and is_relative_asset(tag.get('src')):
+        tag.set('src', '/' + tag.get('src'))
+        page.log(f"Converted relative script path to absolute: /{tag.get('src')}")
+    elif tag.name == 'link' and is_relative_asset(tag.get('href')):
+        tag.set('href', '/' + tag.get('href'))
+        page.log(f"Converted relative link path to absolute: /{tag.get('href')}")
+
+
+def is_local_srcset(srcset):
+    """
+    True when every candidate in srcset is a file on this site, like the
+    ones image_derivatives.py writes.
+    """
+    urls = [candidate.split()[0] for candidate in srcset.split(',') if candidate.strip()]
+    return bool(urls) and all(url.startswith('/') and not url.startswith('//') for url in urls)
+
+
+@rule('strip-srcset', "Remove srcset attributes from <img> tags unless they only list local files.",
+      triggers=(b'srcset',))
+def strip_srcset(soup, page):
+    for img_tag in soup.find_all('img', srcset=True):
+        if not is_local_srcset(img_tag['srcset']):
+            del img_tag['srcset']
+            page.log("Removed srcset from an <img> tag.")
+
+
+@stream_rule('strip-srcset')
+def stream_strip_srcset(tag, page):
+    if tag.name == 'img' and tag.has('srcset') and not is_local_srcset(tag.get('srcset')):
+        tag.remove_attr('srcset')
+        page.log("Removed srcset from an <img> tag.")
+
+
+@rule('iframe-fixups', "Point iframes that load from Readymag's CDN at a placeholder.",
+      triggers=attribute_triggers([b'src'], b'rmcdn'))
+def fix_iframes(soup, page):
+    for iframe_tag in soup.find_all('iframe', src=True):
+        if 'rmcdn' in iframe_tag['src']:
+            iframe_tag['src'] = '#'
+            page.log("Replaced broken iframe source.")
+
+
+@stream_rule('iframe-fixups')
+def stream_fix_iframes(tag, page):
+    if tag.name == 'iframe' and 'rmcdn' in tag.get('src', ''):
+        tag.set('src', '#')
+        page.log("Replaced broken iframe source.")
+
+
+def analytics_ids(soup, page):
+    """
+    Returns the GA and GTM ids set in the ServerData opts of the page, inline
+    or in the shared state file extract_server_data.py writes.
+    """
+    texts = [script.string or '' for script in soup.find_all('script', src=False)]
+    for script in soup.find_all('script', src=SHARED_STATE_SRC):
+        path = os.path.join(page.root_dir, script['src'].lstrip('/'))
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                texts.append(f.read())
+    ids = {'ga_id': [], 'gtm_id': []}
+    for text in texts:
+        for key, value in ANALYTICS_OPTS.findall(text):
+            if value not in ids[key]:
+                ids[key].append(value)
+    return ids['ga_id'], ids['gtm_id']
+
+
+def parse_analytics_script(code):
+    """
+    Splits an inline script into its gtag() calls and GTM ids. Returns None
+    when it does anything else, so scripts that only look similar are kept.
+    """
+    rest = GTAG_PREAMBLE_CODE.sub('', code)
+    gtm_ids = []
+    bootstrap = ANALYTICS_LOADER.search(rest)
+    if bootstrap:
+        gtm_ids += json.loads(bootstrap.group(1))['gtm']
+        rest = rest[:bootstrap.start()] + rest[bootstrap.end():]
+    gtm_ids += GTM_SNIPPET.findall(rest)
+    rest = GTM_SNIPPET.sub('', rest)
+    calls = [' '.join(call.split()) for call in GTAG_CALL.findall(rest)]
+    if re.sub(r'[\s;]', '', GTAG_CALL.sub('', rest)):
+        return None
+    return calls, gtm_ids
+
+
+def collapse_configs(calls):
+    """
+    Keeps one gtag('config') call per id, where the first one for the id
+    was. A plain call after one with parameters would otherwise configure
+    the id again with the defaults, page_view included, so the call that
+    sets parameters wins.
+    """
+    chosen = {}
+    for call in calls:
+        match = GTAG_CONFIG_ID.match(call)
+        if match and (match.group(1) not in chosen or ('{' in call and '{' not in chosen[match.group(1)])):
+            chosen[match.group(1)] = call
+    collapsed = []
+    for call in calls:
+        match = GTAG_CONFIG_ID.match(call)
+        if not match:
+            collapsed.append(call)
+        elif chosen.get(match.group(1)):
+            collapsed.append(chosen.pop(match.group(1)))
+    return collapsed
+
+
+def analytics_bootstrap(calls, gtag_id, gtm_ids):
+    """
+    One inline script in place of every loader: the gtag() queue is set up
+    and configured right away, and gtag.js and gtm.js are only fetched once
+    the page has loaded and the browser is idle.
+    """
+    lines = list(GTAG_PREAMBLE) + ["gtag('js', new Date());"] + [call + ';' for call in calls]
+    loader = ANALYTICS_LOADER_CODE + json.dumps({'gtag': gtag_id, 'gtm': gtm_ids}) + ');'
+    return '\n' + '\n'.join(lines + [loader]) + '\n'
+
+
+@rule('analytics-bootstrap', "Merge duplicate gtag.js and GTM loaders into one bootstrap that loads after first paint.",
+      triggers=attribute_triggers([b'src'], b'googletagmanager.com/gtag/js') + (b"window,document,'script','datalayer'",))
+def merge_analytics(soup, page):
+    loaders = []
+    calls, gtm_ids, gtag_ids = [], [], []
+    for script in soup.find_all('script'):
+        src = script.get('src', '')
+        if script.get('type', 'text/javascript') != 'text/javascript':
+            continue
+        if src:
+            match = GTAG_SRC.match(src)
+            if match:
+                loaders.append(script)
+                gtag_ids.append(match.group(1))
+            continue
+        code = script.string or ''
+        if script.get('id') != ANALYTICS_ID and 'gtag(' not in code and 'gtm.js' not in code:
+            continue
+        parsed = parse_analytics_script(code)
+        if parsed is None:
+            continue
+        loaders.append(script)
+        for call in parsed[0]:
+            if call not in calls and not call.startswith("gtag('js'"):
+                calls.append(call)
+        gtm_ids += [gtm_id for gtm_id in parsed[1] if gtm_id not in gtm_ids]
+    if not loaders:
+        return
+
+    ga_ids, opts_gtm_ids = analytics_ids(soup, page)
+    configured = ' '.join(calls)
+    for ga_id in ga_ids:
+        if f"'{ga_id}'" not in configured:
+            calls.append(f"gtag('config', '{ga_id}')")
+    gtm_ids += [gtm_id for gtm_id in opts_gtm_ids if gtm_id not in gtm_ids]
+    calls = collapse_configs(calls)
+    config_ids = GTAG_CONFIG_ID.findall(configured)
+    gtag_id = next(iter(config_ids + ga_ids + gtag_ids), None) if calls else None
+
+    code = analytics_bootstrap(calls, gtag_id, gtm_ids)
+    first = loaders[0]
+    if len(loaders) == 1 and first.get('id') == ANALYTICS_ID and first.string == code:
+        return
+    bootstrap = soup.new_tag('script', id=ANALYTICS_ID)
+    bootstrap.string = code
+    first.replace_with(bootstrap)
+    for script in loaders[1:]:
+        # The line break that set the script apart goes with it, or the next
+        # run finds the blank line it leaves and rewrites the page again.
+        for sibling in (script.previous_sibling, script.next_sibling):
+            if type(sibling) is NavigableString and not sibling.strip():
+                sibling.extract()
+                break
+        script.decompose()
+    page.log(f"Merged {len(loaders)} analytics script(s) into one deferred bootstrap "
+             f"({len(calls)} gtag call(s), {len(gtm_ids)} GTM container(s)).")
+
+
+def select_rules(names=None, skip=None, stream=False):
+    """
+    Returns the rules to run, in registry order. With no names, every rule
+    enabled by default is used (in streaming mode, every default rule that
+    has a streaming version). Unknown names, or naming a rule that cannot
+    stream in streaming mode, raise a ValueError.
+    """
+    unknown = [name for name in (names or []) + (skip or []) if name not in RULES]
+    if unknown:
+        raise ValueError(f"Unknown rule(s): {', '.join(unknown)}")
+    if stream and names:
+        no_stream = [name for name in names if RULES[name].stream is None]
+        if no_stream:
+            raise ValueError(f"Rule(s) without a streaming version: {', '.join(no_stream)}")
+
+    selected = []
+    for name, entry in RULES.items():
+        wanted = name in names if names else entry.default and (entry.stream is not None or not stream)
+        if wanted and name not in (skip or []):
+            selected.append(entry)
+    return selected
+
+
+def find_html_files(root_dir):
+    """
+    Returns every page under root_dir in a stable order, skipping asset folders.
+    """
+    html_files = []
+    for subdir, dirs, files in os.walk(root_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for filename in sorted(files):
+            if filename.endswith('.html'):
+                html_files.append(os.path.join(subdir, filename))
+    return html_files
+
+
+def load_head_template(root_dir):
+    """
+    Parses index.html once and returns its <head>, or None if it is missing.
+    """
+    index_path = os.path.join(root_dir, 'index.html')
+    if not os.path.exists(index_path):
+        print("Error: index.html not found in the root directory. The head-sync rule will be skipped.")
+        return None
+
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return BeautifulSoup(f.read(), 'html.parser').head
+    except Exception as e:
+        print(f"Error reading index.html: {e}. The head-sync rule will be skipped.")
+        return None
+
+
+def rewrite_html(content, page, rules):
+    """
+    Parses the page once, runs every rule over the same tree and serializes
+    once. Returns the new HTML.
+    """
+    with timed(page, 'parse'):
+        soup = BeautifulSoup(content, 'html.parser')
+    with timed(page, 'rewrite'):
+        for entry in rules:
+            page.current_rule = entry.name
+            start = time.perf_counter()
+            entry.func(soup, page)
+            page.add_rule_time(entry.name, time.perf_counter() - start)
+        page.current_rule = None
+    with timed(page, 'serialize'):
+        return str(soup)
+
+
+def rewrite_stream(data, page, rules):
+    """
+    Runs the streaming versions of the rules over the raw bytes of a page
+    without building a tree. Returns the list of byte-range edits.
+    """
+    def bind(entry):
+        def handler(tag):
+            page.current_rule = entry.name
+            start = time.perf_counter()
+            entry.stream(tag, page)
+            page.add_rule_time(entry.name, time.perf_counter() - start)
+        return handler
+
+    # Tokenizing and running the rules is one pass, so the time spent in the
+    # rules is moved from "parse" to "rewrite" afterwards.
+    with timed(page, 'parse'):
+        edits = html_stream.rewrite(data, [bind(entry) for entry in rules])
+    rule_time = sum(page.rule_times.values())
+    page.phases['parse'] -= rule_time
+    page.phases['rewrite'] += rule_time
+    page.current_rule = None
+    return edits
+
+
+def rewrite_page(page, rules, dry_run, stream, diff=False):
+    with timed(page, 'read'):
+        with open(page.filepath, 'rb') as f:
+            data = f.read()
+
+    if stream:
+        # Everything outside the edited byte ranges is copied as-is.
+        edits = rewrite_stream(data, page, rules)
+        changed = bool(edits)
+        if diff and changed:
+            page.diff = html_stream.format_edits(data, edits)
+        if changed and not dry_run:
+            with timed(page, 'serialize'):
+                html_stream.write_atomic(page.filepath, edits=edits, source=data)
+    else:
+        with timed(page, 'read'):
+            content = data.decode('utf-8')
+        new_content = rewrite_html(content, page, rules)
+        with timed(page, 'serialize'):
+            new_data = new_content.encode('utf-8')
+        changed = new_data != data
+        if diff and changed:
+            # The tree keeps no source offsets, so the spans are recovered
+            # by comparing the two versions.
+            page.diff = html_stream.format_edits(data, html_stream.line_edits(data, new_data))
+        if changed and not dry_run:
+            with timed(page, 'write'):
+                html_stream.write_atomic(page.filepath, new_data)
+    page.changed = changed
+    page.written = changed and not dry_run
+
+    with timed(page, 'write'):
+        page.output_hash = hash_file(page.filepath) if page.written else hash_bytes(data)
+
+
+def process_page(filepath, root_dir, rules, head_template=None, dry_run=False, stream=False,
+                 keep_messages=True, profile=None, diff=False):
+    """
+    Rewrites one page and returns its PageContext. The file is only written
+    when the output actually differs from what is on disk, and is replaced
+    atomically. profile names the fix_metrics.profiled modes ('cpu',
+    'memory') to run the page under. With diff=True, page.diff lists the
+    byte spans that change.
+    """
+    page = PageContext(filepath, root_dir, head_template, keep_messages)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        with fix_metrics.profiled(page, profile):
+            rewrite_page(page, rules, dry_run, stream, diff)
+    except Exception as e:
+        page.error = str(e) or type(e).__name__
+    page.elapsed = time.perf_counter() - start
+    page.cpu_time = time.process_time() - cpu_start
+    return page
+
+
+def profile_modes(filepath, profile):
+    """
+    Returns the profiling modes for filepath out of profile, a dict from
+    page path to modes.
+    """
+    return profile.get(os.path.abspath(filepath)) if profile else None
+
+
+def init_worker(root_dir, rule_names, head_html, dry_run, stream, keep_messages, profile, diff):
+    """
+    Runs once in each worker process: resolves the rules and parses the head
+    template so tasks only need to carry a file path.
+    """
+    _worker_state['root_dir'] = root_dir
+    _worker_state['rules'] = select_rules(rule_names, stream=stream)
+    _worker_state['head_template'] = BeautifulSoup(head_html, 'html.parser').head if head_html else None
+    _worker_state['dry_run'] = dry_run
+    _worker_state['stream'] = stream
+    _worker_state['keep_messages'] = keep_messages
+    _worker_state['profile'] = profile
+    _worker_state['diff'] = diff
+
+
+def process_page_in_worker(filepath):
+    state = _worker_state
+    page = process_page(filepath, state['root_dir'], state['rules'], state['head_template'],
+                        state['dry_run'], state['stream'], state['keep_messages'],
+                        profile_modes(filepath, state['profile']), state['diff'])
+    # The parsed template stays in the worker; only the results travel back.
+    page.head_template = None
+    return page
+
+
+def format_counts(page):
+    return ', '.join(f"{name} {count}" for name, count in page.change_counts.items())
+
+
+def report_page(page, verbosity=VERBOSE):
+    """
+    Prints what happened to a page. QUIET only reports errors, NORMAL one
+    line per page with the number of changes per rule, VERBOSE every change.
+    """
+    if verbosity > QUIET or page.error is not None:
+        print(f"\nProcessing: {page.filepath}")
+        for rule_name, message in page.changes:
+            print(f"  - [{rule_name}] {message}")
+        if page.error is not None:
+            print(f"  - ERROR processing file {page.filepath}: {page.error}")
+        elif page.changed:
+            if not page.change_count:
+                counts = " (the parser's formatting only)"
+            else:
+                counts = f" ({page.change_count} change(s): {format_counts(page)})" if not page.changes else ''
+            saved = "Changes saved to" if page.written else "Dry run, changes not saved to"
+            print(f"  - {saved} {page.filename}{counts}.")
+        elif page.change_count:
+            print(f"  - Output is identical to {page.filename}, nothing written.")
+        else:
+            print(f"  - No changes were made to {page.filename}.")
+    if page.diff:
+        print(page.diff)
+    if page.profile:
+        print(page.profile)
+
+
+def report_metrics(summary, verbosity):
+    """
+    Prints the time per phase and, when verbose, per rule.
+    """
+    total = sum(summary['phases_s'].values()) or 1
+    print("Time per phase: " + ', '.join(f"{phase} {seconds:.2f}s ({seconds / total:.0%})"
+                                          for phase, seconds in summary['phases_s'].items()))
+    if verbosity >= VERBOSE:
+        print("Time per rule:")
+        for name, stats in sorted(summary['rules'].items(), key=lambda item: -item[1]['time_s']):
+            print(f"  - {name:20} {stats['time_s']:8.3f}s  {stats['changes']:6} change(s) "
+                  f"in {stats['pages_changed']} page(s)")
+
+
+def write_redirects(root_dir):
+    """
+    Writes the _redirects file from the route table of the site's pages.
+    routes.py builds the table with this module's find_html_files, so it
+    is imported here rather than at the top.
+    """
+    from routes import build_route_table, write_redirects as write_route_redirects
+    table = build_route_table(root_dir)
+    if table is None:
+        print("\nError creating _redirects file: no ServerData found.")
+        return
+    print("\nWriting the _redirects file:")
+    write_route_redirects(root_dir, table)
+
+
+def iter_pages(root_dir, rules, html_files, head_template, dry_run=False, jobs=1, stream=False,
+               keep_messages=True, profile=None, diff=False):
+    """
+    Yields a PageContext per file, in the order of html_files. With jobs > 1
+    the pages are rewritten in a process pool; results still come back in
+    file order so reports and errors are deterministic.
+    """
+    if jobs <= 1 or len(html_files) <= 1:
+        for filepath in html_files:
+            yield process_page(filepath, root_dir, rules, head_template, dry_run, stream, keep_messages,
+                               profile_modes(filepath, profile), diff)
+        return
+
+    head_html = str(head_template) if head_template is not None else None
+    init_args = (root_dir, [r.name for r in rules], head_html, dry_run, stream, keep_messages, profile, diff)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=init_args) as executor:
+        yield from executor.map(process_page_in_worker, html_files)
+
+
+def compile_triggers(rules):
+    """
+    Returns the prefilter for rules as (literals, patterns): the plain byte
+    strings and the regexes to look for, each once. Returns None when a rule
+    has no triggers, as every page must then be parsed.
+    """
+    literals, patterns = set(), set()
+    for entry in rules:
+        if entry.triggers is None:
+            return None
+        for trigger in entry.triggers:
+            (literals if isinstance(trigger, bytes) else patterns).add(trigger)
+    # Regexes are searched one by one: joined in one alternation they would
+    # lose the literal prefix that lets re skip through the page.
+    return literals, patterns
+
+
+def matches_triggers(data, triggers):
+    literals, patterns = triggers
+    return any(data.find(literal) != -1 for literal in literals) or \
+        any(pattern.search(data) is not None for pattern in patterns)
+
+
+def has_trigger(filepath, triggers):
+    """
+    True when the bytes of filepath match one of the triggers. The file is
+    mapped rather than read, so a page that has a trigger as written is
+    usually settled after reading part of it. Only pages without one are
+    lowercased and searched again, since tag and attribute names can be in
+    any case.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return matches_triggers(data, triggers) or matches_triggers(data[:].lower(), triggers)
+
+
+def split_untriggered(html_files, triggers, always=()):
+    """
+    Splits html_files into (candidates, untriggered) with the prefilter.
+    Pages in always are kept as candidates whatever they contain.
+    """
+    if triggers is None:
+        return list(html_files), []
+    candidates, untriggered = [], []
+    for filepath in html_files:
+        if os.path.abspath(filepath) in always or has_trigger(filepath, triggers):
+            candidates.append(filepath)
+        else:
+            untriggered.append(filepath)
+    return candidates, untriggered
+
+
+def split_unchanged(root_dir, html_files, manifest, rules_key, head_hash):
+    """
+    Splits html_files into (to_process, unchanged) using the manifest. A page
+    is unchanged when its bytes hash to what the last run left on disk and
+    that run used the same rules and the same index.html head.
+    """
+    to_process, unchanged = [], []
+    for filepath in html_files:
+        entry = manifest.get(manifest_key(root_dir, filepath))
+        if entry is not None and is_unchanged(entry, hash_file(filepath), rules_key, head_hash):
+            unchanged.append(filepath)
+        else:
+            to_process.append(filepath)
+    return to_process, unchanged
+
+
+def fix_site(root_dir, rules, dry_run=False, redirects=False, jobs=1, stream=False, incremental=True,
+             verbosity=NORMAL, metrics=True, profile=None, diff=False, prefilter=True):
+    """
+    Runs the given rules over every page under root_dir, parsing and writing
+    each file at most once. With stream=True the pages are rewritten with
+    html_stream instead of BeautifulSoup. With incremental=True pages the
+    manifest marks as unchanged are skipped without being parsed. With
+    prefilter=True so are pages containing none of the rules' triggers.
+
+    verbosity is QUIET, NORMAL or VERBOSE; only VERBOSE keeps and prints
+    every change. metrics is where to save the JSON summary of the run:
+    True for .fix_metrics.json in root_dir (not on dry runs), or a path.
+    profile maps page paths to the profiling modes to run them under; those
+    pages are processed even when unchanged. diff=True prints the byte
+    spans each page changes, which with dry_run previews a run.
+    Returns the list of PageContexts for the pages that were processed.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    mode = "streaming" if stream else "tree"
+    # Pages to profile can be named from the current folder or from root_dir.
+    profile = {os.path.abspath(path if os.path.exists(path) else os.path.join(root_dir, path)): modes
+               for path, modes in (profile or {}).items()}
+    print(f"Running {len(rules)} rule(s) in {mode} mode over {root_dir}: {', '.join(r.name for r in rules)}")
+
+    uses_head = not stream and any(r.name == 'head-sync' for r in rules)
+    rules_key = rules_signature(rules, stream)
+    # This is the head as it was before the run. If index.html itself gets
+    # rewritten, the next run redoes every page once against the new head.
+    head_hash = head_template_hash(root_dir) if uses_head else ''
+
+    html_files = find_html_files(root_dir)
+    for path in set(profile) - set(map(os.path.abspath, html_files)):
+        print(f"Warning: {path} is not a page under {root_dir}, it will not be profiled.")
+
+    # Looking for the triggers costs less than hashing a page, so it goes first.
+    prefilter_start = time.perf_counter()
+    triggers = compile_triggers(rules) if prefilter else None
+    candidates, untriggered = split_untriggered(html_files, triggers, always=profile)
+    prefilter_time = time.perf_counter() - prefilter_start
+    if verbosity >= VERBOSE:
+        for filepath in untriggered:
+            print(f"Not parsed, no rule applies: {filepath}")
+
+    manifest = load_manifest(root_dir) if incremental else {}
+    to_process, unchanged = split_unchanged(root_dir, candidates, manifest, rules_key, head_hash)
+    profiled_pages = [path for path in unchanged if os.path.abspath(path) in profile]
+    if profiled_pages:
+        unchanged = [path for path in unchanged if path not in profiled_pages]
+        to_process = [path for path in html_files if path in to_process or path in profiled_pages]
+    if unchanged:
+        print(f"Skipping {len(unchanged)} page(s) unchanged since the last run.")
+
+    head_template = None
+    if uses_head and to_process:
+        head_template = load_head_template(root_dir)
+
+    start = time.perf_counter()
+    pages = []
+    for page in iter_pages(root_dir, rules, to_process, head_template, dry_run, jobs, stream,
+                           keep_messages=verbosity >= VERBOSE, profile=profile, diff=diff):
+        report_page(page, verbosity)
+        pages.append(page)
+    wall_time = time.perf_counter() - start
+
+    if redirects and not dry_run:
+        write_redirects(root_dir)
+
+    if incremental and not dry_run:
+        existing = {manifest_key(root_dir, filepath) for filepath in html_files}
+        manifest = {key: entry for key, entry in manifest.items() if key in existing}
+        for page in pages:
+            key = manifest_key(root_dir, page.filepath)
+            if page.error is None:
+                manifest[key] = {'hash': page.output_hash, 'rules': rules_key, 'head': head_hash}
+            else:
+                manifest.pop(key, None)
+        save_manifest(root_dir, manifest)
+
+    written = sum(1 for page in pages if page.written)
+    errors = sum(1 for page in pages if page.error is not None)
+    print(f"\n{len(pages)} page(s) processed, {len(unchanged) + len(untriggered)} skipped, "
+          f"{written} written, {errors} error(s).")
+    if triggers is not None:
+        parsed = len(html_files) - len(untriggered)
+        print(f"Prefilter: {len(untriggered)} page(s) matched no trigger and were not parsed, "
+              f"{parsed} did ({len(untriggered) / max(len(html_files), 1):.0%} skipped) in {prefilter_time:.2f}s.")
+
+    summary = fix_metrics.summarize(pages, root_dir, rules, mode, min(jobs, len(pages)), wall_time, len(unchanged),
+                                    len(untriggered) if triggers is not None else None, prefilter_time)
+    # Per-page CPU time adds up to roughly what a serial run would spend; wall
+    # time per page is not used because it grows when workers share a core.
+    if pages:
+        serial_time = summary['cpu_s']
+        print(f"Wall time {wall_time:.2f}s with {min(jobs, len(pages))} job(s); "
+              f"pages used {serial_time:.2f}s of CPU, speedup x{serial_time / wall_time:.2f} over serial.")
+        if verbosity > QUIET:
+            report_metrics(summary, verbosity)
+
+    metrics_path = metrics
+    if metrics is True:
+        metrics_path = None if dry_run else os.path.join(root_dir, fix_metrics.METRICS_NAME)
+    if metrics_path:
+        try:
+            fix_metrics.save_summary(metrics_path, summary)
+            if verbosity > QUIET:
+                print(f"Metrics saved to {metrics_path}.")
+        except OSError as e:
+            print(f"Error saving metrics to {metrics_path}: {e}")
+    return pages
+
+
+def split_names(value):
+    return [name.strip() for name in value.split(',') if name.strip()] if value else []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fix a Readymag export with one parse per page.")
+    parser.add_argument('root', nargs='?', default='.', help="Root folder of the export (default: current folder).")
+    parser.add_argument('--rules', help="Comma-separated rules to run instead of the default set.")
+    parser.add_argument('--skip', help="Comma-separated rules to leave out.")
+    parser.add_argument('--list-rules', action='store_true', help="List the available rules and exit.")
+    parser.add_argument('--dry-run', action='store_true', help="Report changes without writing any file.")
+    parser.add_argument('--diff', action='store_true',
+                        help="Show the exact byte spans each page changes; with --dry-run, what a run would change.")
+    parser.add_argument('--redirects', action='store_true', help="Also write the _redirects file.")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="Number of worker processes; 0 uses every CPU (default: 1).")
+    parser.add_argument('--force', action='store_true',
+                        help="Process every page even if the manifest says it is unchanged.")
+    parser.add_argument('--no-prefilter', action='store_true',
+                        help="Parse every page, even those containing none of the rules' trigger patterns.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Rewrite tags in place without building a tree. Only rules with a streaming version can run.")
+    level = parser.add_mutually_exclusive_group()
+    level.add_argument('--quiet', '-q', action='store_true', help="Only report errors and the totals.")
+    level.add_argument('--verbose', '-v', action='store_true', help="Report every change and the time of each rule.")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help=f"Where to save the JSON summary of the run (default: root/{fix_metrics.METRICS_NAME}).")
+    parser.add_argument('--profile', metavar='PAGE', action='append', default=[],
+                        help="Run PAGE under cProfile and print where its time goes. Can be given several times.")
+    parser.add_argument('--trace-memory', metavar='PAGE', action='append', default=[],
+                        help="Trace the memory PAGE allocates with tracemalloc, per phase. Can be given several times.")
+    args = parser.parse_args(argv)
+
+    if args.list_rules:
+        for entry in RULES.values():
+            marker = '*' if entry.default else ' '
+            streams = 's' if entry.stream else ' '
+            filtered = 'p' if entry.triggers is not None else ' '
+            print(f"{marker}{streams}{filtered} {entry.name:20} {entry.description}")
+        print("\n* = enabled by default, s = has a streaming version, p = pages can be skipped by the prefilter")
+        return 0
+
+    try:
+        rules = select_rules(split_names(args.rules), split_names(args.skip), stream=args.stream)
+    except ValueError as e:
+        parser.error(str(e))
+
+    profile = {}
+    for modes, paths in (('cpu', args.profile), ('memory', args.trace_memory)):
+        for path in paths:
+            profile[path] = profile.get(path, ()) + (modes,)
+    verbosity = QUIET if args.quiet else VERBOSE if args.verbose else NORMAL
+    pages = fix_site(args.root, rules, dry_run=args.dry_run, redirects=args.redirects,
+                     jobs=args.jobs, stream=args.stream, incremental=not args.force,
+                     verbosity=verbosity, metrics=args.metrics or True, profile=profile, diff=args.diff,
+                     prefilter=not args.no_prefilter)
+    return 1 if any(page.error is not None for page in pages) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
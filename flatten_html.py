@@ -1,51 +1,305 @@
+import argparse
+import glob
+import io
 import os
-import shutil
+import posixpath
+import re
+from urllib.parse import urlsplit, urlunsplit
 
-def flatten_html_files(root_dir):
+import html_stream
+from asset_refs import html_refs, resolve_ref
+from fingerprint_assets import STATE_FILES
+from fix_pipeline import SKIP_DIRS
+from routes import (build_route_table, load_page_moves, save_page_moves, write_redirects,
+                    write_server_rules)
+from server_rules import REDIRECTS
+
+SITEMAP = 'sitemap.xml'
+SITEMAP_LOC = re.compile(rb'<loc>([^<]*)</loc>')
+
+
+def disk_path(root_dir, path):
+    return os.path.join(root_dir, path.lstrip('/'))
+
+
+def site_path(root_dir, filepath):
+    return '/' + os.path.relpath(filepath, root_dir).replace(os.sep, '/')
+
+
+def scan_pages(root_dir):
     """
-    Recursively finds all .html files in subdirectories and moves them
-    to the root directory. It handles potential filename conflicts.
+    Walks the site once. Returns the names taken at the root, the index
+    new names are checked against, and the site path of every page.
     """
-    print(f"Starting to flatten directory from: {root_dir}")
-    
-    # Walk through the directory tree from the bottom up.
-    for dirpath, dirnames, filenames in os.walk(root_dir, topdown=False):
-        # We only want to process subdirectories, not the root itself.
-        if dirpath == root_dir:
-            continue
-
-        for filename in filenames:
-            # Only move HTML files.
-            if filename.endswith('.html'):
-                source_path = os.path.join(dirpath, filename)
-                destination_path = os.path.join(root_dir, filename)
-
-                # Check for a filename conflict.
-                if os.path.exists(destination_path):
-                    name, ext = os.path.splitext(filename)
-                    counter = 1
-                    # Append a number until a unique filename is found.
-                    while os.path.exists(os.path.join(root_dir, f"{name}_{counter}{ext}")):
-                        counter += 1
-                    new_filename = f"{name}_{counter}{ext}"
-                    destination_path = os.path.join(root_dir, new_filename)
-                    print(f"Conflict found for {filename}. Renaming to {new_filename}")
-                
-                # Move the file.
-                shutil.move(source_path, destination_path)
-                print(f"Moved {source_path} to {destination_path}")
-
-        # After moving all files, check if the subdirectory is now empty and remove it.
+    root_names, pages = set(), []
+    for subdir, dirs, files in os.walk(root_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        if os.path.samefile(subdir, root_dir):
+            root_names.update(dirs)
+            root_names.update(files)
+        pages.extend(site_path(root_dir, os.path.join(subdir, f)) for f in sorted(files) if f.endswith('.html'))
+    return root_names, pages
+
+
+def plan_moves(root_names, pages):
+    """
+    Picks the root name of every page in a subfolder, shallow pages first.
+    A folder's index.html takes the folder's name, like a clean URL would.
+    Taken names get the first free _<n> suffix, found from a counter per
+    stem instead of probing the disk. Returns {old path: new path}.
+    """
+    taken = set(root_names)
+    next_suffix = {}
+    moves = {}
+    for path in sorted((p for p in pages if p.count('/') > 1), key=lambda p: (p.count('/'), p)):
+        name = posixpath.basename(path)
+        if name == 'index.html':
+            name = posixpath.basename(posixpath.dirname(path)) + '.html'
+        if name in taken:
+            stem, ext = posixpath.splitext(name)
+            suffix = next_suffix.get(stem, 1)
+            while f"{stem}_{suffix}{ext}" in taken:
+                suffix += 1
+            next_suffix[stem] = suffix + 1
+            name = f"{stem}_{suffix}{ext}"
+        taken.add(name)
+        moves[path] = '/' + name
+    return moves
+
+
+def folder_urls(moves):
+    """
+    The URLs a moved index.html answered as its folder, with and without
+    the trailing slash: {folder URL: new path}. Links and redirects for
+    them have to follow the page too.
+    """
+    urls = {}
+    for old, new in moves.items():
+        if posixpath.basename(old) == 'index.html' and posixpath.dirname(old) != '/':
+            folder = posixpath.dirname(old)
+            urls[folder] = urls[folder + '/'] = new
+    return urls
+
+
+def moved_url(url, old_base, new_base, moves):
+    """
+    Returns url as the page now at new_base has to write it to reach what
+    it reached from old_base, following moved pages, or None when it
+    stays as it is. Query strings, fragments and trailing slashes are kept.
+    """
+    target = resolve_ref(url, old_base)
+    if target is None:
+        return None
+    new_target = moves.get(target, target)
+    relative = not url.strip().startswith('/')
+    if new_target == target and (not relative or posixpath.dirname(old_base) == posixpath.dirname(new_base)):
+        return None
+    cut = min([i for i in (url.find('?'), url.find('#')) if i != -1] or [len(url)])
+    path, rest = url[:cut], url[cut:]
+    if relative:
+        new_path = posixpath.relpath(new_target, posixpath.dirname(new_base))
+        new_path = './' if new_path == '.' else new_path
+    else:
+        new_path = new_target
+    # A folder URL that now names a page loses its slash with the move.
+    if path.endswith('/') and not new_path.endswith('/') and new_target == target:
+        new_path += '/'
+    return None if new_path == path else new_path + rest
+
+
+def quoted_paths(moves):
+    """
+    Matches a moved page's path quoted in script or JSON text, with or
+    without the leading slash. Such paths are relative to the site root.
+    """
+    names = '|'.join(re.escape(path.lstrip('/')) for path in sorted(moves, key=len, reverse=True))
+    return re.compile(r'''(?:(?<=["'])|(?<=&quot;))(/?)(%s)(?=["'?#&\\])''' % names)
+
+
+def rewrite_quoted(text, pattern, moves):
+    return pattern.sub(lambda m: m.group(1) + moves['/' + m.group(2)].lstrip('/'), text)
+
+
+def rewrite_page(data, old_path, new_path, moves, pattern):
+    """
+    Returns the page with its links, sources and inline script paths
+    pointing where they pointed before the moves, seen from its new place.
+    """
+    edits = []
+    for start, end, url, kind in html_refs(data):
+        new_url = moved_url(data[start:end].decode('utf-8', 'replace'), old_path, new_path, moves)
+        if new_url is not None:
+            edits.append((start, end, new_url.encode('utf-8')))
+    for token in html_stream.iter_tags(data):
+        if isinstance(token, html_stream.StartTag) and token.name == 'script' and token.content_end is not None:
+            text = token.content.decode('utf-8', 'surrogateescape')
+            new_text = rewrite_quoted(text, pattern, moves)
+            if new_text != text:
+                edits.append((token.end, token.content_end, new_text.encode('utf-8', 'surrogateescape')))
+    if not edits:
+        return data
+    out = io.BytesIO()
+    html_stream.apply_edits(data, edits, out)
+    return out.getvalue()
+
+
+def rewrite_sitemap(data, moves):
+    """
+    Points the <loc> entries that name a moved page at its new path.
+    """
+    def loc(match):
+        parts = urlsplit(match.group(1).decode('utf-8'))
+        if parts.path not in moves:
+            return match.group(0)
+        return b'<loc>' + urlunsplit(parts._replace(path=moves[parts.path])).encode('utf-8') + b'</loc>'
+    return SITEMAP_LOC.sub(loc, data)
+
+
+def rewrite_redirects(text, moves):
+    """
+    Swaps moved page paths in a _redirects file that routes.py cannot
+    rebuild, for sites without a project state.
+    """
+    lines = []
+    for line in text.splitlines(keepends=True):
+        words = re.split(r'(\s+)', line)
+        lines.append(''.join(moves.get(word, word) for word in words))
+    return ''.join(lines)
+
+
+def plan_outputs(root_dir, pages, moves):
+    """
+    Works out the new content of every file the moves touch, before any
+    of them is written: {site path the file will have: (old site path,
+    new bytes)}. Pages are listed even when only their place changes.
+    """
+    links = dict(moves, **folder_urls(moves))
+    pattern = quoted_paths(links)
+    outputs = {}
+    for path in pages:
+        with open(disk_path(root_dir, path), 'rb') as f:
+            data = f.read()
+        new_path = moves.get(path, path)
+        new_data = rewrite_page(data, path, new_path, links, pattern)
+        if new_path != path or new_data != data:
+            outputs[new_path] = (path, new_data)
+
+    state_paths = sorted({site_path(root_dir, p) for spec in STATE_FILES
+                          for p in glob.glob(disk_path(root_dir, spec))})
+    for path in state_paths:
+        with open(disk_path(root_dir, path), 'r', encoding='utf-8') as f:
+            text = f.read()
+        new_text = rewrite_quoted(text, pattern, links)
+        if new_text != text:
+            outputs[path] = (path, new_text.encode('utf-8'))
+
+    sitemap = disk_path(root_dir, SITEMAP)
+    if os.path.exists(sitemap):
+        with open(sitemap, 'rb') as f:
+            data = f.read()
+        new_data = rewrite_sitemap(data, links)
+        if new_data != data:
+            outputs['/' + SITEMAP] = ('/' + SITEMAP, new_data)
+    return outputs
+
+
+def remove_empty_dirs(root_dir, moves):
+    """
+    Removes the folders the moves emptied, deepest first, and their
+    parents once they are empty too.
+    """
+    folders = set()
+    for path in moves:
+        folder = posixpath.dirname(path)
+        while folder != '/':
+            folders.add(folder)
+            folder = posixpath.dirname(folder)
+    for folder in sorted(folders, key=lambda f: -f.count('/')):
+        filepath = disk_path(root_dir, folder)
         try:
-            if not os.listdir(dirpath):
-                os.rmdir(dirpath)
-                print(f"Removed empty directory: {dirpath}")
+            if os.path.isdir(filepath) and not os.listdir(filepath):
+                os.rmdir(filepath)
+                print(f"  - Removed empty folder {folder}.")
         except OSError as e:
-            # This handles cases where the directory isn't empty (e.g., has other file types).
-            print(f"Could not remove directory {dirpath}: {e}")
+            print(f"  - Could not remove folder {folder}: {e}")
 
-if __name__ == "__main__":
-    # The root directory of your project.
-    project_root = "." 
-    flatten_html_files(project_root)
+
+def update_routes(root_dir, moves):
+    """
+    Rebuilds the server rules and _redirects from the route table, which
+    now finds the moved pages and redirects their old paths.
+    """
+    table = build_route_table(root_dir)
+    if table is not None:
+        write_server_rules(root_dir, table)
+        write_redirects(root_dir, table)
+        return
+    path = disk_path(root_dir, REDIRECTS)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        new_text = rewrite_redirects(text, dict(moves, **folder_urls(moves)))
+        if new_text != text:
+            html_stream.write_atomic(path, new_text.encode('utf-8'))
+            print(f"  - Moved page paths updated in {REDIRECTS}.")
+
+
+def flatten_html_files(root_dir, dry_run=False):
+    """
+    Moves every page in a subfolder to the site root in one batch. All the
+    moves are planned first from a single walk, then every page, state
+    file and the sitemap is rewritten in memory so links to a moved page
+    follow it and relative links in a moved page still resolve. Nothing is
+    written unless all of that succeeds. The old paths are kept in the
+    page moves index, which the server rules turn into redirects.
+    """
+    print(f"Starting to flatten directory from: {root_dir}")
+    root_names, pages = scan_pages(root_dir)
+    moves = plan_moves(root_names, pages)
+    if not moves:
+        print("  - No pages in subfolders, nothing to move.")
+        return
+    for old, new in moves.items():
+        print(f"  - {old} -> {new}")
+
+    try:
+        outputs = plan_outputs(root_dir, pages, moves)
+    except Exception as e:
+        print(f"  - ERROR planning the moves, no file was changed: {e}")
+        return
+    for new_path, (old_path, data) in sorted(outputs.items()):
+        if new_path == old_path:
+            print(f"  - References to moved pages updated in {new_path}.")
+    if dry_run:
+        print(f"  - Dry run, {len(moves)} move(s) and {len(outputs)} file(s) not saved.")
+        return
+
+    for new_path, (old_path, data) in outputs.items():
+        html_stream.write_atomic(disk_path(root_dir, new_path), data)
+    for old_path in moves:
+        os.remove(disk_path(root_dir, old_path))
+        html_stream.remove_sidecars(disk_path(root_dir, old_path))
+    remove_empty_dirs(root_dir, moves)
+
+    history = load_page_moves(root_dir)
+    # A page moved again redirects from every place it has been.
+    history = {old: moves.get(new, new) for old, new in history.items()}
+    history.update(moves)
+    history.update(folder_urls(moves))
+    save_page_moves(root_dir, history)
+    print(f"  - {len(moves)} page(s) moved, {len(outputs) - len(moves)} other file(s) updated.")
+    update_routes(root_dir, moves)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move the pages in subfolders to the site root and point every "
+                                                 "reference at their new paths.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--dry-run', action='store_true', help="List the moves without touching any file.")
+    args = parser.parse_args(argv)
+    flatten_html_files(args.root, dry_run=args.dry_run)
     print("\nDirectory flattening complete.")
+
+
+if __name__ == "__main__":
+    main()
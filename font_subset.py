@@ -0,0 +1,370 @@
+import argparse
+import glob
+import hashlib
+import io
+import os
+import posixpath
+import re
+import html_stream
+from extract_server_data import entry_page_id, find_server_data, project_pages
+from fix_manifest import hash_bytes
+from fix_pipeline import CRITICAL_CSS_ID, find_html_files
+
+try:
+    from fontTools import subset as font_subsetter
+    from fontTools.ttLib import TTFont
+except ImportError:
+    font_subsetter = None
+
+# Subsets are named after their source and the hash of the glyph set they
+# cover, so a run that needs the same characters reuses the file on disk.
+FONT_DIR = 'dist/fonts'
+SUBSET_NAME = re.compile(r'\.([0-9a-f]{10})\.woff2$')
+SOURCE_EXTENSIONS = ('.ttf', '.otf', '.woff')
+
+FONT_FACE = re.compile(r'@font-face\s*\{[^}]*\}', re.I)
+DECLARATION = re.compile(r'(?P<indent>[ \t]*)(?P<name>[\w-]+)\s*:\s*(?P<value>[^;{}]*);?[ \t]*\n?')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)(?:\s*format\(\s*['"]?([\w-]+)['"]?\s*\))?''')
+
+# Per-viewport overrides of a widget, like viewport_phone_portrait.
+VIEWPORT_PREFIX = 'viewport_'
+
+
+def style_families(state):
+    """
+    Returns {text style name: font family} for the project's text styles.
+    """
+    families = {}
+    styles = state.get('mags', {}).get('mag', {}).get('textStyles') or {}
+    for group in ('global', 'project'):
+        for style in styles.get(group) or []:
+            family = (style.get('cssProperties') or {}).get('fontFamily')
+            if style.get('name') and family:
+                families[style['name']] = family
+    return families
+
+
+def block_runs(block_text, block_style, defaults):
+    """
+    Yields (family, text) for one block of a text widget: the block's text
+    style gives the family, and FONT_FAMILY inline styles override it over
+    their offset and length.
+    """
+    families = [defaults.get(block_style.get('type'))] * len(block_text)
+    inline = block_style.get('inlineStyles') or {}
+    keys, values = inline.get('keys') or [], inline.get('values') or []
+    for run in inline.get('styles') or []:
+        for ref in run.get('styles') or []:
+            key_index, _, value_index = str(ref).partition(';')
+            try:
+                key, value = keys[int(key_index)], values[int(value_index)]
+            except (ValueError, IndexError):
+                continue
+            if key == 'FONT_FAMILY':
+                start = run.get('offset', 0)
+                end = min(start + run.get('length', 0), len(families))
+                families[start:end] = [value] * max(0, end - start)
+    for family, char in zip(families, block_text):
+        if family:
+            yield family, char
+
+
+def widget_text(widget, defaults):
+    """
+    Yields (family, text) for everything a text or button widget renders,
+    in every viewport it has styles for.
+    """
+    variants = [widget] + [value for key, value in widget.items()
+                           if key.startswith(VIEWPORT_PREFIX) and isinstance(value, dict)]
+    if widget.get('type') == 'text':
+        blocks = {block.get('key'): block.get('text') or '' for block in widget.get('blocks') or []}
+        for variant in variants:
+            for block_style in variant.get('styles') or []:
+                text = blocks.get(block_style.get('key'), '')
+                yield from block_runs(text, block_style, defaults)
+    elif widget.get('type') == 'button':
+        for variant in variants:
+            for key, value in variant.items():
+                if key.endswith('font-family') and value:
+                    yield value, widget.get('text') or ''
+
+
+def collect_characters(root_dir):
+    """
+    Reads the ServerData of every page and returns {page id: {family: set
+    of characters}} for the text and button widgets of each project page,
+    and the pages' entry page ids as {html path: page id}.
+    """
+    per_page = {}
+    entries = {}
+    for filepath in find_html_files(root_dir):
+        with open(filepath, 'rb') as f:
+            found = find_server_data(f.read())
+        if found is None:
+            continue
+        state = found[2]
+        defaults = style_families(state)
+        pages = project_pages(state)
+        entries[filepath] = entry_page_id(root_dir, filepath, pages)
+        global_widgets = state.get('mags', {}).get('mag', {}).get('globalWidgets') or []
+        for page in pages:
+            if page['_id'] in per_page:
+                continue
+            chars = per_page[page['_id']] = {}
+            for widget in page['wids'] + [w for w in global_widgets if isinstance(w, dict)]:
+                for family, text in widget_text(widget, defaults):
+                    chars.setdefault(family, set()).update(text)
+    return per_page, entries
+
+
+def glyph_set(chars):
+    """
+    The code points a subset keeps. Both cases of every letter are in, since
+    text-transform can change the case the viewer renders.
+    """
+    codepoints = set()
+    for char in chars:
+        for variant in (char, char.upper(), char.lower()):
+            if len(variant) == 1 and ord(variant) >= 0x20:
+                codepoints.add(ord(variant))
+    return sorted(codepoints | {0x20})
+
+
+def unicode_range(codepoints):
+    ranges = []
+    for cp in codepoints:
+        if ranges and ranges[-1][1] == cp - 1:
+            ranges[-1][1] = cp
+        else:
+            ranges.append([cp, cp])
+    return ', '.join(f"U+{start:X}" if start == end else f"U+{start:X}-{end:X}" for start, end in ranges)
+
+
+def build_subset(source_path, codepoints, out_path):
+    """
+    Writes the WOFF2 subset of source_path that covers codepoints, keeping
+    every layout feature so kerning and ligatures survive.
+    """
+    options = font_subsetter.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    options.notdef_outline = True
+    # FontForge's timestamp table, which fontTools cannot subset.
+    options.drop_tables += ['FFTM']
+    font = TTFont(source_path)
+    subsetter = font_subsetter.Subsetter(options)
+    subsetter.populate(unicodes=codepoints)
+    subsetter.subset(font)
+    out = io.BytesIO()
+    font_subsetter.save_font(font, out, options)
+    html_stream.write_atomic(out_path, out.getvalue())
+
+
+def face_declarations(block):
+    body = block[block.index('{') + 1:block.rindex('}')]
+    return list(DECLARATION.finditer(body))
+
+
+def original_source(src_value):
+    """
+    Returns (url, format) of the font file an @font-face loads, looking past
+    a subset an earlier run put in front of it.
+    """
+    for match in CSS_URL.finditer(src_value):
+        if not SUBSET_NAME.search(match.group(2)) and match.group(2).lower().endswith(SOURCE_EXTENSIONS):
+            return match.group(2), match.group(3)
+    return None, None
+
+
+def rewrite_face(block, subset_url, source_url, source_format, codepoints):
+    """
+    Points an @font-face rule at its subset with the original as a fallback
+    for browsers without WOFF2, and limits it to the subset's unicode-range.
+    """
+    head = block[:block.index('{') + 1]
+    parts = []
+    for match in face_declarations(block):
+        name = match.group('name').lower()
+        if name == 'unicode-range':
+            continue
+        if name == 'src':
+            fallback = f'url("{source_url}")' + (f' format("{source_format}")' if source_format else '')
+            parts.append(f'{match.group("indent")}src: url("{subset_url}") format("woff2"), {fallback};\n')
+            parts.append(f'{match.group("indent")}unicode-range: {unicode_range(codepoints)};\n')
+        else:
+            parts.append(match.group(0) if match.group(0).endswith('\n') else match.group(0) + '\n')
+    return head + '\n' + ''.join(parts) + '}'
+
+
+def face_family(block):
+    for match in face_declarations(block):
+        if match.group('name').lower() == 'font-family':
+            return match.group('value').strip().strip('"\'')
+    return None
+
+
+def find_stylesheets(root_dir):
+    return sorted(glob.glob(os.path.join(root_dir, 'dist', '**', '*.css'), recursive=True))
+
+
+def subset_fonts(root_dir, characters, dry_run=False):
+    """
+    Builds a WOFF2 subset for every local @font-face whose family some page
+    renders and rewrites the rule to use it. Returns {family: [subset URL
+    from the site root]} and the paths of the subsets in use.
+    """
+    used = {}
+    keep = set()
+    for css_path in find_stylesheets(root_dir):
+        with open(css_path, 'r', encoding='utf-8') as f:
+            css = f.read()
+        css_dir = '/' + os.path.relpath(os.path.dirname(css_path), root_dir).replace(os.sep, '/')
+        css_name = os.path.relpath(css_path, root_dir)
+
+        def rewrite(match):
+            block = match.group(0)
+            family = face_family(block)
+            src = next((m.group('value') for m in face_declarations(block) if m.group('name').lower() == 'src'), '')
+            source_url, source_format = original_source(src)
+            if not family or not source_url or source_url.startswith(('/', 'http:', 'https:', 'data:')):
+                return block
+            source_path = os.path.join(root_dir, posixpath.normpath(posixpath.join(css_dir, source_url)).lstrip('/'))
+            if not characters.get(family):
+                print(f"  - {family}: no page renders text in it, left as is.")
+                return block
+            if not os.path.exists(source_path):
+                print(f"  - {family}: {source_url} is missing, left as is.")
+                return block
+
+            codepoints = glyph_set(characters[family])
+            with open(source_path, 'rb') as f:
+                source_hash = hash_bytes(f.read())
+            digest = hashlib.sha256(f"{source_hash}:{unicode_range(codepoints)}".encode('ascii')).hexdigest()[:10]
+            stem = os.path.splitext(os.path.basename(source_path))[0]
+            subset_path = os.path.join(os.path.dirname(source_path), f"{stem}.{digest}.woff2")
+            subset_url = posixpath.join(posixpath.dirname(source_url), os.path.basename(subset_path))
+            keep.add(os.path.abspath(subset_path))
+            if os.path.exists(subset_path):
+                state = 'cached'
+            elif not dry_run:
+                build_subset(source_path, codepoints, subset_path)
+                state = 'built'
+            if os.path.exists(subset_path):
+                print(f"  - {family}: {len(codepoints)} glyph(s), {os.path.getsize(source_path):,} bytes -> "
+                      f"{os.path.getsize(subset_path):,} bytes WOFF2 ({state}).")
+            else:
+                print(f"  - {family}: {len(codepoints)} glyph(s) to subset from {os.path.getsize(source_path):,} bytes.")
+            used.setdefault(family, []).append(posixpath.normpath(posixpath.join(css_dir, subset_url)))
+            return rewrite_face(block, subset_url, source_url, source_format, codepoints)
+
+        print(f"\nProcessing: {css_path}")
+        try:
+            new_css = FONT_FACE.sub(rewrite, css)
+            if new_css == css:
+                print(f"  - No changes were made to {css_name}.")
+            elif dry_run:
+                print(f"  - Dry run, changes not saved to {css_name}.")
+            else:
+                html_stream.write_atomic(css_path, new_css.encode('utf-8'))
+                print(f"  - Changes saved to {css_name}.")
+        except Exception as e:
+            print(f"  - ERROR processing file {css_path}: {e}")
+    return used, keep
+
+
+def is_font_preload(token):
+    return (token.name == 'link' and token.get('rel', '').lower() == 'preload' and token.get('as') == 'font'
+            and SUBSET_NAME.search(token.get('href') or '') is not None)
+
+
+def preload_markup(urls):
+    return ''.join(f'<link as="font" crossorigin="" href="{url}" rel="preload" type="font/woff2"/>'
+                   for url in urls).encode('utf-8')
+
+
+def rewrite_preloads(filepath, urls, dry_run=False):
+    """
+    Replaces the font preloads of a page with one per subset in urls, placed
+    before its first stylesheet so the fonts start downloading early.
+    """
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    edits = []
+    insert_at = None
+    for token in html_stream.iter_tags(data, edits):
+        if isinstance(token, html_stream.EndTag):
+            if token.name == 'head':
+                insert_at = token.start if insert_at is None else insert_at
+                break
+            continue
+        if is_font_preload(token):
+            token.remove()
+        elif insert_at is None and (token.name == 'style' or (
+                token.name == 'link' and (token.get('rel', '').lower() == 'stylesheet' or token.get('as') == 'style'))):
+            insert_at = token.start
+    if urls and insert_at is not None:
+        edits.append((insert_at, insert_at, preload_markup(urls)))
+    out = io.BytesIO()
+    html_stream.apply_edits(data, edits, out)
+    if out.getvalue() == data:
+        return False
+    if not dry_run:
+        html_stream.write_atomic(filepath, out.getvalue())
+    return True
+
+
+def remove_stale_subsets(root_dir, keep, dry_run=False):
+    for path in glob.glob(os.path.join(root_dir, FONT_DIR, '**', '*.woff2'), recursive=True):
+        if SUBSET_NAME.search(path) and os.path.abspath(path) not in keep:
+            print(f"  - Removing stale subset {os.path.relpath(path, root_dir)}.")
+            if not dry_run:
+                os.remove(path)
+
+
+def font_subset(root_dir, dry_run=False):
+    if font_subsetter is None:
+        print("Error: fontTools is not installed (pip install fonttools brotli). No subsets can be built.")
+        return
+
+    per_page, entries = collect_characters(root_dir)
+    if not per_page:
+        print("No inline ServerData found; run this before extract_server_data.py.")
+        return
+    characters = {}
+    for families in per_page.values():
+        for family, chars in families.items():
+            characters.setdefault(family, set()).update(chars)
+    print(f"{len(per_page)} project page(s) render text in {len(characters)} font family(ies): "
+          f"{', '.join(sorted(characters))}.")
+
+    used, keep = subset_fonts(root_dir, characters, dry_run)
+    remove_stale_subsets(root_dir, keep, dry_run)
+
+    critical = False
+    for filepath in find_html_files(root_dir):
+        # A page that is not in the project state may show any of them.
+        page_fonts = per_page[entries[filepath]] if entries.get(filepath) in per_page else characters
+        urls = [url for family in sorted(page_fonts) for url in used.get(family, [])]
+        try:
+            with open(filepath, 'rb') as f:
+                critical = critical or f'id="{CRITICAL_CSS_ID}"'.encode() in f.read()
+            if rewrite_preloads(filepath, urls, dry_run):
+                print(f"Processing: {filepath}\n  - Preloading {len(urls)} font subset(s)"
+                      f"{' (dry run, not saved)' if dry_run else ''}.")
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+    if critical and used:
+        print("\nPages inline @font-face rules from critical_css.py; run it again to pick up the subsets.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Subset local fonts to the characters the pages render, as WOFF2.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--dry-run', action='store_true', help="Report the subsets without writing anything.")
+    args = parser.parse_args(argv)
+    font_subset(args.root, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
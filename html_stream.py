@@ -0,0 +1,360 @@
+import difflib
+import html
+import os
+import re
+import shutil
+
+# The precompressed copies precompress.py writes next to a file.
+SIDECARS = ('.br', '.gz')
+
+# Elements whose body is raw text: the tokenizer jumps straight to the closing
+# tag instead of scanning the (often huge) inline script for markup.
+RAW_TEXT_ELEMENTS = {'script', 'style'}
+
+# Elements that never have a closing tag.
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+TAG_OPEN = re.compile(rb'<([a-zA-Z][^\s/>]*)')
+END_TAG = re.compile(rb'</([a-zA-Z][^\s/>]*)[^>]*>')
+ATTRIBUTE = re.compile(rb'''(\s*)([^\s"'>/=]+)(?:(\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?''')
+TAG_CLOSE = re.compile(rb'\s*(/?)>')
+JUNK = re.compile(rb'[^>]*>')
+
+
+class Attribute:
+    """
+    One attribute of a start tag, with the byte offsets of the whole attribute
+    (including the whitespace before it) and of its value.
+    """
+
+    def __init__(self, name, raw_value, start, end, value_start, value_end, quote):
+        self.name = name
+        self.raw_value = raw_value
+        self.start = start
+        self.end = end
+        self.value_start = value_start
+        self.value_end = value_end
+        self.quote = quote
+
+    @property
+    def value(self):
+        if self.raw_value is None:
+            return ''
+        return html.unescape(self.raw_value.decode('utf-8', 'replace'))
+
+
+class EndTag:
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+
+
+class StartTag:
+    """
+    A start tag found in the buffer. Rules read attributes with get() and
+    record edits with set(), remove_attr() and remove(); nothing in the
+    buffer is touched until the edits are applied.
+    """
+
+    def __init__(self, data, name, start, end, attrs, self_closing, edits):
+        self.data = data
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attrs = attrs
+        self.self_closing = self_closing
+        # For raw-text and void elements: where the element ends, closing tag included.
+        self.element_end = end if name in VOID_ELEMENTS or self_closing else None
+        # For raw-text elements: where the text body stops (the closing tag starts).
+        self.content_end = None
+        self.removed = False
+        self._edits = edits
+
+    def _find(self, name):
+        name = name.lower()
+        for attr in self.attrs:
+            if attr.name == name:
+                return attr
+        return None
+
+    def has(self, name):
+        return self._find(name) is not None
+
+    def get(self, name, default=None):
+        attr = self._find(name)
+        return attr.value if attr is not None else default
+
+    @property
+    def source(self):
+        return bytes(self.data[self.start:self.end])
+
+    @property
+    def content(self):
+        """
+        The raw text body of a script or style element, as bytes.
+        """
+        if self.content_end is None:
+            return b''
+        return bytes(self.data[self.end:self.content_end])
+
+    def set(self, name, value):
+        encoded = html.escape(value, quote=True).encode('utf-8')
+        attr = self._find(name)
+        if attr is None:
+            # New attributes go right before the closing '>' or '/>'.
+            insert_at = self.end - (2 if self.self_closing else 1)
+            self._edits.append((insert_at, insert_at, b' ' + name.encode('ascii') + b'="' + encoded + b'"'))
+        elif attr.quote:
+            self._edits.append((attr.value_start, attr.value_end, encoded))
+        else:
+            self._edits.append((attr.start, attr.end, b' ' + name.encode('ascii') + b'="' + encoded + b'"'))
+
+    def remove_attr(self, name):
+        attr = self._find(name)
+        if attr is not None:
+            self._edits.append((attr.start, attr.end, b''))
+
+    def remove(self):
+        if self.element_end is None:
+            raise ValueError(f"Cannot remove <{self.name}> without a known end in streaming mode.")
+        self.removed = True
+        self._edits.append((self.start, self.element_end, b''))
+
+    def replace(self, markup):
+        """
+        Replaces the whole element, closing tag included, with markup (bytes).
+        """
+        if self.element_end is None:
+            raise ValueError(f"Cannot replace <{self.name}> without a known end in streaming mode.")
+        self.removed = True
+        self._edits.append((self.start, self.element_end, markup))
+
+
+def parse_start_tag(data, pos, edits):
+    """
+    Parses the start tag at data[pos] and returns it, or None when the '<' does
+    not open a well-formed tag.
+    """
+    match = TAG_OPEN.match(data, pos)
+    if not match:
+        return None
+    name = match.group(1).decode('ascii', 'replace').lower()
+    cursor = match.end()
+    attrs = []
+    while True:
+        close = TAG_CLOSE.match(data, cursor)
+        if close:
+            return StartTag(data, name, pos, close.end(), attrs, bool(close.group(1)), edits)
+        attr_match = ATTRIBUTE.match(data, cursor)
+        if not attr_match or attr_match.end() == cursor:
+            # A stray '/' or quote: step over it like browsers do.
+            if cursor >= len(data):
+                return None
+            cursor += 1
+            continue
+        attr_name = attr_match.group(2).decode('ascii', 'replace').lower()
+        raw_value, value_start, value_end, quote = None, attr_match.end(), attr_match.end(), None
+        for group, quote_char in ((4, '"'), (5, "'"), (6, None)):
+            if attr_match.group(group) is not None:
+                raw_value = attr_match.group(group)
+                value_start, value_end = attr_match.span(group)
+                quote = quote_char
+                break
+        attrs.append(Attribute(attr_name, raw_value, attr_match.start(), attr_match.end(),
+                               value_start, value_end, quote))
+        cursor = attr_match.end()
+
+
+def iter_tags(data, edits=None):
+    """
+    Walks the buffer and yields StartTag and EndTag events in document order.
+    Text, comments and raw-text element bodies are skipped without copying.
+    """
+    if edits is None:
+        edits = []
+    pos = 0
+    length = len(data)
+    while True:
+        pos = data.find(b'<', pos)
+        if pos == -1 or pos >= length - 1:
+            return
+        if data.startswith(b'<!--', pos):
+            end = data.find(b'-->', pos + 4)
+            pos = length if end == -1 else end + 3
+            continue
+        if data.startswith(b'</', pos):
+            match = END_TAG.match(data, pos)
+            if match:
+                yield EndTag(match.group(1).decode('ascii', 'replace').lower(), pos, match.end())
+                pos = match.end()
+            else:
+                pos += 2
+            continue
+        if data.startswith(b'<!', pos) or data.startswith(b'<?', pos):
+            match = JUNK.match(data, pos)
+            pos = match.end() if match else length
+            continue
+
+        tag = parse_start_tag(data, pos, edits)
+        if tag is None:
+            pos += 1
+            continue
+        if tag.name in RAW_TEXT_ELEMENTS and not tag.self_closing:
+            closing = re.compile(rb'</' + tag.name.encode('ascii') + rb'[\s/>]', re.I).search(data, tag.end)
+            body_end = closing.start() if closing else length
+            end_match = JUNK.match(data, body_end) if closing else None
+            tag.content_end = body_end
+            tag.element_end = end_match.end() if end_match else length
+            yield tag
+            pos = body_end
+            continue
+        yield tag
+        pos = tag.end
+
+
+def effective_edits(edits):
+    """
+    Yields the edits in buffer order as apply_edits makes them: edits that
+    fall inside an earlier edit's range (like attribute changes on a removed
+    tag) are dropped.
+    """
+    pos = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: (edit[0], -edit[1])):
+        if start < pos:
+            continue
+        yield start, end, replacement
+        pos = end
+
+
+def apply_edits(data, edits, out):
+    """
+    Writes data to the file object out with the edits applied. Untouched byte
+    ranges are written straight from the original buffer. Edits that fall
+    inside a removed range are dropped.
+    """
+    view = memoryview(data)
+    pos = 0
+    for start, end, replacement in effective_edits(edits):
+        out.write(view[pos:start])
+        out.write(replacement)
+        pos = end
+    out.write(view[pos:])
+
+
+def remove_sidecars(filepath):
+    """
+    Deletes the precompressed copies of filepath. Servers send them in
+    place of the file, so they must go whenever it changes or is removed;
+    precompress.py writes them again from the new content.
+    """
+    for ext in SIDECARS:
+        if os.path.exists(filepath + ext):
+            os.remove(filepath + ext)
+
+
+def write_atomic(filepath, data=None, edits=None, source=None):
+    """
+    Replaces filepath through a temp file next to it and os.replace, so a
+    failed write never leaves half a page behind. Writes data as is, or the
+    edits applied over source when edits are given. The file keeps its
+    permissions and loses its precompressed copies, which no longer match.
+    """
+    temp_path = filepath + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            if edits is None:
+                f.write(data)
+            else:
+                apply_edits(source, edits, f)
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, temp_path)
+        os.replace(temp_path, filepath)
+        remove_sidecars(filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# Changed regions up to this size are compared byte by byte in line_edits.
+BYTE_DIFF_LIMIT = 16 * 1024
+
+
+def line_edits(old, new):
+    """
+    Returns the byte-range edits that turn old into new, found line by line
+    and then narrowed to the bytes that actually differ. Used to show what a
+    whole-document rewrite changed.
+    """
+    old_lines, new_lines = old.splitlines(keepends=True), new.splitlines(keepends=True)
+    old_offsets, new_offsets = [0], [0]
+    for line in old_lines:
+        old_offsets.append(old_offsets[-1] + len(line))
+    for line in new_lines:
+        new_offsets.append(new_offsets[-1] + len(line))
+    edits = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            continue
+        start, end = old_offsets[i1], old_offsets[i2]
+        replacement = new[new_offsets[j1]:new_offsets[j2]]
+        # Trim what the two sides share so the span is only what changed.
+        prefix = len(os.path.commonprefix([old[start:end], replacement]))
+        start, replacement = start + prefix, replacement[prefix:]
+        suffix = len(os.path.commonprefix([old[start:end][::-1], replacement[::-1]]))
+        end, replacement = end - suffix, replacement[:len(replacement) - suffix]
+        if max(end - start, len(replacement)) > BYTE_DIFF_LIMIT:
+            edits.append((start, end, replacement))
+            continue
+        # Small enough to split into the separate spans inside the lines.
+        byte_matcher = difflib.SequenceMatcher(None, old[start:end], replacement, autojunk=False)
+        for op, a1, a2, b1, b2 in byte_matcher.get_opcodes():
+            if op != 'equal':
+                edits.append((start + a1, start + a2, replacement[b1:b2]))
+    return edits
+
+
+def show_bytes(value, limit):
+    text = value.decode('utf-8', 'replace').replace('\n', '\\n')
+    if len(text) > limit:
+        half = limit // 2
+        text = f"{text[:half]} ...{len(text) - limit:,} more... {text[-half:]}"
+    return text
+
+
+def format_edits(data, edits, context=30, limit=300):
+    """
+    Returns a readable listing of the edits: each changed span with its line
+    and byte offsets, the bytes it held and the bytes replacing them, with a
+    little unchanged text on either side.
+    """
+    lines = []
+    for start, end, replacement in effective_edits(edits):
+        line = data.count(b'\n', 0, start) + 1
+        before = show_bytes(data[max(start - context, 0):start], context)
+        after = show_bytes(data[end:end + context], context)
+        lines.append(f"@@ line {line}, bytes {start}-{end} ({len(replacement) - (end - start):+,} bytes) @@")
+        if end > start:
+            lines.append(f"- {before}[{show_bytes(data[start:end], limit)}]{after}")
+        if replacement:
+            lines.append(f"+ {before}[{show_bytes(replacement, limit)}]{after}")
+    return '\n'.join(lines)
+
+
+def rewrite(data, handlers):
+    """
+    Runs every handler over every start tag in data and returns the list of
+    (start, end, replacement) edits they made. A handler is called as
+    handler(tag) and stops being offered a tag once it has been removed.
+    """
+    edits = []
+    for token in iter_tags(data, edits):
+        if not isinstance(token, StartTag):
+            continue
+        for handler in handlers:
+            handler(token)
+            if token.removed:
+                break
+    return edits
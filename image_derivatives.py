@@ -0,0 +1,311 @@
+import argparse
+import io
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import html_stream
+from extract_server_data import find_server_data, to_json
+from fix_manifest import hash_bytes
+from fix_pipeline import find_html_files
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+# Derivatives are named after the content hash of their source, so a
+# renamed or duplicated image reuses what was already built.
+DERIVED_DIR = 'img/responsive'
+INDEX_NAME = 'index.json'
+
+DERIVATIVE_NAME = re.compile(r'^' + re.escape(DERIVED_DIR) + r'/([0-9a-f]+)-\d+w\.\w+$')
+
+WIDTHS = (160, 320, 640, 960, 1280, 1920)
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+QUALITY = {'webp': 80, 'avif': 55}
+
+# The viewer picks between these two for 1x and 2x screens.
+PICTURE_URL_KEYS = (('finalUrl', 1), ('final2xUrl', 2))
+
+
+def find_images(root_dir):
+    """
+    Returns every PNG and JPEG under img/, leaving out the derivatives.
+    """
+    images = []
+    derived = os.path.join(root_dir, DERIVED_DIR)
+    for subdir, dirs, files in os.walk(os.path.join(root_dir, 'img')):
+        if os.path.abspath(subdir) == os.path.abspath(derived):
+            dirs[:] = []
+            continue
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith(SOURCE_EXTENSIONS):
+                images.append(os.path.join(subdir, filename))
+    return images
+
+
+def derivative_path(digest, width, fmt):
+    return f"{DERIVED_DIR}/{digest}-{width}w.{fmt}"
+
+
+def target_widths(source_width):
+    return [w for w in WIDTHS if w < source_width] + [source_width]
+
+
+def build_derivatives(task):
+    """
+    Builds the missing derivatives of one source image. Runs in a worker
+    process. Returns (digest, width, height, number built) or an error string.
+    """
+    root_dir, filepath, digest, formats = task
+    try:
+        with Image.open(filepath) as image:
+            image.load()
+            width, height = image.size
+            has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+            built = 0
+            for target in target_widths(width):
+                resized = None
+                for fmt in formats:
+                    out_path = os.path.join(root_dir, derivative_path(digest, target, fmt))
+                    if os.path.exists(out_path):
+                        continue
+                    if resized is None:
+                        resized = image if target == width else image.resize(
+                            (target, max(1, round(height * target / width))), Image.LANCZOS)
+                    buffer = io.BytesIO()
+                    resized.save(buffer, fmt.upper(), quality=QUALITY[fmt])
+                    with open(out_path + '.tmp', 'wb') as f:
+                        f.write(buffer.getvalue())
+                    os.replace(out_path + '.tmp', out_path)
+                    built += 1
+        return digest, width, height, built
+    except Exception as e:
+        return str(e) or type(e).__name__
+
+
+def load_index(root_dir):
+    path = os.path.join(root_dir, DERIVED_DIR, INDEX_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(root_dir, index):
+    path = os.path.join(root_dir, DERIVED_DIR, INDEX_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    html_stream.remove_sidecars(path)
+
+
+def build_all(root_dir, formats, jobs=1):
+    """
+    Makes sure every source image has its derivatives and returns
+    {image path from the site root: {'hash', 'width', 'height'}}.
+    Images whose derivatives are all on disk are not opened again.
+    """
+    os.makedirs(os.path.join(root_dir, DERIVED_DIR), exist_ok=True)
+    index = load_index(root_dir)
+    images = {}
+    tasks = []
+    for filepath in find_images(root_dir):
+        with open(filepath, 'rb') as f:
+            digest = hash_bytes(f.read())[:16]
+        key = '/' + os.path.relpath(filepath, root_dir).replace(os.sep, '/')
+        images[key] = digest
+        known = index.get(digest)
+        if known and all(os.path.exists(os.path.join(root_dir, derivative_path(digest, w, fmt)))
+                         for w in target_widths(known['width']) for fmt in formats):
+            continue
+        tasks.append((root_dir, filepath, digest, formats))
+
+    print(f"{len(images)} source image(s), {len(images) - len(tasks)} already built, {len(tasks)} to build.")
+    if jobs == 1:
+        results = map(build_derivatives, tasks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs or None)
+        results = executor.map(build_derivatives, tasks, chunksize=4)
+
+    built = 0
+    for task, result in zip(tasks, results):
+        if isinstance(result, str):
+            print(f"  - ERROR processing file {task[1]}: {result}")
+            continue
+        digest, width, height, count = result
+        index[digest] = {'width': width, 'height': height}
+        built += count
+    if jobs != 1:
+        executor.shutdown()
+    save_index(root_dir, index)
+    print(f"Built {built} derivative(s) in {DERIVED_DIR}/.")
+    return {key: dict(index[digest], hash=digest) for key, digest in images.items() if digest in index}
+
+
+def srcset(info, fmt):
+    return ', '.join(f"/{derivative_path(info['hash'], w, fmt)} {w}w" for w in target_widths(info['width']))
+
+
+def closest_derivative(info, wanted_width, fmt):
+    """
+    Returns the smallest derivative at least wanted_width wide, or the
+    largest one there is.
+    """
+    widths = target_widths(info['width'])
+    width = next((w for w in widths if w >= wanted_width), widths[-1])
+    return derivative_path(info['hash'], width, fmt)
+
+
+def widget_widths(state, images):
+    """
+    Returns {image path from the site root: widest widget width} for the
+    picture widgets in a ServerData state. URLs that already point at a
+    derivative count for every source image with the same content.
+    """
+    widths = {}
+    sources = {}
+    for path, info in images.items():
+        sources.setdefault(info['hash'], []).append(path)
+
+    def walk(node):
+        if isinstance(node, dict):
+            picture = node.get('picture')
+            if isinstance(picture, dict) and isinstance(node.get('w'), (int, float)):
+                for key, scale in PICTURE_URL_KEYS + (('url', 1),):
+                    url = picture.get(key)
+                    if not isinstance(url, str):
+                        continue
+                    match = DERIVATIVE_NAME.match(url.lstrip('/'))
+                    for path in sources.get(match.group(1), []) if match else ['/' + url.lstrip('/')]:
+                        widths[path] = max(widths.get(path, 0), node['w'])
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(state)
+    return widths
+
+
+def rewrite_pictures(state, images, fmt):
+    """
+    Points the 1x and 2x URLs of every picture widget at the derivative
+    closest to the size it is shown at. Returns how many URLs changed.
+    """
+    changed = 0
+
+    def walk(node):
+        nonlocal changed
+        if isinstance(node, dict):
+            picture = node.get('picture')
+            if isinstance(picture, dict) and isinstance(node.get('w'), (int, float)):
+                for key, scale in PICTURE_URL_KEYS:
+                    url = picture.get(key)
+                    info = images.get('/' + url.lstrip('/')) if isinstance(url, str) else None
+                    if info:
+                        picture[key] = closest_derivative(info, node['w'] * scale, fmt)
+                        changed += 1
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(state)
+    return changed
+
+
+def rewrite_page(filepath, images, formats, dry_run=False):
+    """
+    Adds srcset and sizes to the local images of one page and points the
+    picture widgets in its inline ServerData at the derivatives.
+    """
+    print(f"\nProcessing: {filepath}")
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    edits = []
+    found = find_server_data(data, edits)
+    shown_widths = widget_widths(found[2], images) if found else {}
+    fmt = formats[0]
+
+    for token in html_stream.iter_tags(data, edits):
+        if not isinstance(token, html_stream.StartTag) or token.name != 'img':
+            continue
+        src = token.get('src') or ''
+        path = '/' + src.lstrip('/')
+        info = images.get(path)
+        if not info:
+            continue
+        shown = shown_widths.get(path)
+        sizes = f"(max-width: {round(shown)}px) 100vw, {round(shown)}px" if shown else '100vw'
+        # Always from the site root: absolute-paths leaves srcset alone, and a
+        # relative candidate would be a different URL on every nested page.
+        candidates = srcset(info, fmt)
+        if token.get('srcset') != candidates or token.get('sizes') != sizes:
+            token.set('srcset', candidates)
+            token.set('sizes', sizes)
+            print(f"  - Added srcset to {token.get('src')}")
+
+    if found:
+        tag, prefix, state, suffix = found
+        changed = rewrite_pictures(state, images, fmt)
+        if changed:
+            body = f"{prefix}window.ServerData = {to_json(state).replace('</', '<' + chr(92) + '/')};{suffix}"
+            if body.encode('utf-8') != tag.content:
+                edits.append((tag.end, tag.content_end, body.encode('utf-8')))
+                print(f"  - Pointed {changed} ServerData picture URL(s) at derivatives.")
+    elif b'window.ServerData' not in data:
+        print("  - No inline ServerData; run this before extract_server_data.py to rewrite widget images too.")
+
+    if not edits:
+        print(f"  - No changes were made to {os.path.basename(filepath)}.")
+        return
+    if not dry_run:
+        html_stream.write_atomic(filepath, edits=edits, source=data)
+        print(f"  - Changes saved to {os.path.basename(filepath)}.")
+
+
+def make_responsive(root_dir, formats=('webp',), jobs=1, dry_run=False):
+    if Image is None:
+        print("Error: Pillow is not installed (pip install pillow). No derivatives can be built.")
+        return
+    for fmt in formats:
+        if not features.check(fmt):
+            print(f"Error: this Pillow build cannot write {fmt.upper()}.")
+            return
+
+    images = build_all(root_dir, formats, jobs)
+    for filepath in find_html_files(root_dir):
+        try:
+            rewrite_page(filepath, images, formats, dry_run)
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+
+    source_bytes = sum(os.path.getsize(os.path.join(root_dir, path.lstrip('/'))) for path in images)
+    derived_bytes = sum(os.path.getsize(os.path.join(root_dir, derivative_path(info['hash'], w, formats[0])))
+                        for info in images.values() for w in target_widths(info['width']))
+    print(f"\nOriginals: {source_bytes:,} bytes. {formats[0].upper()} derivatives at every width: {derived_bytes:,} bytes.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build width-stepped WebP/AVIF images and point pages at them with srcset.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--format', choices=sorted(QUALITY), default='webp',
+                        help="Format of the derivatives. AVIF is smaller but has no fallback in a plain srcset.")
+    parser.add_argument('--jobs', '-j', type=int, default=0, help="Worker processes for encoding (0 = one per CPU).")
+    parser.add_argument('--dry-run', action='store_true', help="Build derivatives but do not rewrite any page.")
+    args = parser.parse_args(argv)
+    make_responsive(args.root, formats=(args.format,), jobs=args.jobs, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+import argparse
+import asyncio
+import json
+import os
+import posixpath
+import re
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+import html_stream
+from asset_refs import embedded_refs, html_refs, resolve_ref
+from extract_server_data import SHARED_PREFIX, entry_page_id, find_server_data, to_json
+from snippets import page_url
+
+SITEMAP_LOC = re.compile(r'<loc>\s*([^<\s]+)\s*</loc>')
+
+# The connections a browser opens to one host.
+CONNECTIONS_PER_VIEW = 6
+
+# References a browser fetches while loading a page; <a href> and other
+# page links only load when followed.
+FETCHED_KINDS = {'src', 'srcset', 'poster', 'style'}
+FETCHED_LINKS = {'stylesheet', 'modulepreload', 'preload', 'icon', 'apple-touch-icon', 'shortcut icon'}
+
+
+class Response:
+
+    def __init__(self, status, headers, size, latency):
+        self.status = status
+        self.headers = headers
+        self.size = size
+        self.latency = latency
+
+
+class Connection:
+    """
+    One keep-alive HTTP/1.1 connection, enough of a client to time
+    requests and count body bytes without decoding them.
+    """
+
+    def __init__(self, host, port, host_header):
+        self.host = host
+        self.port = port
+        self.host_header = host_header
+        self.reader = self.writer = None
+
+    async def request(self, path, headers=()):
+        started = time.perf_counter()
+        for attempt in (0, 1):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            lines = [f"GET {path} HTTP/1.1", f"Host: {self.host_header}", "Accept-Encoding: gzip, br",
+                     "User-Agent: load_test.py"] + [f"{name}: {value}" for name, value in headers]
+            try:
+                self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                await self.writer.drain()
+                status, response_headers, size = await self.read_response()
+                return Response(status, response_headers, size, time.perf_counter() - started)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                # The server closed an idle connection: retry once on a new one.
+                self.close()
+                if attempt:
+                    raise
+
+    async def read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        size = 0
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                length = int((await self.reader.readline()).split(b';')[0], 16)
+                if length == 0:
+                    await self.reader.readline()
+                    break
+                size += len(await self.reader.readexactly(length + 2)) - 2
+        elif 'content-length' in headers:
+            size = int(headers['content-length'])
+            await self.reader.readexactly(size)
+        elif status not in (204, 304):
+            size = len(await self.reader.read())
+            self.close()
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, headers, size
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def sitemap_paths(root_dir):
+    """
+    Returns the paths of the pages listed in sitemap.xml, without the host
+    the sitemap was written for.
+    """
+    path = os.path.join(root_dir, 'sitemap.xml')
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    paths = []
+    for url in SITEMAP_LOC.findall(text):
+        page = urlsplit(url).path or '/'
+        if page not in paths:
+            paths.append(page)
+    return paths
+
+
+def read_state(root_dir, src):
+    path = os.path.join(root_dir, src.lstrip('/'))
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        return json.loads(text[text.index('=') + 1:].strip().rstrip(';'))
+    except ValueError:
+        return None
+
+
+def page_widgets(root_dir, data, page_path):
+    """
+    Returns the widgets of the project page served at page_path: from the
+    inline ServerData, the inline copy a split page keeps, or its
+    dist/pages fragment. The state lists every page of the project, but a
+    view only loads the images of its own. Returns [] when the page is not
+    in the state.
+    """
+    found = find_server_data(data)
+    state, inline = found[2] if found else None, {}
+    for token in html_stream.iter_tags(data):
+        if not isinstance(token, html_stream.StartTag) or token.name != 'script':
+            continue
+        src = token.get('src') or ''
+        if state is None and os.path.basename(src).startswith(SHARED_PREFIX):
+            state = read_state(root_dir, src)
+        elif not src and token.content_end is not None and token.content.startswith(b'window.ServerDataPages='):
+            text = token.content.decode('utf-8')
+            inline, _ = json.JSONDecoder().raw_decode(text, len('window.ServerDataPages='))
+    mag = state.get('mags', {}).get('mag', {}) if isinstance(state, dict) else {}
+    pages = [p for p in mag.get('pages') or [] if isinstance(p, dict) and p.get('_id')]
+    page_id = next((p['_id'] for p in pages if page_url(p) == page_path), None) or \
+        entry_page_id(root_dir, os.path.join(root_dir, page_path.lstrip('/')), pages)
+    page = next((p for p in pages if p['_id'] == page_id), None)
+    if page is None:
+        return []
+    if isinstance(page.get('wids'), list):
+        return page['wids']
+    if page_id in inline:
+        return inline[page_id]
+    if page.get('widsUrl'):
+        return load_fragment(root_dir, page['widsUrl'])
+    return []
+
+
+def load_fragment(root_dir, url):
+    path = os.path.join(root_dir, url.lstrip('/'))
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def page_requests(root_dir, data, page_path):
+    """
+    Returns the paths a browser loading this page would fetch from the
+    site, in document order: stylesheets, module preloads, scripts,
+    images and the ServerData paths of the widgets on the page itself.
+    page_path is the URL the page was served at.
+    """
+    paths = []
+    base = posixpath.join(page_path, 'index.html') if page_path.endswith('/') else page_path
+
+    def add(url, base):
+        target = resolve_ref(url, base)
+        if target and target not in paths:
+            paths.append(target)
+
+    links = {}
+    for token in html_stream.iter_tags(data):
+        if isinstance(token, html_stream.StartTag) and token.name == 'link' and token.has('href'):
+            links[token.get('href')] = (token.get('rel') or '').lower()
+    for start, end, url, kind in html_refs(data):
+        if kind in FETCHED_KINDS or (kind == 'href' and links.get(url) in FETCHED_LINKS):
+            add(url, base)
+    # Paths quoted outside the state, then those of the page's own widgets.
+    rest, pos = [], 0
+    for token in html_stream.iter_tags(data):
+        if isinstance(token, html_stream.StartTag) and token.name == 'script' and not token.has('src') \
+                and token.content_end is not None and b'window.ServerData' in token.content:
+            rest.append(data[pos:token.end])
+            pos = token.content_end
+    rest.append(data[pos:])
+    for start, end, url in embedded_refs(b''.join(rest)):
+        add(url, '/')
+    for start, end, url in embedded_refs(to_json(page_widgets(root_dir, data, page_path)).encode('utf-8')):
+        add(url, '/')
+    return paths
+
+
+async def crawl(connection, pages, root_dir):
+    """
+    Fetches every page once and returns {page: [paths]}, the request mix
+    of one view, with the segments of each HLS playlist it plays.
+    """
+    mix = {}
+    playlists = {}
+    for page in pages:
+        paths = [page]
+        status, location, data = await fetch_body(connection, page)
+        # A view starts with the redirects the server answers the sitemap URL with.
+        while location and len(paths) < 5:
+            paths.append(resolve_ref(location, paths[-1]) or location)
+            status, location, data = await fetch_body(connection, paths[-1])
+        paths += [p for p in page_requests(root_dir, data, paths[-1]) if p not in paths]
+        for path in list(paths):
+            if path.endswith('.m3u8'):
+                if path not in playlists:
+                    status, location, playlist = await fetch_body(connection, path)
+                    playlists[path] = [resolve_ref(line, path) for line in playlist.decode('utf-8', 'replace').split()
+                                       if line and not line.startswith('#')]
+                paths.extend(p for p in playlists[path] if p and p not in paths)
+        mix[page] = paths
+        print(f"  - {page}: {len(paths)} request(s)")
+    return mix
+
+
+async def fetch_body(connection, path):
+    """
+    Fetches path without compression and returns (status, Location header
+    of a redirect, body bytes).
+    """
+    if connection.writer is None:
+        connection.reader, connection.writer = await asyncio.open_connection(connection.host, connection.port)
+    request = f"GET {path} HTTP/1.1\r\nHost: {connection.host_header}\r\nConnection: close\r\n\r\n"
+    connection.writer.write(request.encode('latin-1'))
+    await connection.writer.drain()
+    raw = await connection.reader.read()
+    connection.close()
+    head, _, body = raw.partition(b'\r\n\r\n')
+    status = int(head.split(None, 2)[1])
+    location = re.search(rb'(?im)^location:\s*(\S+)', head) if 300 <= status < 400 else None
+    if b'transfer-encoding: chunked' in head.lower():
+        out, pos = bytearray(), 0
+        while True:
+            line_end = body.index(b'\r\n', pos)
+            length = int(body[pos:line_end].split(b';')[0], 16)
+            if length == 0:
+                break
+            out += body[line_end + 2:line_end + 2 + length]
+            pos = line_end + 4 + length
+        body = bytes(out)
+    return status, location.group(1).decode('latin-1') if location else None, body
+
+
+class Phase:
+    """
+    The measurements of one phase of the run.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.view_times = []
+        self.view_bytes = []
+        self.bytes = 0
+        self.statuses = {}
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def summary(self):
+        requests = len(self.latencies)
+        return {
+            'requests': requests,
+            'errors': self.errors,
+            'statuses': {str(k): v for k, v in sorted(self.statuses.items())},
+            'elapsed_s': round(self.elapsed, 3),
+            'requests_per_s': round(requests / self.elapsed, 1) if self.elapsed else 0,
+            'mb_per_s': round(self.bytes / self.elapsed / 1e6, 2) if self.elapsed else 0,
+            'latency_ms': percentiles(self.latencies),
+            'page_views': len(self.view_times),
+            'page_view_ms': percentiles(self.view_times),
+            'bytes_per_page_view': round(sum(self.view_bytes) / len(self.view_bytes)) if self.view_bytes else 0,
+        }
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 2)
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(ordered[-1] * 1000, 2)}
+
+
+async def page_view(connections, paths, phase, etags=None):
+    """
+    Loads one page the way a browser does: the HTML, then its
+    subresources spread over the connections. With etags, repeat visits
+    revalidate what the client kept and the server can answer 304.
+    """
+    started = time.perf_counter()
+    received = 0
+
+    async def fetch(connection, path):
+        nonlocal received
+        headers = [('If-None-Match', etags[path])] if etags is not None and path in etags else []
+        try:
+            response = await connection.request(path, headers)
+        except Exception:
+            phase.errors += 1
+            return
+        phase.latencies.append(response.latency)
+        phase.statuses[response.status] = phase.statuses.get(response.status, 0) + 1
+        phase.bytes += response.size
+        received += response.size
+        if response.status >= 400:
+            phase.errors += 1
+        if etags is not None and 'etag' in response.headers:
+            etags[path] = response.headers['etag']
+
+    await fetch(connections[0], paths[0])
+    queue = list(paths[1:])
+
+    async def worker(connection):
+        while queue:
+            await fetch(connection, queue.pop(0))
+    await asyncio.gather(*(worker(c) for c in connections))
+    phase.view_times.append(time.perf_counter() - started)
+    phase.view_bytes.append(received)
+
+
+async def run_phase(name, views, mix, target, users, revalidate=False):
+    """
+    Replays views (a list of pages) with users concurrent visitors, each
+    with its own connections and, when revalidating, its own cache.
+    """
+    phase = Phase(name)
+    queue = list(views)
+    host, port, host_header = target
+    visitors = [([Connection(host, port, host_header) for _ in range(CONNECTIONS_PER_VIEW)], {} if revalidate else None)
+                for _ in range(users)]
+    if revalidate:
+        # Fill each visitor's cache first: only the repeat visits count.
+        warmup = Phase('warmup')
+        for connections, etags in visitors:
+            for page in mix:
+                await page_view(connections, mix[page], warmup, etags)
+
+    async def visit(connections, etags):
+        while queue:
+            await page_view(connections, mix[queue.pop(0)], phase, etags)
+        for c in connections:
+            c.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(visit(connections, etags) for connections, etags in visitors))
+    phase.elapsed = time.perf_counter() - started
+    return phase
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(root_dir, rules):
+    """
+    Starts dev_server.py on a free port and returns (process, port) once
+    it accepts connections.
+    """
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dev_server.py')
+    process = subprocess.Popen([sys.executable, script, root_dir, '--rules', rules, '--port', str(port), '--quiet'],
+                               stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("dev_server.py did not start")
+
+
+def print_phase(summary, name):
+    latency, views = summary['latency_ms'], summary['page_view_ms']
+    print(f"\n{name}: {summary['requests']:,} request(s) in {summary['elapsed_s']:.2f}s, "
+          f"{summary['requests_per_s']:,.0f} req/s, {summary['mb_per_s']:,.1f} MB/s, {summary['errors']} error(s)")
+    if latency:
+        print(f"  - latency p50 {latency['p50']} ms, p90 {latency['p90']} ms, p99 {latency['p99']} ms, "
+              f"max {latency['max']} ms")
+    if views:
+        print(f"  - page view p50 {views['p50']} ms, p90 {views['p90']} ms, "
+              f"{summary['bytes_per_page_view'] / 1024:,.0f} KB per view")
+    print(f"  - statuses: {', '.join(f'{k}: {v}' for k, v in summary['statuses'].items())}")
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline.get('label') or 'no label'}):")
+    for name, summary in results['phases'].items():
+        old = baseline.get('phases', {}).get(name)
+        if not old:
+            continue
+        for key, label in (('requests_per_s', 'req/s'), ('bytes_per_page_view', 'bytes/view')):
+            if old.get(key):
+                print(f"  - {name} {label}: {old[key]:,} -> {summary[key]:,} ({summary[key] / old[key] - 1:+.0%})")
+        for key in ('p50', 'p99'):
+            if old['latency_ms'].get(key):
+                change = summary['latency_ms'][key] / old['latency_ms'][key] - 1
+                print(f"  - {name} latency {key}: {old['latency_ms'][key]} -> {summary['latency_ms'][key]} ms "
+                      f"({change:+.0%})")
+
+
+async def crawl_site(root_dir, target):
+    pages = sitemap_paths(root_dir)
+    print(f"Crawling {len(pages)} page(s) from sitemap.xml:")
+    mix = await crawl(Connection(*target), pages, root_dir)
+    print(f"{sum(len(paths) for paths in mix.values())} request(s) per pass over the site.")
+    return mix
+
+
+async def replay(mix, target, users, rounds):
+    phases = {}
+    # The first pass meets every file for the first time in the server's cache.
+    phases['cold'] = await run_phase('cold', list(mix), mix, target, users)
+    phases['warm'] = await run_phase('warm', list(mix) * rounds, mix, target, users)
+    phases['revisit'] = await run_phase('revisit', list(mix) * rounds, mix, target, users, revalidate=True)
+    return {name: phase.summary() for name, phase in phases.items()}
+
+
+def server_target(url):
+    parts = urlsplit(url)
+    return parts.hostname, parts.port or 80, parts.netloc
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay page views from sitemap.xml against a server and time them.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--url', help="Server to test, like http://127.0.0.1:8000 (default: start dev_server.py).")
+    parser.add_argument('--rules', default='nginx', help="Rules for the dev_server.py started without --url.")
+    parser.add_argument('--users', type=int, default=8, help="Concurrent visitors (default: 8).")
+    parser.add_argument('--rounds', type=int, default=3, help="Passes over the site in the warm phases (default: 3).")
+    parser.add_argument('--label', default='', help="Name of this build or optimization stage, saved in the JSON.")
+    parser.add_argument('--output', '-o', help="Save the results as JSON here.")
+    parser.add_argument('--compare', metavar='JSON', help="Show the change against results saved earlier.")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        target = server_target(args.url)
+        mix = asyncio.run(crawl_site(args.root, target))
+        print("Note: the cold phase is only cold if the server was started just before this run.")
+        phases = asyncio.run(replay(mix, target, args.users, args.rounds))
+    else:
+        # Crawl, then start a fresh server so the cold phase meets an empty cache.
+        process, port = start_server(args.root, args.rules)
+        try:
+            mix = asyncio.run(crawl_site(args.root, server_target(f"http://127.0.0.1:{port}")))
+        finally:
+            process.terminate()
+            process.wait()
+        process, port = start_server(args.root, args.rules)
+        try:
+            phases = asyncio.run(replay(mix, server_target(f"http://127.0.0.1:{port}"), args.users, args.rounds))
+        finally:
+            process.terminate()
+            process.wait()
+
+    results = {'label': args.label, 'url': args.url or f"dev_server.py --rules {args.rules}",
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'users': args.users, 'rounds': args.rounds,
+               'pages': {page: len(paths) for page, paths in mix.items()}, 'phases': phases}
+    for name, summary in phases.items():
+        print_phase(summary, name)
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+        print(f"\nResults saved to {args.output}.")
+    return 1 if any(summary['errors'] for summary in phases.values()) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
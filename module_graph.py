@@ -0,0 +1,126 @@
+import json
+import os
+import posixpath
+import re
+import html_stream
+
+# import x from "a", import "a", export {x} from "a" -- as minified by the bundler.
+STATIC_IMPORT = re.compile(rb'''(?:\bimport|\bexport)\s*(?:[\w$*{}\s,]*?\bfrom\s*)?["']([^"'\s]+)["']''')
+DYNAMIC_IMPORT = re.compile(rb'''\bimport\(\s*["']([^"'\s]+)["']\s*\)''')
+
+
+class Module:
+    """
+    One JavaScript file of the site, as a path from the site root, with the
+    modules it imports statically and the ones it only loads with import().
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.imports = []
+        self.dynamic_imports = []
+
+
+def load_import_map(data):
+    """
+    Returns the "imports" mapping of the first <script type="importmap"> in
+    the page bytes, or {} when there is none.
+    """
+    for token in html_stream.iter_tags(data):
+        if isinstance(token, html_stream.StartTag) and token.name == 'script' and token.get('type') == 'importmap':
+            try:
+                return json.loads(token.content.decode('utf-8')).get('imports', {})
+            except ValueError:
+                return {}
+    return {}
+
+
+def resolve(specifier, base_path, import_map=None):
+    """
+    Resolves an import specifier found in the module at base_path to a path
+    from the site root, like '/dist/c/c-X.js'. Returns None for modules that
+    live on another host.
+    """
+    for prefix, target in sorted((import_map or {}).items(), key=lambda item: -len(item[0])):
+        if prefix.endswith('/') and specifier.startswith(prefix):
+            specifier = target + specifier[len(prefix):]
+            break
+        if specifier == prefix:
+            specifier = target
+            break
+    if specifier.startswith(('./', '../')):
+        specifier = posixpath.join(posixpath.dirname(base_path), specifier)
+    if not specifier.startswith('/') or specifier.startswith('//'):
+        return None
+    return posixpath.normpath(specifier)
+
+
+def import_spans(source):
+    """
+    Yields (start, end, specifier, dynamic) for every import specifier in
+    JavaScript source bytes, with the byte offsets of the specifier text.
+    """
+    for pattern, dynamic in ((STATIC_IMPORT, False), (DYNAMIC_IMPORT, True)):
+        for match in pattern.finditer(source):
+            yield match.start(1), match.end(1), match.group(1).decode('utf-8', 'replace'), dynamic
+
+
+def scan_imports(source):
+    """
+    Returns the static and dynamic import specifiers found in JavaScript
+    source bytes, in the order they appear.
+    """
+    static, dynamic = [], []
+    for start, end, specifier, is_dynamic in import_spans(source):
+        (dynamic if is_dynamic else static).append(specifier)
+    return static, dynamic
+
+
+def build_graph(root_dir, entries, import_map=None):
+    """
+    Follows static and dynamic imports from the entry module paths and
+    returns {path: Module} for every module found on disk.
+    """
+    graph = {}
+    queue = list(entries)
+    while queue:
+        path = queue.pop(0)
+        if path in graph:
+            continue
+        filepath = os.path.join(root_dir, path.lstrip('/'))
+        if not os.path.isfile(filepath):
+            continue
+        with open(filepath, 'rb') as f:
+            source = f.read()
+        module = graph[path] = Module(path, len(source))
+        static, dynamic = scan_imports(source)
+        for specifiers, targets in ((static, module.imports), (dynamic, module.dynamic_imports)):
+            for specifier in specifiers:
+                resolved = resolve(specifier, path, import_map)
+                if resolved and resolved not in targets:
+                    targets.append(resolved)
+                    queue.append(resolved)
+    return graph
+
+
+def static_depths(graph, entries):
+    """
+    Returns {path: depth} for every module the entries pull in through
+    static imports alone, where depth is the longest import chain from an
+    entry. These are the modules a page cannot run without.
+    """
+    depths = {}
+
+    def visit(path, depth, chain):
+        if path not in graph or path in chain or depths.get(path, -1) >= depth:
+            return
+        depths[path] = depth
+        chain.add(path)
+        for child in graph[path].imports:
+            visit(child, depth + 1, chain)
+        chain.discard(path)
+
+    for entry in entries:
+        visit(entry, 0, set())
+    return depths
@@ -0,0 +1,413 @@
+import argparse
+import glob
+import io
+import math
+import os
+import posixpath
+import re
+import html_stream
+from extract_server_data import find_server_data, to_json
+from fix_pipeline import find_html_files
+from snippets import load_state
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+VIDEO_DIR = 'videos'
+PLAYLIST_NAME = 'playlist.m3u8'
+POSTER_NAME = 'poster.jpg'
+PACKED_NAME = 'media.ts'
+
+# Posters are built at this multiple of the widest box they are shown in,
+# for high-density screens, and never wider than the original.
+POSTER_SCALE = 2
+POSTER_QUALITY = 80
+POSTER_DERIVATIVE = re.compile(r'^poster-\d+w\.webp$')
+
+# Playlists with a shorter target duration than this cost a request for
+# every second or two of video.
+MIN_TARGET_DURATION = 4
+TARGET_DURATION = 6
+
+TS_PACKET = 188
+TS_SYNC = 0x47
+
+# The only tags a playlist may use for repack to rewrite it; anything else,
+# like discontinuities or keys, is left alone.
+HEADER_TAGS = {'#EXTM3U', '#EXT-X-VERSION', '#EXT-X-TARGETDURATION', '#EXT-X-MEDIA-SEQUENCE',
+               '#EXT-X-PLAYLIST-TYPE', '#EXT-X-INDEPENDENT-SEGMENTS', '#EXT-X-ENDLIST'}
+
+# Markup that fetches video data before the video is played.
+VIDEO_PRELOAD_RELS = {'preload', 'prefetch', 'modulepreload'}
+
+
+def find_playlists(root_dir):
+    return sorted(glob.glob(os.path.join(root_dir, VIDEO_DIR, '*', PLAYLIST_NAME)))
+
+
+def parse_playlist(text):
+    """
+    Parses a media playlist into (tags, segments): tags maps each header
+    tag to its value, segments lists {'duration', 'uri', 'byterange'} in
+    order. Raises ValueError for a tag repack does not handle.
+    """
+    tags, segments = {}, []
+    duration, byterange = None, None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            byterange = line[len('#EXT-X-BYTERANGE:'):]
+        elif line.startswith('#EXT'):
+            name, _, value = line.partition(':')
+            if name not in HEADER_TAGS:
+                raise ValueError(f"uses {name}, which repacking does not handle")
+            tags[name] = value
+        elif not line.startswith('#'):
+            if duration is None:
+                raise ValueError(f"segment {line} has no #EXTINF")
+            segments.append({'duration': duration, 'uri': line, 'byterange': byterange})
+            duration, byterange = None, None
+    return tags, segments
+
+
+def audit_playlist(root_dir, path):
+    """
+    Prints what a player has to fetch for one playlist and returns
+    (tags, segments, total bytes), or None if it cannot be read.
+    """
+    folder = os.path.dirname(path)
+    print(f"\nProcessing: {os.path.relpath(path, root_dir)}")
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            tags, segments = parse_playlist(f.read())
+    except (OSError, ValueError) as e:
+        print(f"  - ERROR processing file {path}: {e}")
+        return None
+    files = {segment['uri'] for segment in segments}
+    total = sum(os.path.getsize(os.path.join(folder, uri)) for uri in files
+                if os.path.exists(os.path.join(folder, uri)))
+    target = int(tags.get('#EXT-X-TARGETDURATION') or 0)
+    duration = sum(segment['duration'] for segment in segments)
+    print(f"  - {duration:.1f}s in {len(segments)} segment(s) from {len(files)} file(s), "
+          f"target duration {target}s, {total:,} bytes.")
+    if len(segments) > 1 and target < MIN_TARGET_DURATION:
+        print(f"  - Short target duration: one request for every {target}s of video.")
+    poster = os.path.join(folder, POSTER_NAME)
+    if os.path.exists(poster):
+        print(f"  - Poster: {os.path.getsize(poster):,} bytes.")
+    return tags, segments, total
+
+
+def group_segments(segments, target):
+    """
+    Splits the segments into runs of at least target seconds, in order.
+    A short last run is folded into the one before it.
+    """
+    groups, current = [], []
+    for segment in segments:
+        current.append(segment)
+        if sum(s['duration'] for s in current) >= target:
+            groups.append(current)
+            current = []
+    if current:
+        if groups and sum(s['duration'] for s in current) < target / 2:
+            groups[-1].extend(current)
+        else:
+            groups.append(current)
+    return groups
+
+
+def check_ts(data, uri):
+    if len(data) % TS_PACKET or not data or data[0] != TS_SYNC:
+        raise ValueError(f"{uri} is not a whole MPEG-TS stream")
+
+
+def repack_playlist(root_dir, path, tags, segments, target=TARGET_DURATION, dry_run=False):
+    """
+    Joins the segments of one playlist into a single file and rewrites the
+    playlist to address runs of them with EXT-X-BYTERANGE, each run at least
+    target seconds long. Segments start on keyframes with their own PAT and
+    PMT, so every run still starts where a player can begin decoding. The
+    old segment files are removed once the new playlist is in place.
+    """
+    folder = os.path.dirname(path)
+    if any(segment['byterange'] for segment in segments):
+        print("  - Already addressed by byte range, nothing to repack.")
+        return False
+    groups = group_segments(segments, target)
+    if len(groups) >= len(segments):
+        print(f"  - Runs of {target}s would not save a request, nothing to repack.")
+        return False
+
+    packed, lines, offset = io.BytesIO(), [], 0
+    for group in groups:
+        start = offset
+        for segment in group:
+            with open(os.path.join(folder, segment['uri']), 'rb') as f:
+                data = f.read()
+            check_ts(data, segment['uri'])
+            packed.write(data)
+            offset += len(data)
+        lines += [f"#EXTINF:{sum(s['duration'] for s in group):.6f},",
+                  f"#EXT-X-BYTERANGE:{offset - start}@{start}", PACKED_NAME]
+    longest = max(sum(s['duration'] for s in group) for group in groups)
+    # Byte ranges need protocol version 4.
+    header = ["#EXTM3U", "#EXT-X-VERSION:4", f"#EXT-X-TARGETDURATION:{math.ceil(longest)}",
+              f"#EXT-X-MEDIA-SEQUENCE:{tags.get('#EXT-X-MEDIA-SEQUENCE') or 0}"]
+    header += [f"{name}:{tags[name]}" if tags[name] else name
+               for name in ('#EXT-X-PLAYLIST-TYPE', '#EXT-X-INDEPENDENT-SEGMENTS') if name in tags]
+    text = '\n'.join(header + lines + ["#EXT-X-ENDLIST"]) + '\n'
+    print(f"  - {len(segments)} segment(s) -> {len(groups)} byte range(s) of {PACKED_NAME}, "
+          f"target duration {math.ceil(longest)}s.")
+    if dry_run:
+        print(f"  - Dry run, changes not saved to {PLAYLIST_NAME}.")
+        return True
+
+    html_stream.write_atomic(os.path.join(folder, PACKED_NAME), packed.getvalue())
+    html_stream.write_atomic(path, text.encode('utf-8'))
+    for uri in sorted({segment['uri'] for segment in segments} - {PACKED_NAME}):
+        os.remove(os.path.join(folder, uri))
+    print(f"  - Changes saved to {PLAYLIST_NAME}.")
+    return True
+
+
+def poster_source(uri):
+    """
+    The original poster behind a poster URL, which may already point at a
+    derivative of it. Returns a path from the site root, or None for a
+    poster outside videos/.
+    """
+    path = '/' + uri.lstrip('/')
+    if not path.startswith(f"/{VIDEO_DIR}/"):
+        return None
+    if POSTER_DERIVATIVE.match(posixpath.basename(path)):
+        return posixpath.join(posixpath.dirname(path), POSTER_NAME)
+    return path
+
+
+def poster_boxes(state):
+    """
+    Returns {original poster path: (width, height)} with the largest box
+    each poster is shown in by a video widget, across every viewport.
+    """
+    boxes = {}
+
+    def walk(node):
+        if isinstance(node, dict):
+            source = poster_source(node['posterUri']) if isinstance(node.get('posterUri'), str) else None
+            if node.get('type') == 'video' and source:
+                for view in [node] + [v for k, v in node.items() if k.startswith('viewport_') and isinstance(v, dict)]:
+                    w, h = view.get('w'), view.get('h')
+                    if isinstance(w, (int, float)) and isinstance(h, (int, float)):
+                        old_w, old_h = boxes.get(source, (0, 0))
+                        boxes[source] = (max(old_w, w), max(old_h, h))
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(state)
+    return boxes
+
+
+def build_poster(root_dir, source, box):
+    """
+    Writes the WebP poster for one video, big enough to cover box at
+    POSTER_SCALE, next to the original. Returns its path from the site
+    root, or None when the original is missing.
+    """
+    filepath = os.path.join(root_dir, source.lstrip('/'))
+    if not os.path.exists(filepath):
+        return None
+    with Image.open(filepath) as image:
+        image.load()
+        width, height = image.size
+        # Videos fill their box like object-fit: cover.
+        scale = max(box[0] / width, box[1] / height) * POSTER_SCALE
+        target = min(width, max(1, math.ceil(width * scale)))
+        path = posixpath.join(posixpath.dirname(source), f"poster-{target}w.webp")
+        out_path = os.path.join(root_dir, path.lstrip('/'))
+        if not os.path.exists(out_path):
+            resized = image.convert('RGB')
+            if target < width:
+                resized = resized.resize((target, max(1, round(height * target / width))), Image.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, 'WEBP', quality=POSTER_QUALITY)
+            html_stream.write_atomic(out_path, buffer.getvalue())
+            print(f"  - {source} ({os.path.getsize(filepath):,} bytes) -> {path} "
+                  f"({len(buffer.getvalue()):,} bytes) for a {round(box[0])}x{round(box[1])} box.")
+    return path
+
+
+def build_posters(root_dir):
+    """
+    Builds a poster for every video widget at the size it is shown, drops
+    the ones no widget uses any more, and returns {original poster path:
+    derivative path}.
+    """
+    state = load_state(root_dir)
+    if state is None:
+        print("Error: no ServerData found, neither inline nor in a shared state file.")
+        return {}
+    print("\nBuilding posters:")
+    posters = {}
+    for source, box in sorted(poster_boxes(state).items()):
+        try:
+            path = build_poster(root_dir, source, box)
+        except Exception as e:
+            print(f"  - ERROR processing file {source}: {e}")
+            continue
+        if path:
+            posters[source] = path
+    in_use = {os.path.normpath(os.path.join(root_dir, path.lstrip('/'))) for path in posters.values()}
+    for filepath in sorted(glob.glob(os.path.join(root_dir, VIDEO_DIR, '*', 'poster-*w.webp'))):
+        if os.path.normpath(filepath) not in in_use:
+            os.remove(filepath)
+            print(f"  - Removed unused poster {os.path.relpath(filepath, root_dir)}.")
+    return posters
+
+
+def rewrite_posters(state, posters):
+    """
+    Points the posterUri of every video widget at its derivative. Returns
+    how many URLs changed.
+    """
+    changed = 0
+
+    def walk(node):
+        nonlocal changed
+        if isinstance(node, dict):
+            uri = node.get('posterUri')
+            if node.get('type') == 'video' and isinstance(uri, str):
+                path = posters.get(poster_source(uri))
+                if path and '/' + uri.lstrip('/') != path:
+                    # Keep the URL relative or absolute as it was written.
+                    node['posterUri'] = path if uri.startswith('/') else path.lstrip('/')
+                    changed += 1
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(state)
+    return changed
+
+
+def is_video_path(url):
+    return ('/' + (url or '').lstrip('/')).startswith(f"/{VIDEO_DIR}/")
+
+
+def rewrite_page(filepath, posters, dry_run=False):
+    """
+    Keeps video out of the way of first paint on one page: drops preloads
+    of anything under videos/, gives <video> elements preload="none",
+    lazy-loads poster images and points the video widgets in its inline
+    ServerData at the built posters.
+    """
+    print(f"\nProcessing: {filepath}")
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    edits = []
+    found = find_server_data(data, edits)
+
+    for token in html_stream.iter_tags(data, edits):
+        if not isinstance(token, html_stream.StartTag):
+            continue
+        if token.name == 'link' and VIDEO_PRELOAD_RELS & set((token.get('rel') or '').lower().split()) \
+                and is_video_path(token.get('href')):
+            token.remove()
+            print(f"  - Removed the preload of {token.get('href')}")
+        elif token.name == 'video':
+            if token.get('preload') != 'none':
+                token.set('preload', 'none')
+                print("  - Set preload=\"none\" on a <video>.")
+            poster = posters.get(poster_source(token.get('poster') or '') or '')
+            if poster and '/' + token.get('poster').lstrip('/') != poster:
+                token.set('poster', poster)
+                print(f"  - Pointed a <video> poster at {poster}")
+        elif token.name == 'img' and is_video_path(token.get('src')):
+            poster = posters.get(poster_source(token.get('src')) or '')
+            if poster and '/' + token.get('src').lstrip('/') != poster:
+                token.set('src', poster)
+                print(f"  - Pointed a poster image at {poster}")
+            for name, value in (('loading', 'lazy'), ('decoding', 'async')):
+                if token.get(name) != value:
+                    token.set(name, value)
+                    print(f"  - Set {name}=\"{value}\" on a poster image.")
+
+    if found and posters:
+        tag, prefix, state, suffix = found
+        changed = rewrite_posters(state, posters)
+        if changed:
+            body = f"{prefix}window.ServerData = {to_json(state).replace('</', '<' + chr(92) + '/')};{suffix}"
+            edits.append((tag.end, tag.content_end, body.encode('utf-8')))
+            print(f"  - Pointed {changed} ServerData poster URL(s) at the built posters.")
+    elif posters and b'window.ServerData' not in data:
+        print("  - No inline ServerData; run this before extract_server_data.py to rewrite widget posters too.")
+
+    if not edits:
+        print(f"  - No changes were made to {os.path.basename(filepath)}.")
+    elif dry_run:
+        print(f"  - Dry run, changes not saved to {os.path.basename(filepath)}.")
+    else:
+        html_stream.write_atomic(filepath, edits=edits, source=data)
+        print(f"  - Changes saved to {os.path.basename(filepath)}.")
+
+
+def optimize_videos(root_dir, repack=False, target=TARGET_DURATION, posters=False, dry_run=False):
+    playlists = find_playlists(root_dir)
+    print(f"Auditing {len(playlists)} playlist(s) in {VIDEO_DIR}/...")
+    repacked = 0
+    for path in playlists:
+        audit = audit_playlist(root_dir, path)
+        if audit is None or not repack:
+            continue
+        tags, segments, total = audit
+        try:
+            repacked += repack_playlist(root_dir, path, tags, segments, target, dry_run)
+        except (OSError, ValueError) as e:
+            print(f"  - ERROR processing file {path}: {e}")
+
+    built = {}
+    if posters:
+        if Image is None or not features.check('webp'):
+            print("Error: Pillow with WebP support is not installed (pip install pillow). No posters were built.")
+        elif dry_run:
+            print("\nDry run, no posters built.")
+        else:
+            built = build_posters(root_dir)
+
+    for filepath in find_html_files(root_dir):
+        try:
+            rewrite_page(filepath, built, dry_run)
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+    if repack:
+        print(f"\n{repacked} of {len(playlists)} playlist(s) repacked.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Audit the HLS videos, repack their segments, build posters at "
+                                                 "the size they are shown and keep video out of first paint.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--repack', action='store_true',
+                        help="Join each playlist's segments into one file addressed by byte ranges.")
+    parser.add_argument('--target-duration', type=int, default=TARGET_DURATION,
+                        help=f"Seconds of video per byte range when repacking (default: {TARGET_DURATION}).")
+    parser.add_argument('--posters', action='store_true', help="Build WebP posters at the size the widgets show.")
+    parser.add_argument('--dry-run', action='store_true', help="Report the changes without writing any file.")
+    args = parser.parse_args(argv)
+    optimize_videos(args.root, repack=args.repack, target=args.target_duration, posters=args.posters,
+                    dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
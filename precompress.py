@@ -0,0 +1,265 @@
+import argparse
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from fix_manifest import hash_bytes
+from server_config import (HTACCESS, NGINX_CONFIG, NGINX_SERVER_LEVEL, WEB_CONFIG, after_first, before_first,
+                           ensure_element, set_block, update_file)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = '.precompress.json'
+
+# Text formats worth compressing, with the Content-Type servers must send
+# for their sidecars.
+CONTENT_TYPES = {'.html': 'text/html', '.js': 'text/javascript', '.css': 'text/css',
+                 '.svg': 'image/svg+xml', '.json': 'application/json'}
+
+SIDECARS = ('.br', '.gz')
+SKIP_DIRS = {'.git'}
+
+# A sidecar that saves less than this is not worth the extra file.
+MIN_SAVING = 0.05
+
+
+def find_sources(root_dir, min_size):
+    """
+    Returns every compressible file under root_dir of at least min_size
+    bytes, plus every sidecar on disk.
+    """
+    sources, sidecars = [], []
+    for subdir, dirs, files in os.walk(root_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for filename in sorted(files):
+            filepath = os.path.join(subdir, filename)
+            base, ext = os.path.splitext(filename)
+            if ext in SIDECARS and os.path.splitext(base)[1] in CONTENT_TYPES:
+                sidecars.append(filepath)
+            elif ext in CONTENT_TYPES and not filename.startswith('.') and os.path.getsize(filepath) >= min_size:
+                sources.append(filepath)
+    return sources, sidecars
+
+
+def write_sidecar(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def compress_file(task):
+    """
+    Writes the .gz and .br sidecars of one file unless the manifest entry
+    shows they were made from the same content. Runs in a worker process.
+    Returns (filepath, manifest entry, reused) or (filepath, error, None).
+    """
+    filepath, entry, use_brotli = task
+    try:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        digest = hash_bytes(data)
+        wanted = ('gz', 'br') if use_brotli else ('gz',)
+        if entry and entry.get('hash') == digest and all(
+                kind in entry and (entry[kind] is None or os.path.exists(f"{filepath}.{kind}")) for kind in wanted):
+            return filepath, entry, True
+
+        entry = {'hash': digest, 'size': len(data)}
+        for kind in wanted:
+            if kind == 'gz':
+                compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            else:
+                compressed = brotli.compress(data, quality=11)
+            if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                write_sidecar(f"{filepath}.{kind}", compressed)
+                entry[kind] = len(compressed)
+            else:
+                entry[kind] = None
+                if os.path.exists(f"{filepath}.{kind}"):
+                    os.remove(f"{filepath}.{kind}")
+        return filepath, entry, False
+    except Exception as e:
+        return filepath, str(e) or type(e).__name__, None
+
+
+def load_manifest(root_dir):
+    path = os.path.join(root_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(root_dir, manifest):
+    path = os.path.join(root_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def nginx_rules(brotli_module):
+    """
+    gzip_static is built into nginx; brotli_static needs the ngx_brotli
+    module and stops nginx from starting without it, so it is only switched
+    on when asked for.
+    """
+    lines = "  gzip_static on;\n  gzip_vary on;\n"
+    if brotli_module:
+        lines += "  brotli_static on;\n"
+    else:
+        lines += "  # brotli_static on;  # needs the ngx_brotli module, see precompress.py --brotli-module\n"
+    return lines
+
+
+def nginx_precompress(brotli_module):
+    def update(text):
+        return set_block(text, 'precompressed', nginx_rules(brotli_module), indent='  ',
+                         insert_at=before_first(NGINX_SERVER_LEVEL))
+    return update
+
+
+def htaccess_precompress(text):
+    exts = '|'.join(ext.lstrip('.') for ext in CONTENT_TYPES)
+    lines = ["<IfModule mod_rewrite.c>"]
+    for sidecar, encoding in (('br', 'br'), ('gz', 'gzip')):
+        lines += [f"  RewriteCond %{{HTTP:Accept-Encoding}} {encoding}",
+                  f"  RewriteCond %{{REQUEST_FILENAME}}.{sidecar} -f",
+                  f"  RewriteRule ^(.+\\.({exts}))$ $1.{sidecar} [L]"]
+    for ext, content_type in CONTENT_TYPES.items():
+        lines.append(f"  RewriteRule \"\\{ext}\\.(br|gz)$\" \"-\" [T={content_type},E=no-gzip:1,E=no-brotli:1]")
+    lines.append("</IfModule>")
+    lines.append("<IfModule mod_headers.c>")
+    for sidecar, encoding in (('br', 'br'), ('gz', 'gzip')):
+        lines += [f"  <FilesMatch \"\\.({exts})\\.{sidecar}$\">",
+                  f"    Header set Content-Encoding {encoding}",
+                  "    Header append Vary Accept-Encoding",
+                  "  </FilesMatch>"]
+    lines.append("</IfModule>")
+    # Has to come before the page rewrites, which end with [L].
+    return set_block(text, 'precompressed', '\n'.join(lines) + '\n', insert_at=after_first(r'^RewriteBase'))
+
+
+def web_config_precompress(text):
+    exts = '|'.join(ext.lstrip('.') for ext in CONTENT_TYPES)
+    pad = ' ' * 16
+    inbound = ''
+    for sidecar, encoding in (('br', 'br'), ('gz', 'gzip')):
+        inbound += (f'{pad}<rule name="serve precompressed {sidecar}" stopProcessing="true">\n'
+                    f'{pad}    <match url="^(.+\\.({exts}))$" ignoreCase="false"/>\n'
+                    f'{pad}    <conditions logicalGrouping="MatchAll">\n'
+                    f'{pad}        <add input="{{HTTP_ACCEPT_ENCODING}}" pattern="{encoding}"/>\n'
+                    f'{pad}        <add input="{{REQUEST_FILENAME}}.{sidecar}" matchType="IsFile"/>\n'
+                    f'{pad}    </conditions>\n'
+                    f'{pad}    <action type="Rewrite" url="{{R:1}}.{sidecar}"/>\n'
+                    f'{pad}</rule>\n')
+    outbound = ''
+    for sidecar, encoding in (('br', 'br'), ('gz', 'gzip')):
+        outbound += (f'{pad}<rule name="content encoding of {sidecar} sidecars">\n'
+                     f'{pad}    <match serverVariable="RESPONSE_Content_Encoding" pattern=".*"/>\n'
+                     f'{pad}    <conditions><add input="{{URL}}" pattern="\\.({exts})\\.{sidecar}$"/></conditions>\n'
+                     f'{pad}    <action type="Rewrite" value="{encoding}"/>\n'
+                     f'{pad}</rule>\n')
+    for ext, content_type in CONTENT_TYPES.items():
+        outbound += (f'{pad}<rule name="content type of {ext} sidecars">\n'
+                     f'{pad}    <match serverVariable="RESPONSE_Content_Type" pattern=".*"/>\n'
+                     f'{pad}    <conditions><add input="{{URL}}" pattern="\\{ext}\\.(br|gz)$"/></conditions>\n'
+                     f'{pad}    <action type="Rewrite" value="{content_type}"/>\n'
+                     f'{pad}</rule>\n')
+    mime_pad = ' ' * 12
+    mime = ''.join(f'{mime_pad}<remove fileExtension=".{sidecar}"/>\n'
+                   f'{mime_pad}<mimeMap fileExtension=".{sidecar}" mimeType="application/octet-stream"/>\n'
+                   for sidecar in ('br', 'gz'))
+
+    comment = ('<!-- ', ' -->')
+    # The sidecar rewrites must run before the page rewrites, which stop processing.
+    text = set_block(text, 'precompressed', inbound, comment=comment, indent=pad, insert_at=after_first(r'<rules>'))
+    text = ensure_element(text, 'outboundRules', r'</rules>', ' ' * 12)
+    text = set_block(text, 'precompressed encodings', outbound, comment=comment, indent=pad,
+                     insert_at=after_first(r'<outboundRules>'))
+    text = ensure_element(text, 'staticContent', r'</rewrite>', ' ' * 8)
+    return set_block(text, 'precompressed sidecars', mime, comment=comment, indent=mime_pad,
+                     insert_at=after_first(r'<staticContent>'))
+
+
+def write_server_rules(root_dir, brotli_module=False):
+    for name, update in ((NGINX_CONFIG, nginx_precompress(brotli_module)), (HTACCESS, htaccess_precompress),
+                         (WEB_CONFIG, web_config_precompress)):
+        if update_file(os.path.join(root_dir, name), update):
+            print(f"  - Precompressed file rules written to {name}.")
+        else:
+            print(f"  - {name} already has the precompressed file rules or does not exist.")
+
+
+def precompress(root_dir, min_size=1024, jobs=0, brotli_module=False):
+    """
+    Writes the sidecars of every text file. This has to be the last stage:
+    the other tools drop a file's sidecars when they rewrite it, but a
+    server only sends sidecars at all once they are here again.
+    """
+    use_brotli = brotli is not None
+    if not use_brotli:
+        print("Warning: the brotli package is not installed (pip install brotli). Only .gz sidecars will be written.")
+
+    sources, sidecars = find_sources(root_dir, min_size)
+    stale = [sidecar for sidecar in sidecars if os.path.exists(sidecar[:-3])
+             and os.path.getmtime(sidecar) < os.path.getmtime(sidecar[:-3])]
+    if stale:
+        print(f"Warning: {len(stale)} sidecar(s) are older than their file, which changed after the last run; "
+              f"run precompress.py after every other stage.")
+    manifest = load_manifest(root_dir)
+    keys = {filepath: os.path.relpath(filepath, root_dir).replace(os.sep, '/') for filepath in sources}
+    tasks = [(filepath, manifest.get(keys[filepath]), use_brotli) for filepath in sources]
+
+    print(f"Compressing {len(sources)} file(s) of at least {min_size:,} bytes...")
+    with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        results = list(executor.map(compress_file, tasks, chunksize=8))
+
+    new_manifest = {}
+    reused = 0
+    for filepath, entry, was_reused in results:
+        if was_reused is None:
+            print(f"  - ERROR processing file {filepath}: {entry}")
+            continue
+        new_manifest[keys[filepath]] = entry
+        reused += was_reused
+        gz, br = entry.get('gz'), entry.get('br')
+        ratios = ' '.join(f"{kind} {size:,} ({size / entry['size']:.0%})" for kind, size in (('gz', gz), ('br', br))
+                          if size is not None) or 'not worth compressing'
+        print(f"  - {keys[filepath]}: {entry['size']:,} -> {ratios}")
+
+    # Sidecars of files that were renamed, deleted or fell under the threshold.
+    removed = 0
+    wanted = {f"{filepath}.{kind}" for filepath in keys for kind in ('gz', 'br')}
+    for sidecar in sidecars:
+        if sidecar not in wanted:
+            os.remove(sidecar)
+            removed += 1
+    save_manifest(root_dir, new_manifest)
+
+    total = sum(e['size'] for e in new_manifest.values())
+    for kind in ('gz', 'br'):
+        compressed = sum(e[kind] if e.get(kind) is not None else e['size'] for e in new_manifest.values() if kind in e)
+        if any(kind in e for e in new_manifest.values()):
+            print(f"\n{kind}: {total:,} bytes -> {compressed:,} bytes ({compressed / total:.0%}).")
+    print(f"{len(results) - reused} file(s) compressed, {reused} reused, {removed} stale sidecar(s) removed.")
+    write_server_rules(root_dir, brotli_module)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write .gz and .br copies of text assets for servers to send as they are.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--min-size', type=int, default=1024, help="Skip files smaller than this many bytes.")
+    parser.add_argument('--jobs', '-j', type=int, default=0, help="Worker processes (0 = one per CPU).")
+    parser.add_argument('--brotli-module', action='store_true',
+                        help="Switch on brotli_static in the nginx config (needs ngx_brotli).")
+    args = parser.parse_args(argv)
+    precompress(args.root, min_size=args.min_size, jobs=args.jobs, brotli_module=args.brotli_module)
+
+
+if __name__ == "__main__":
+    main()
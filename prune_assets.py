@@ -0,0 +1,136 @@
+import argparse
+import fnmatch
+import os
+import shutil
+from ref_index import build_index, orphan_files
+
+# Assets nothing names in full. The viewer builds the paths of its sprites
+# and stubs at runtime (q(`./viewer/share/thumb-open${x}.png`)), and the
+# derivative index is the cache of image_derivatives.py.
+DEFAULT_KEEP = ('/dist/img/*', '/img/responsive/index.json')
+
+# Sidecars written by precompress.py travel with their source.
+SIDECARS = ('.gz', '.br')
+
+
+def default_target(root_dir):
+    root = os.path.abspath(root_dir)
+    return root.rstrip(os.sep) + '_pruned'
+
+
+def load_keep_file(path):
+    """
+    Returns the glob patterns in an allowlist file, one per line, skipping
+    blank lines and # comments.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def is_kept(path, patterns):
+    return any(fnmatch.fnmatchcase(path, '/' + pattern.lstrip('/')) for pattern in patterns)
+
+
+def move(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.move(source, target)
+
+
+def move_with_sidecars(root_dir, target_dir, path):
+    for suffix in ('',) + SIDECARS:
+        source = os.path.join(root_dir, path.lstrip('/')) + suffix
+        if os.path.exists(source):
+            move(source, os.path.join(target_dir, path.lstrip('/')) + suffix)
+
+
+def remove_empty_dirs(root_dir, paths):
+    for path in sorted({os.path.dirname(p) for p in paths}, key=len, reverse=True):
+        folder = os.path.join(root_dir, path.lstrip('/'))
+        while folder.rstrip(os.sep) != os.path.abspath(root_dir).rstrip(os.sep) and os.path.isdir(folder) \
+                and not os.listdir(folder):
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+
+
+def prune_assets(root_dir, target_dir=None, keep=(), dry_run=False):
+    """
+    Moves the files in dist/, img/ and videos/ that no served page reaches
+    out of the site into target_dir, keeping their paths so they can be put
+    back. Reachability follows everything ref_index.py knows: tags, CSS,
+    the module graph including import(), ServerData and HLS playlists.
+    """
+    target_dir = target_dir or default_target(root_dir)
+    patterns = DEFAULT_KEEP + tuple(keep)
+    index = build_index(root_dir)
+
+    pruned, kept = [], []
+    for path in orphan_files(index):
+        (kept if is_kept(path, patterns) else pruned).append(path)
+
+    size = sum(index.files[path] for path in pruned)
+    print(f"\n{len(pruned)} unreachable file(s), {size / 1024:,.0f} KB"
+          f"{' would be' if dry_run else ''} moved to {target_dir}:")
+    for path in pruned:
+        print(f"  - {path} ({index.files[path] / 1024:,.1f} KB)")
+    if kept:
+        print(f"\n{len(kept)} unreachable file(s) kept by the allowlist:")
+        for path in kept:
+            print(f"  - {path}")
+    if dry_run:
+        return pruned
+
+    moved = []
+    for path in pruned:
+        try:
+            move_with_sidecars(root_dir, target_dir, path)
+            moved.append(path)
+        except Exception as e:
+            print(f"  - ERROR processing file {path}: {e}")
+    remove_empty_dirs(root_dir, moved)
+    print(f"\n{len(moved)} file(s) moved. Run with --restore to put them back.")
+    return moved
+
+
+def restore_assets(root_dir, target_dir=None):
+    target_dir = target_dir or default_target(root_dir)
+    if not os.path.isdir(target_dir):
+        print(f"Nothing to restore: {target_dir} does not exist.")
+        return
+    restored = 0
+    for subdir, dirs, files in os.walk(target_dir):
+        for filename in files:
+            source = os.path.join(subdir, filename)
+            destination = os.path.join(root_dir, os.path.relpath(source, target_dir))
+            if os.path.exists(destination):
+                print(f"  - Skipped {destination}: a file with that name is back in the site.")
+                continue
+            move(source, destination)
+            restored += 1
+    for subdir, dirs, files in os.walk(target_dir, topdown=False):
+        if not os.listdir(subdir):
+            os.rmdir(subdir)
+    print(f"{restored} file(s) restored from {target_dir}.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move assets no page can reach out of the deploy tree.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--to', dest='target', help="Where to move the files (default: <root>_pruned next to the site).")
+    parser.add_argument('--keep', action='append', default=[], metavar='GLOB',
+                        help="Never prune paths matching GLOB, like /dist/c/c-*.js. Can be given several times.")
+    parser.add_argument('--keep-file', help="File of GLOBs to keep, one per line, for assets loaded dynamically.")
+    parser.add_argument('--dry-run', action='store_true', help="List what would be moved without moving it.")
+    parser.add_argument('--restore', action='store_true', help="Move previously pruned files back into the site.")
+    args = parser.parse_args(argv)
+
+    if args.restore:
+        restore_assets(args.root, args.target)
+        return
+    keep = list(args.keep)
+    if args.keep_file:
+        keep += load_keep_file(args.keep_file)
+    prune_assets(args.root, args.target, keep, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
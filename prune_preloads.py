@@ -0,0 +1,130 @@
+import argparse
+import io
+import os
+import re
+import sys
+import html_stream
+from fix_pipeline import find_html_files
+from module_graph import build_graph, load_import_map, static_depths
+
+WHITESPACE = re.compile(rb'\s*')
+
+
+def page_entries(data):
+    """
+    Returns the local module scripts a page starts from, as paths from the
+    site root, plus the <link rel="modulepreload"> tags it already has.
+    """
+    entries, preloads = [], []
+    for token in html_stream.iter_tags(data):
+        if not isinstance(token, html_stream.StartTag):
+            continue
+        if token.name == 'script' and token.get('type') == 'module' and token.get('src', '').startswith('/'):
+            entries.append((token.get('src'), token))
+        elif token.name == 'link' and token.get('rel') == 'modulepreload':
+            preloads.append(token)
+    return entries, preloads
+
+
+def critical_preloads(graph, entries, max_preloads=None):
+    """
+    Returns the modules on the static import path from the entries, deepest
+    first: those are the ones the browser would otherwise find last. The
+    entries themselves are left out since the page already loads them.
+    """
+    depths = static_depths(graph, entries)
+    modules = sorted((p for p in depths if p not in entries), key=lambda p: (-depths[p], p))
+    if max_preloads is not None:
+        modules = modules[:max_preloads]
+    return modules
+
+
+def prune_page(filepath, root_dir, graphs, default_entries, max_preloads=None, dry_run=False):
+    """
+    Rewrites the modulepreload links of one page to the critical set.
+    graphs caches the module graph per import map and entry list, since
+    most pages share both. Pages without a module script of their own use
+    default_entries, the ones of index.html whose <head> they carry.
+    """
+    print(f"\nProcessing: {filepath}")
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    entries, preloads = page_entries(data)
+    entry_paths = [path for path, tag in entries]
+    if not entry_paths:
+        if not preloads:
+            print("  - No module script or preloads, nothing to do.")
+            return 0, 0
+        entry_paths = default_entries
+        print(f"  - No module script of its own, using the entries of index.html: {', '.join(entry_paths) or 'none'}")
+
+    import_map = load_import_map(data)
+    key = (tuple(sorted(import_map.items())), tuple(entry_paths))
+    if key not in graphs:
+        graphs[key] = build_graph(root_dir, entry_paths, import_map)
+    graph = graphs[key]
+
+    modules = critical_preloads(graph, entry_paths, max_preloads)
+    block = '\n'.join(f'<link href="{path}" rel="modulepreload"/>' for path in modules).encode('utf-8')
+
+    edits = []
+    if preloads:
+        for index, tag in enumerate(preloads):
+            # Take the line break after the link with it, so no blank lines are left behind.
+            end = WHITESPACE.match(data, tag.end).end() if index else tag.end
+            edits.append((tag.start, end, block if index == 0 else b''))
+    elif block and entries:
+        start = entries[0][1].start
+        edits.append((start, start, block + b'\n'))
+
+    before = sum(graph[tag.get('href')].size for tag in preloads if tag.get('href') in graph)
+    after = sum(graph[path].size for path in modules)
+    print(f"  - {len(modules)} of {len(preloads)} module preload(s) kept, "
+          f"{after / 1024:,.0f} KB instead of {before / 1024:,.0f} KB fetched up front.")
+
+    out = io.BytesIO()
+    html_stream.apply_edits(data, edits, out)
+    new_data = out.getvalue()
+    if new_data == data:
+        print(f"  - No changes were made to {os.path.basename(filepath)}.")
+    elif not dry_run:
+        html_stream.write_atomic(filepath, new_data)
+        print(f"  - Changes saved to {os.path.basename(filepath)}.")
+    return before, after
+
+
+def prune_preloads(root_dir, max_preloads=None, dry_run=False):
+    # The depth walk recurses once per import in the longest chain.
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    graphs = {}
+    default_entries = []
+    index_path = os.path.join(root_dir, 'index.html')
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            default_entries = [path for path, tag in page_entries(f.read())[0]]
+
+    total_before = total_after = 0
+    for filepath in find_html_files(root_dir):
+        try:
+            before, after = prune_page(filepath, root_dir, graphs, default_entries, max_preloads, dry_run)
+        except Exception as e:
+            print(f"  - ERROR processing file {filepath}: {e}")
+            continue
+        total_before += before
+        total_after += after
+    print(f"\nPreloaded module bytes across all pages: {total_after / 1024:,.0f} KB, "
+          f"was {total_before / 1024:,.0f} KB.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Only preload the modules each page needs before it can run.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--max-preloads', type=int, default=None, metavar='N',
+                        help="Keep at most N preloads per page, deepest imports first.")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would change without writing anything.")
+    args = parser.parse_args(argv)
+    prune_preloads(args.root, max_preloads=args.max_preloads, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
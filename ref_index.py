@@ -0,0 +1,390 @@
+import argparse
+import json
+import os
+import posixpath
+import re
+import html_stream
+from asset_refs import css_refs, embedded_refs, html_refs, resolve_ref
+from fix_manifest import hash_bytes
+from fix_pipeline import LOCAL_ASSET_DIRS
+from module_graph import import_spans, load_import_map, resolve
+
+INDEX_NAME = '.ref_index.json'
+
+# Bump this whenever extract_refs finds something new, so every file is rescanned.
+INDEX_VERSION = 1
+
+SKIP_DIRS = {'.git', '__pycache__'}
+
+# Files next to a source that stand in for it rather than being referenced.
+SKIP_SUFFIXES = ('.gz', '.br', '.tmp')
+
+# The viewer asks for size variants of an image by adding these to the name
+# in ServerData (a_256.png, b_w-400.jpg, c_readyscr_512.jpg), so a reference
+# to the base name is satisfied by any of them.
+VARIANT_SUFFIX = re.compile(r'(?:_readyscr)?(?:_(?:w-)?\d+)?(?:_q-\d+)?$')
+
+# Links that only move between pages: they cost nothing until followed.
+NAVIGATION = {'href'}
+
+# Edges left out of a page's transfer weight: modules loaded on demand and
+# the segments of videos, which stream as they play.
+DEFERRED = {'dynamic', 'playlist'}
+
+# Paths named in ServerData. The viewer only fetches the ones on the page
+# being shown, so they are weighed apart from what the markup loads.
+STATE_KINDS = {'state'}
+
+STATE_FILE = re.compile(r'^/dist/(server-data\.[0-9a-f]+\.js|pages/.+\.json)$')
+PLAYLIST_URI = re.compile(rb'URI="([^"]+)"')
+
+
+class Reference:
+    """
+    One reference found in a file: what kind of reference it is, the URL as
+    written and the path from the site root it points at, or None for URLs
+    on other hosts. found lists the files that answer it.
+    """
+
+    def __init__(self, kind, url, target):
+        self.kind = kind
+        self.url = url
+        self.target = target
+        self.found = []
+
+
+class SiteIndex:
+    """
+    Every file of the site with its size, and the references each text file
+    makes. Built by build_index and queried by the report functions.
+    """
+
+    def __init__(self, root_dir, files, refs):
+        self.root_dir = root_dir
+        self.files = files
+        self.refs = refs
+        self.pages = sorted(path for path in files if path.endswith('.html'))
+        self.redirects = load_redirects(root_dir)
+        self.variants = {}
+        for path in files:
+            self.variants.setdefault(variant_key(path), []).append(path)
+        for refs in self.refs.values():
+            for ref in refs:
+                if ref.target is not None:
+                    ref.found = self.locate(ref.target)
+
+    def locate(self, target):
+        """
+        Returns the files that answer a request for target, the way the
+        server configs do: the file itself, a page for a clean URL, or
+        the size variants the viewer asks for in place of an image.
+        """
+        if target in self.files:
+            return [target]
+        if not posixpath.splitext(target)[1] or target.endswith('/'):
+            path, seen = target, set()
+            # An old spelling of a page URL may redirect to the canonical one first.
+            while (path.rstrip('/') or '/') in self.redirects and path not in seen:
+                seen.add(path)
+                path = self.redirects[path.rstrip('/') or '/']
+            for candidate in (path, path.rstrip('/') + '.html', posixpath.join(path, 'index.html')):
+                if candidate in self.files:
+                    return [candidate]
+            # The route table has no other page URLs; the servers answer 404.
+            return []
+        return sorted(self.variants.get(variant_key(target), []))
+
+    def used_by(self, path):
+        """
+        Returns (source, reference) for every reference answered by path.
+        """
+        return [(source, ref) for source, refs in sorted(self.refs.items()) for ref in refs if path in ref.found]
+
+    def reachable(self, roots, skip_kinds=()):
+        """
+        Returns every file reachable from roots through references whose
+        kind is not in skip_kinds.
+        """
+        seen = set()
+        queue = [root for root in roots if root in self.files]
+        while queue:
+            path = queue.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            for ref in self.refs.get(path, []):
+                if ref.kind not in skip_kinds:
+                    queue.extend(found for found in ref.found if found not in seen)
+        return seen
+
+
+def variant_key(path):
+    stem, ext = posixpath.splitext(path)
+    return VARIANT_SUFFIX.sub('', stem) + ext
+
+
+def load_redirects(root_dir):
+    """
+    Returns {from: to} for the plain path rules in _redirects, keyed
+    without the trailing slash static hosts ignore. Rules with
+    placeholders, splats or query conditions are left out.
+    """
+    redirects = {}
+    path = os.path.join(root_dir, '_redirects')
+    if not os.path.exists(path):
+        return redirects
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].startswith('/') and parts[1].startswith('/') and \
+                    not re.search(r'[:*]', parts[0]):
+                redirects[parts[0].rstrip('/') or '/'] = parts[1]
+    return redirects
+
+
+def html_file_refs(data, path, import_map):
+    """
+    Yields (kind, url, target) for the references in a page: its tags,
+    the import map, the imports of inline modules and the paths quoted in
+    inline scripts such as ServerData.
+    """
+    for start, end, url, kind in html_refs(data):
+        yield kind, url, resolve_ref(url, path)
+    for token in html_stream.iter_tags(data):
+        if not isinstance(token, html_stream.StartTag) or token.name != 'script' or token.content_end is None:
+            continue
+        script_type = token.get('type')
+        if script_type == 'importmap':
+            for target in import_map.values():
+                if not target.endswith('/'):
+                    yield 'importmap', target, resolve_ref(target, path)
+        elif script_type == 'module' and not token.has('src'):
+            for start, end, specifier, dynamic in import_spans(token.content):
+                yield 'dynamic' if dynamic else 'import', specifier, resolve(specifier, path, import_map)
+        elif not token.has('src'):
+            for start, end, url in embedded_refs(token.content):
+                yield 'state', url, resolve_ref(url, '/')
+
+
+def playlist_refs(data, path):
+    for line in data.splitlines():
+        line = line.strip()
+        if line and not line.startswith(b'#'):
+            url = line.decode('utf-8', 'replace')
+            yield 'playlist', url, resolve_ref(url, path)
+        for match in PLAYLIST_URI.finditer(line):
+            url = match.group(1).decode('utf-8', 'replace')
+            yield 'playlist', url, resolve_ref(url, path)
+
+
+def extract_refs(data, path, import_map):
+    """
+    Returns [kind, url, target] for every reference in the file at path,
+    or None for files that cannot refer to anything.
+    """
+    if path.endswith('.html'):
+        refs = html_file_refs(data, path, import_map)
+    elif path.endswith('.css'):
+        refs = (('css', url, resolve_ref(url, path)) for start, end, url in css_refs(data))
+    elif STATE_FILE.match(path):
+        # Paths in the state files are relative to the page that loads them.
+        refs = (('state', url, resolve_ref(url, '/')) for start, end, url in embedded_refs(data))
+    elif path.endswith('.js'):
+        refs = (('dynamic' if dynamic else 'import', specifier, resolve(specifier, path, import_map))
+                for start, end, specifier, dynamic in import_spans(data))
+    elif path.endswith('.m3u8'):
+        refs = playlist_refs(data, path)
+    else:
+        return None
+    return [list(ref) for ref in refs]
+
+
+def find_files(root_dir):
+    """
+    Returns {path from the site root: os.stat result} for every file of
+    the site, leaving out dotfiles and compressed sidecars.
+    """
+    files = {}
+    for subdir, dirs, filenames in os.walk(root_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS and not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.') or filename.endswith(SKIP_SUFFIXES):
+                continue
+            filepath = os.path.join(subdir, filename)
+            files['/' + os.path.relpath(filepath, root_dir).replace(os.sep, '/')] = os.stat(filepath)
+    return files
+
+
+def load_cache(root_dir, import_map):
+    path = os.path.join(root_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read {path} ({e}). Every file will be scanned.")
+        return {}
+    # The import map decides where every module import points.
+    if cache.get('version') != INDEX_VERSION or cache.get('import_map') != import_map:
+        return {}
+    return cache.get('files', {})
+
+
+def save_cache(root_dir, import_map, entries):
+    path = os.path.join(root_dir, INDEX_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'version': INDEX_VERSION, 'import_map': import_map, 'files': entries}, f, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def build_index(root_dir, force=False, save=True):
+    """
+    Scans every file of the site for references and returns a SiteIndex.
+    Files whose size and modification time, or failing that content hash,
+    match the cached index are not scanned again.
+    """
+    import_map = {}
+    index_path = os.path.join(root_dir, 'index.html')
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            import_map = load_import_map(f.read())
+
+    cache = {} if force else load_cache(root_dir, import_map)
+    entries = {}
+    scanned = cached = skipped = 0
+    for path, stat in find_files(root_dir).items():
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': None, 'refs': None}
+        if not path.endswith(('.html', '.css', '.js', '.json', '.m3u8')):
+            entries[path] = entry
+            skipped += 1
+            continue
+        old = cache.get(path)
+        if old and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime_ns:
+            entries[path] = old
+            cached += 1
+            continue
+        try:
+            with open(os.path.join(root_dir, path.lstrip('/')), 'rb') as f:
+                data = f.read()
+            entry['hash'] = hash_bytes(data)
+            if old and old.get('hash') == entry['hash']:
+                entry['refs'] = old['refs']
+                cached += 1
+            else:
+                entry['refs'] = extract_refs(data, path, import_map)
+                scanned += 1
+        except Exception as e:
+            print(f"  - ERROR processing file {path}: {e}")
+        entries[path] = entry
+
+    if save:
+        save_cache(root_dir, import_map, entries)
+    print(f"Indexed {len(entries)} file(s), {scanned} scanned, {cached} from the cache, "
+          f"{skipped} without references.")
+    refs = {path: [Reference(*ref) for ref in entry['refs']] for path, entry in entries.items() if entry['refs']}
+    return SiteIndex(root_dir, {path: entry['size'] for path, entry in entries.items()}, refs)
+
+
+def broken_refs(index):
+    """
+    Returns (source, reference) for every local reference nothing answers.
+    """
+    return [(source, ref) for source, refs in sorted(index.refs.items()) for ref in refs
+            if ref.target is not None and not ref.found]
+
+
+def orphan_files(index):
+    """
+    Returns the files in the asset folders that no page reaches, even
+    through modules loaded on demand.
+    """
+    reached = index.reachable(index.pages)
+    return sorted(path for path in index.files
+                  if path.lstrip('/').startswith(LOCAL_ASSET_DIRS) and path not in reached)
+
+
+def page_weight(index, page):
+    """
+    Returns (bytes, files, state bytes) for a first visit to page: the page
+    and everything its markup pulls in, short of other pages, modules loaded
+    on demand and video segments, then the images its ServerData names on
+    top. Only the largest size variant of an image is counted, since the
+    viewer asks for one.
+    """
+    def follow(seen, skip_kinds):
+        queue = list(seen)
+        while queue:
+            path = queue.pop()
+            for ref in index.refs.get(path, []):
+                if ref.kind in skip_kinds or not ref.found or \
+                        (ref.kind in NAVIGATION and ref.found[0].endswith('.html')):
+                    continue
+                found = [max(ref.found, key=index.files.get)] if len(ref.found) > 1 else ref.found
+                for target in found:
+                    if target not in seen:
+                        seen.add(target)
+                        queue.append(target)
+        return seen
+
+    seen = follow({page}, DEFERRED | STATE_KINDS)
+    markup = sum(index.files[path] for path in seen)
+    count = len(seen)
+    state = sum(index.files[path] for path in follow(seen, DEFERRED)) - markup
+    return markup, count, state
+
+
+def report(index, broken=True, orphans=True, weight=True):
+    if broken:
+        found = {}
+        for source, ref in broken_refs(index):
+            found.setdefault((source, ref.url, ref.kind), []).append(ref)
+        print(f"\nBroken references: {len(found)}")
+        for (source, url, kind), refs in found.items():
+            times = f", {len(refs)} times" if len(refs) > 1 else ''
+            print(f"  - {source}: {url} ({kind}{times})")
+    if orphans:
+        found = orphan_files(index)
+        size = sum(index.files[path] for path in found)
+        print(f"\nOrphan files: {len(found)}, {size / 1024:,.0f} KB")
+        for path in found:
+            print(f"  - {path} ({index.files[path] / 1024:,.1f} KB)")
+    if weight:
+        print("\nFirst-visit transfer weight per page:")
+        for page in index.pages:
+            total, count, state = page_weight(index, page)
+            print(f"  - {page}: {total / 1024:,.0f} KB in {count} file(s), "
+                  f"plus up to {state / 1024:,.0f} KB of images named in ServerData")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index every reference in the site and report the broken ones.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--broken', action='store_true', help="Only report broken references.")
+    parser.add_argument('--orphans', action='store_true', help="Only report files nothing refers to.")
+    parser.add_argument('--weight', action='store_true', help="Only report the transfer weight of each page.")
+    parser.add_argument('--refs', metavar='PATH', help="List the references made by the file at PATH and exit.")
+    parser.add_argument('--used-by', metavar='PATH', help="List the files that refer to PATH and exit.")
+    parser.add_argument('--force', action='store_true', help="Rescan every file instead of using the cached index.")
+    args = parser.parse_args(argv)
+
+    index = build_index(args.root, force=args.force)
+    if args.refs:
+        path = '/' + args.refs.lstrip('/')
+        for ref in index.refs.get(path, []):
+            print(f"  - {ref.kind:9} {ref.url} -> {', '.join(ref.found) or ('external' if ref.target is None else 'MISSING')}")
+        return 0
+    if args.used_by:
+        path = '/' + args.used_by.lstrip('/')
+        for source, ref in index.used_by(path):
+            print(f"  - {source}: {ref.url} ({ref.kind})")
+        return 0
+
+    chosen = args.broken or args.orphans or args.weight
+    report(index, broken=args.broken or not chosen, orphans=args.orphans or not chosen,
+           weight=args.weight or not chosen)
+    return 1 if broken_refs(index) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,460 @@
+import argparse
+import html
+import json
+import os
+import re
+from urllib.parse import urlsplit
+
+import html_stream
+from extract_server_data import entry_page_id, project_pages
+from fix_pipeline import find_html_files
+from server_config import (HTACCESS, NGINX_CONFIG, WEB_CONFIG, after_first, before_first, ensure_element,
+                           outside_blocks, set_block, update_file)
+from server_rules import REDIRECTS, RULE_SETS, SCHEME, Request, load_rules, split_target
+from snippets import build_snippets, load_state, page_url, site_origin, snippet_path
+
+# Folders served as they are. Pages that refer to them by relative paths
+# ask for them under their own URL too, like /projects/radio/img/a.png.
+ASSET_DIRS = ('dist', 'img', 'snippets', 'videos')
+
+# A query string asking for the crawler snippet of a page.
+ESCAPED_FRAGMENT = r'(^|&)_escaped_fragment_(=|&|$)'
+
+# Redirects the conformance check follows before calling it a loop.
+MAX_HOPS = 5
+
+WEB_CONFIG_COMMENT = ('<!-- ', ' -->')
+
+# {old site path: new site path} of every page flatten_html.py moved.
+PAGE_MOVES = '.page_moves.json'
+
+
+class RouteTable:
+    """
+    Every URL the site answers, in the order of the project's pages. pages
+    maps each canonical page URL to (file, snippet): the HTML file that
+    renders it and the crawler snippet snippets.py builds for it, or None
+    for a hidden or private page, which gets none.
+    redirects maps the other spellings of a page URL (no trailing slash,
+    the page's bare uri) and the old paths of moved pages to the canonical
+    URL, or to the new path of a moved file that is not a page. missing
+    lists the page URLs no file renders.
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.redirects = {}
+        self.missing = []
+
+
+def load_page_moves(root_dir):
+    path = os.path.join(root_dir, PAGE_MOVES)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_page_moves(root_dir, moves):
+    path = os.path.join(root_dir, PAGE_MOVES)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(moves, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def site_path(root_dir, filepath):
+    return '/' + os.path.relpath(filepath, root_dir).replace(os.sep, '/')
+
+
+def build_route_table(root_dir):
+    """
+    Builds the route table from the project state and the pages on disk,
+    or returns None when there is no project state.
+    """
+    state = load_state(root_dir)
+    if state is None:
+        return None
+    pages = project_pages(state)
+    files = {}
+    # index.html is the home page, whatever other file also matches it.
+    for filepath in sorted(find_html_files(root_dir), key=lambda path: site_path(root_dir, path) != '/index.html'):
+        page_id = entry_page_id(root_dir, filepath, pages)
+        if page_id is not None and page_id not in files:
+            files[page_id] = site_path(root_dir, filepath)
+
+    table = RouteTable()
+    for page in pages:
+        url = page_url(page)
+        if page['_id'] not in files:
+            table.missing.append(url)
+            continue
+        # Routed whether or not the snippet is built yet, so crawler rules
+        # never depend on the order the tools ran in.
+        snippet = None if page.get('hidden') or page.get('isPrivate') else '/' + snippet_path(page)
+        table.pages.setdefault(url, (files[page['_id']], snippet))
+
+    for page in pages:
+        url = page_url(page)
+        if url not in table.pages or url == '/':
+            continue
+        bare = f"/{(page.get('uri') or '').strip('/')}"
+        for alias in (url.rstrip('/'), bare + '/', bare):
+            if alias != url and alias not in table.pages and alias not in table.redirects:
+                table.redirects[alias] = url
+
+    urls = {file: url for url, (file, snippet) in table.pages.items()}
+    for old, new in load_page_moves(root_dir).items():
+        if old not in table.pages and old not in table.redirects and \
+                not os.path.exists(os.path.join(root_dir, old.lstrip('/'))):
+            table.redirects[old] = urls.get(new, new)
+    return table
+
+
+def literal(path):
+    """
+    A site path as a regex that matches only itself.
+    """
+    return re.sub(r'([.^$*+?()\[\]{}|\\])', r'\\\1', path)
+
+
+def remove_nginx_locations(text):
+    """
+    Drops every location block, nested ones included, from nginx config
+    text.
+    """
+    while True:
+        match = re.search(r'^[ \t]*location\b[^{;]*\{', text, re.M)
+        if not match:
+            return re.sub(r'\n{3,}', '\n\n', text)
+        depth, pos = 0, match.end() - 1
+        while pos < len(text):
+            if text[pos] == '{':
+                depth += 1
+            elif text[pos] == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            pos += 1
+        line_end = text.find('\n', pos)
+        text = text[:match.start()] + text[len(text) if line_end == -1 else line_end + 1:]
+
+
+def server_end(text):
+    """
+    insert_at for set_block: the line closing the last top-level block,
+    which is the server block.
+    """
+    ends = list(re.finditer(r'^\}', text, re.M))
+    return ends[-1].start() if ends else None
+
+
+def nginx_routes(table):
+    """
+    Exact-match locations for the page URLs and their redirects, so nginx
+    finds a page with one lookup; prefix locations that stop the regex
+    search for the asset folders; and one regex location, reached only by
+    URLs outside the table, for assets asked for under a page URL.
+    """
+    def update(text):
+        escaped = f'map $args $rm_escaped_fragment {{\n  default 0;\n  "~{ESCAPED_FRAGMENT}" 1;\n}}\n'
+        lines = []
+        for url, (file, snippet) in table.pages.items():
+            lines.append(f"location = {url} {{")
+            if snippet:
+                lines += ["  if ($rm_escaped_fragment) {", f"    rewrite ^ {snippet} last;", "  }"]
+            lines += [f"  try_files {file} =404;", "}"]
+        for url, target in table.redirects.items():
+            lines += [f"location = {url} {{", f"  return 301 {target}$is_args$args;", "}"]
+        for name in ASSET_DIRS:
+            lines += [f"location ^~ /{name}/ {{", "  try_files $uri =404;", "}"]
+        lines += [f"location ~ ^/.+?/((?:{'|'.join(ASSET_DIRS)})/.*)$ {{", "  try_files /$1 =404;", "}",
+                  "location / {", "  try_files $uri =404;", "}"]
+        text = outside_blocks(text, remove_nginx_locations)
+        text = set_block(text, 'routes map', escaped, insert_at=before_first(r'^server\s*\{'))
+        return set_block(text, 'routes', ''.join(f"  {line}\n" for line in lines), indent='  ',
+                         insert_at=server_end)
+    return update
+
+
+def remove_htaccess_rewrites(text):
+    text = re.sub(r'^[ \t]*Rewrite(?:Cond|Rule)\b.*\n?', '', text, flags=re.M)
+    return re.sub(r'\n{3,}', '\n\n', text).rstrip('\n') + '\n'
+
+
+def htaccess_routes(table):
+    """
+    .htaccess files cannot declare a RewriteMap, so each route is its own
+    anchored rule on a literal path; none of them needs a file system check.
+    """
+    def update(text):
+        lines = []
+        for url, (file, snippet) in table.pages.items():
+            if snippet:
+                lines += [f"RewriteCond %{{QUERY_STRING}} {ESCAPED_FRAGMENT}",
+                          f"RewriteRule ^{literal(url[1:])}$ {snippet[1:]} [L]"]
+        for url, (file, snippet) in table.pages.items():
+            lines.append(f"RewriteRule ^{literal(url[1:])}$ {file[1:]} [L]")
+        for url, target in table.redirects.items():
+            lines.append(f"RewriteRule ^{literal(url[1:])}$ {target} [R=301,L]")
+        dirs = '|'.join(ASSET_DIRS)
+        lines += [f"RewriteCond %{{REQUEST_URI}} !^/({dirs})/", "RewriteCond %{REQUEST_FILENAME} !-f",
+                  f"RewriteRule ^.+?/(({dirs})/.*)$ $1 [L]"]
+        text = outside_blocks(text, remove_htaccess_rewrites)
+        return set_block(text, 'routes', ''.join(f"{line}\n" for line in lines))
+    return update
+
+
+def remove_web_config_rules(text):
+    """
+    Drops the rules of the inbound <rules> section.
+    """
+    def strip(match):
+        return re.sub(r'[ \t]*<rule\b.*?</rule>[ \t]*\n', '', match.group(0), flags=re.S)
+    return re.sub(r'<rules>.*?</rules>', strip, text, count=1, flags=re.S)
+
+
+def web_config_routes(table):
+    """
+    IIS looks the request up in rewrite maps, one per kind of route, so
+    the table costs one lookup however many pages there are.
+    """
+    def update(text):
+        maps_pad, entry_pad, pad = ' ' * 16, ' ' * 20, ' ' * 16
+        maps = ''
+        for name, entries in (('snippets', {url: snippet for url, (file, snippet) in table.pages.items() if snippet}),
+                              ('pages', {url: file for url, (file, snippet) in table.pages.items()}),
+                              ('page redirects', table.redirects)):
+            maps += f'{maps_pad}<rewriteMap name="{name}">\n'
+            maps += ''.join(f'{entry_pad}<add key="{html.escape(url)}" value="{html.escape(value)}"/>\n'
+                            for url, value in entries.items())
+            maps += f'{maps_pad}</rewriteMap>\n'
+
+        rules = ''
+        for name, map_name, extra, action in (
+                ('serve snippets to _escaped_fragment_ crawlers', 'snippets',
+                 f'<add input="{{QUERY_STRING}}" pattern="{html.escape(ESCAPED_FRAGMENT)}"/>',
+                 '<action type="Rewrite" url="{C:1}" appendQueryString="false"/>'),
+                ('serve pages by their canonical url', 'pages', '',
+                 '<action type="Rewrite" url="{C:1}"/>'),
+                ('redirect other spellings of page urls', 'page redirects', '',
+                 '<action type="Redirect" url="{C:1}" redirectType="Permanent"/>')):
+            rules += (f'{pad}<rule name="{name}" stopProcessing="true">\n'
+                      f'{pad}    <match url=".*"/>\n'
+                      f'{pad}    <conditions logicalGrouping="MatchAll">\n'
+                      + (f'{pad}        {extra}\n' if extra else '') +
+                      f'{pad}        <add input="{{{map_name}:{{URL}}}}" pattern="(.+)"/>\n'
+                      f'{pad}    </conditions>\n'
+                      f'{pad}    {action}\n'
+                      f'{pad}</rule>\n')
+        dirs = '|'.join(ASSET_DIRS)
+        rules += (f'{pad}<rule name="rewrite assets asked for under a page url" stopProcessing="true">\n'
+                  f'{pad}    <match url="^.+?/((?:{dirs})/.*)$" ignoreCase="false"/>\n'
+                  f'{pad}    <conditions logicalGrouping="MatchAll">\n'
+                  f'{pad}        <add input="{{URL}}" pattern="^/?({dirs})/" ignoreCase="false" negate="true"/>\n'
+                  f'{pad}        <add input="{{REQUEST_FILENAME}}" matchType="IsFile" negate="true"/>\n'
+                  f'{pad}    </conditions>\n'
+                  f'{pad}    <action type="Rewrite" url="{{R:1}}"/>\n'
+                  f'{pad}</rule>\n')
+
+        text = outside_blocks(text, remove_web_config_rules, comment=WEB_CONFIG_COMMENT)
+        text = ensure_element(text, 'rewriteMaps', r'<rewrite>', ' ' * 12)
+        text = set_block(text, 'routes maps', maps, comment=WEB_CONFIG_COMMENT, indent=maps_pad,
+                         insert_at=after_first(r'<rewriteMaps>'))
+        return set_block(text, 'routes', rules, comment=WEB_CONFIG_COMMENT, indent=pad,
+                         insert_at=before_first(r'</rules>'))
+    return update
+
+
+def redirects_text(table, origin):
+    """
+    The whole _redirects file. Static hosts ignore a trailing slash when
+    matching, so the page rules answer both spellings and only the bare
+    uri aliases need redirects.
+    """
+    lines = []
+    host = urlsplit(origin).hostname if origin else None
+    if host and not host.startswith('www.'):
+        lines += ["# Send www traffic to the root domain.", f"https://www.{host}/* https://{host}/:splat 301!", ""]
+    snippets = [(url, snippet) for url, (file, snippet) in table.pages.items() if snippet]
+    if snippets:
+        lines.append("# Crawler snippets for _escaped_fragment_ requests.")
+        lines += [f"{url} _escaped_fragment_=:fragment {snippet} 200" for url, snippet in snippets]
+        lines.append("")
+    lines.append("# Pages by their canonical URL.")
+    lines += [f"{url} {file} 200" for url, (file, snippet) in table.pages.items()]
+    canonical = {url.rstrip('/') for url in table.pages}
+    aliases = {}
+    for url, target in table.redirects.items():
+        if url.rstrip('/') not in canonical:
+            aliases.setdefault(url.rstrip('/'), target)
+    if aliases:
+        lines += ["", "# Other spellings of page URLs."]
+        lines += [f"{url} {target} 301" for url, target in aliases.items()]
+    depths = sorted({url.count('/') - 1 for url in table.pages if url != '/'})
+    if depths:
+        lines += ["", "# Assets asked for under a page URL."]
+        for depth in depths:
+            prefix = ''.join(f"/:p{level}" for level in range(1, depth + 1))
+            lines += [f"{prefix}/{name}/* /{name}/:splat 200" for name in ASSET_DIRS]
+    return '\n'.join(lines) + '\n'
+
+
+def write_redirects(root_dir, table, dry_run=False):
+    path = os.path.join(root_dir, REDIRECTS)
+    data = redirects_text(table, site_origin(root_dir)).encode('utf-8')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                print(f"  - {REDIRECTS} already has these routes.")
+                return
+    if dry_run:
+        print(f"  - Dry run, changes not saved to {REDIRECTS}.")
+        return
+    html_stream.write_atomic(path, data)
+    print(f"  - Routes written to {REDIRECTS}.")
+
+
+def write_server_rules(root_dir, table, dry_run=False):
+    for name, update in ((NGINX_CONFIG, nginx_routes(table)), (HTACCESS, htaccess_routes(table)),
+                         (WEB_CONFIG, web_config_routes(table))):
+        path = os.path.join(root_dir, name)
+        if dry_run:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                if update(text) != text:
+                    print(f"  - Dry run, changes not saved to {name}.")
+                    continue
+            print(f"  - {name} already has these routes or does not exist.")
+        elif update_file(path, update):
+            print(f"  - Routes written to {name}.")
+        else:
+            print(f"  - {name} already has these routes or does not exist.")
+
+
+def first_file(root_dir, name):
+    for subdir, dirs, files in os.walk(os.path.join(root_dir, name)):
+        dirs.sort()
+        for filename in sorted(files):
+            if not filename.startswith('.'):
+                return site_path(root_dir, os.path.join(subdir, filename))
+    return None
+
+
+def probes(root_dir, table):
+    """
+    Yields (request target, expected file or status, canonical) for every
+    URL in the table, with and without _escaped_fragment_, one file of each
+    asset folder from the root and from a nested page URL, and a URL no
+    route covers. A canonical URL must be answered without a redirect.
+    """
+    for url, (file, snippet) in table.pages.items():
+        yield url, file, True
+        yield url + '?_escaped_fragment_=', snippet or file, True
+    for url, target in table.redirects.items():
+        file, snippet = table.pages.get(target, (target, None))
+        yield url, file, False
+        yield url + '?_escaped_fragment_=', snippet or file, False
+    nested = max(table.pages, key=lambda url: url.count('/'), default='/')
+    for name in ASSET_DIRS:
+        asset = first_file(root_dir, name)
+        if asset:
+            yield asset, asset, True
+            if nested != '/':
+                yield nested + asset[1:], asset, True
+    yield '/no-such-page/', 404, True
+
+
+def replay(rules, target, host):
+    """
+    Routes target through rules, following redirects within the site.
+    Returns (route, hops).
+    """
+    path, query = split_target(target)
+    for hops in range(MAX_HOPS):
+        route = rules.route(Request('GET', path, query, {'host': host}))
+        if route.status not in (301, 302, 303, 307, 308) or not route.location:
+            return route, hops
+        location = route.location
+        if SCHEME.match(location):
+            parts = urlsplit(location)
+            if parts.hostname != host:
+                return route, hops
+            location = parts.path + (f"?{parts.query}" if parts.query else '')
+        path, query = split_target(location)
+    route.trail.append("check: too many redirects")
+    return route.error(508), MAX_HOPS
+
+
+def check_routes(root_dir, table):
+    """
+    Replays every probe URL through the emulated nginx, .htaccess,
+    web.config and _redirects rules and reports where they do not end at
+    the file the table expects. Returns the number of mismatches.
+    """
+    origin = site_origin(root_dir)
+    host = urlsplit(origin).hostname if origin else 'localhost'
+    cases = list(probes(root_dir, table))
+    unbuilt = [snippet for file, snippet in table.pages.values()
+               if snippet and not os.path.isfile(os.path.join(root_dir, snippet.lstrip('/')))]
+    if unbuilt:
+        print(f"  - {len(unbuilt)} snippet(s) not built yet, so crawlers get 404; run snippets.py or routes.py.")
+    failures = 0
+    for name in sorted(RULE_SETS):
+        try:
+            rules = load_rules(root_dir, name)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"  - ERROR loading the {name} rules: {e}")
+            failures += 1
+            continue
+        mismatches = 0
+        for target, expected, canonical in cases:
+            route, hops = replay(rules, target, host)
+            got = route.path if route.status is None else route.status
+            if got == expected and (hops == 0 or not canonical):
+                continue
+            mismatches += 1
+            detail = f"{got} after {hops} redirect(s)" if hops else str(got)
+            print(f"  - {name}: {target} expected {expected}, got {detail}")
+            for step in route.trail:
+                print(f"      {step}")
+        print(f"  - {name}: {len(cases) - mismatches} of {len(cases)} URL(s) routed as the table says.")
+        failures += mismatches
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile the site's routes into nginx, .htaccess, web.config "
+                                                 "and _redirects rules from one table built from its pages.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--dry-run', action='store_true', help="Report which files would change without writing.")
+    parser.add_argument('--check', action='store_true',
+                        help="Only replay the table's URLs against the existing configs.")
+    args = parser.parse_args(argv)
+
+    table = build_route_table(args.root)
+    if table is None:
+        print("Error: no ServerData found, neither inline nor in a shared state file.")
+        return 1
+    print(f"Route table: {len(table.pages)} page URL(s), {len(table.redirects)} redirect(s).")
+    for url in table.missing:
+        print(f"  - No file renders {url}, left out of the routes.")
+    if not args.check:
+        # The crawler rules point at the snippets, so they have to exist.
+        build_snippets(args.root, dry_run=args.dry_run)
+        print()
+        write_server_rules(args.root, table, dry_run=args.dry_run)
+        write_redirects(args.root, table, dry_run=args.dry_run)
+        if args.dry_run:
+            return 0
+    print("\nReplaying the route table against the server configs...")
+    failures = check_routes(args.root, table)
+    print(f"\n{failures} mismatch(es)." if failures else "\nAll configs agree with the route table.")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,104 @@
+import os
+import re
+
+NGINX_CONFIG = 'nginx_rmwebsite.conf'
+HTACCESS = '.htaccess'
+WEB_CONFIG = 'web.config'
+
+# Where server-level nginx directives go: before the first location, which
+# may be inside the routes block routes.py writes.
+NGINX_SERVER_LEVEL = r'^\s*(?:location\s|# BEGIN routes$)'
+
+BLOCK_HOLD = re.compile(r'\x00(\d+)\x00\n')
+
+
+def set_block(text, name, block, comment=('# ', ''), indent='', insert_at=None):
+    """
+    Puts block into text between BEGIN/END marker comments named name. An
+    existing block with that name is replaced in place; otherwise the block
+    goes at the offset insert_at(text) returns, or at the end.
+    """
+    begin = f"{comment[0]}BEGIN {name}{comment[1]}"
+    end = f"{comment[0]}END {name}{comment[1]}"
+    wrapped = f"{indent}{begin}\n{block}{indent}{end}\n"
+    pattern = re.compile(r'[ \t]*' + re.escape(begin) + r'[ \t]*\n.*?' + re.escape(end) + r'[ \t]*(?:\n|$)', re.S)
+    if pattern.search(text):
+        return pattern.sub(lambda match: wrapped, text, count=1)
+    pos = insert_at(text) if insert_at else len(text)
+    if pos is None:
+        pos = len(text)
+    return text[:pos] + wrapped + text[pos:]
+
+
+def outside_blocks(text, update, comment=('# ', '')):
+    """
+    Runs update(text) over the hand-written part of text only: every
+    BEGIN/END block set_block wrote is held out on a placeholder line and
+    put back afterwards.
+    """
+    pattern = re.compile(r'[ \t]*' + re.escape(comment[0]) + r'BEGIN (.+?)' + re.escape(comment[1]) +
+                         r'[ \t]*\n.*?' + re.escape(comment[0]) + r'END \1' + re.escape(comment[1]) +
+                         r'[ \t]*(?:\n|$)', re.S)
+    held = []
+
+    def hold(match):
+        held.append(match.group(0))
+        return f"\x00{len(held) - 1}\x00\n"
+
+    return BLOCK_HOLD.sub(lambda match: held[int(match.group(1))], update(pattern.sub(hold, text)))
+
+
+def update_file(path, update):
+    """
+    Runs update(text) over the file at path and writes the result back if it
+    changed. Returns True when the file was written, False otherwise or if
+    there is no such file.
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    new_text = update(text)
+    if new_text == text:
+        return False
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(new_text)
+    return True
+
+
+def before_first(pattern):
+    """
+    Returns an insert_at function for set_block that places the block at the
+    start of the line holding the first match of pattern.
+    """
+    def insert_at(text):
+        match = re.search(pattern, text, re.M)
+        return text.rfind('\n', 0, match.start()) + 1 if match else None
+    return insert_at
+
+
+def after_first(pattern):
+    """
+    Like before_first, but places the block on the line after the match.
+    """
+    def insert_at(text):
+        match = re.search(pattern, text, re.M)
+        if not match:
+            return None
+        line_end = text.find('\n', match.end())
+        return len(text) if line_end == -1 else line_end + 1
+    return insert_at
+
+
+def ensure_element(text, tag, after_pattern, indent=''):
+    """
+    Makes sure the XML text has a <tag> element, adding an empty one on the
+    line after the first match of after_pattern if it is missing. Used for
+    sections of web.config that several blocks share, like <outboundRules>.
+    """
+    if re.search(rf'<{tag}[\s>]', text):
+        return text
+    pos = after_first(after_pattern)(text)
+    if pos is None:
+        pos = len(text)
+    return text[:pos] + f"{indent}<{tag}>\n{indent}</{tag}>\n" + text[pos:]
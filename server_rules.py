@@ -0,0 +1,883 @@
+import mimetypes
+import os
+import posixpath
+import re
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import parse_qsl, unquote
+
+from server_config import HTACCESS, NGINX_CONFIG, WEB_CONFIG
+
+REDIRECTS = '_redirects'
+
+# nginx gives up after this many internal redirects; Apache has its own limit.
+MAX_CYCLES = 10
+MAX_RESTARTS = 100
+
+SCHEME = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+NGINX_TOKEN = re.compile(r'''\s+|#[^\n]*|"((?:\\.|[^"\\])*)"|'((?:\\.|[^'\\])*)'|([{};])|([^\s{};"']+)''')
+NGINX_VARIABLE = re.compile(r'\$(\d|\{\w+\}|\w+)')
+APACHE_VARIABLE = re.compile(r'%\{(HTTP:)?([\w-]+)\}|\$(\d)|%(\d)')
+# The innermost {...} of an IIS template; map lookups wrap a variable.
+IIS_VARIABLE = re.compile(r'\{([^{}]*)\}')
+IIS_REDIRECTS = {'permanent': 301, 'found': 302, 'seeother': 303, 'temporary': 307}
+
+
+class Request:
+    """
+    What the rules look at: the method, the decoded path, the raw query
+    string and the headers, keyed in lower case.
+    """
+
+    def __init__(self, method, path, query='', headers=None):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers or {}
+
+
+class Route:
+    """
+    What a rule set decided for a request. status is None when a file is
+    served, with path its site path. location is set for redirects.
+    headers are extra response headers, content_type overrides the type
+    taken from the file name, and encodings lists the precompressed
+    sidecars the server may send in place of the file, best first.
+    file_status is the status a served file goes out with. trail names
+    every rule that matched, in order.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.file_status = 200
+        self.path = None
+        self.location = None
+        self.headers = []
+        self.content_type = None
+        self.encodings = []
+        self.trail = []
+
+    def redirect(self, status, location):
+        self.status = status
+        self.location = location
+        return self
+
+    def error(self, status):
+        self.status = status
+        return self
+
+
+def normalize_path(path):
+    """
+    Merges the repeated slashes and the dot segments of a decoded request
+    path, the way nginx does before it routes anything. Raises ValueError
+    for a path that climbs above the site root or holds a NUL byte; nginx
+    answers those with 400.
+    """
+    if not path.startswith('/') or '\0' in path:
+        raise ValueError(f"bad request path {path!r}")
+    segments = []
+    for part in path.split('/'):
+        if part == '..':
+            if not segments:
+                raise ValueError(f"request path {path!r} leaves the site root")
+            segments.pop()
+        elif part not in ('', '.'):
+            segments.append(part)
+    trailing = segments and path.endswith(('/', '/.', '/..'))
+    return '/' + '/'.join(segments) + ('/' if trailing else '')
+
+
+def site_file(root_dir, path):
+    """
+    Returns the file a site path names under root_dir, or None when the
+    path would lead outside it.
+    """
+    root = os.path.abspath(root_dir)
+    filepath = os.path.abspath(os.path.join(root, posixpath.normpath('/' + path).lstrip('/')))
+    if os.path.commonpath([root, filepath]) != root:
+        return None
+    return filepath
+
+
+def file_kind(root_dir, path):
+    """
+    Returns 'file', 'dir' or None for a site path.
+    """
+    filepath = site_file(root_dir, path)
+    if filepath is None:
+        return None
+    if os.path.isfile(filepath):
+        return 'file'
+    if os.path.isdir(filepath):
+        return 'dir'
+    return None
+
+
+def serve_static(root_dir, path, route, index='index.html'):
+    """
+    Finishes a route the way a plain static server does: the file, the
+    index of a folder, a redirect to add the slash to a folder, or 404.
+    """
+    kind = file_kind(root_dir, path)
+    if kind == 'file':
+        route.path = path
+        route.status = None
+    elif kind == 'dir' and path.endswith('/') and file_kind(root_dir, path + index) == 'file':
+        route.path = path + index
+        route.status = None
+    elif kind == 'dir' and not path.endswith('/'):
+        route.redirect(301, path + '/')
+    else:
+        route.error(404)
+    return route
+
+
+class Directive:
+
+    def __init__(self, name, args, line, children=None):
+        self.name = name
+        self.args = args
+        self.line = line
+        self.children = children
+
+    def source(self):
+        return f"{self.name} {' '.join(self.args)}".strip()
+
+
+def parse_nginx(text):
+    """
+    Parses nginx configuration text into a list of Directives, blocks
+    holding their contents in children.
+    """
+    stack = [[]]
+    words, line_of_first = [], None
+    pos = 0
+    while pos < len(text):
+        match = NGINX_TOKEN.match(text, pos)
+        if not match:
+            raise ValueError(f"Cannot parse nginx config at line {text.count(chr(10), 0, pos) + 1}")
+        line = text.count('\n', 0, pos) + 1
+        pos = match.end()
+        quoted = match.group(1) if match.group(1) is not None else match.group(2)
+        if quoted is not None or match.group(4):
+            if not words:
+                line_of_first = line
+            words.append(quoted if quoted is not None else match.group(4))
+        elif match.group(3) == ';':
+            if words:
+                stack[-1].append(Directive(words[0], words[1:], line_of_first))
+            words = []
+        elif match.group(3) == '{':
+            block = Directive(words[0] if words else '', words[1:], line_of_first or line, [])
+            stack[-1].append(block)
+            stack.append(block.children)
+            words = []
+        elif match.group(3) == '}':
+            if len(stack) == 1:
+                raise ValueError(f"Unbalanced '}}' in nginx config at line {line}")
+            stack.pop()
+    return stack[0]
+
+
+class NginxRules:
+    """
+    Emulates the parts of nginx the site config uses: location matching,
+    the rewrite module (if, rewrite, break, return, set), try_files, index,
+    map, add_header and gzip_static/brotli_static.
+    """
+
+    name = 'nginx'
+
+    def __init__(self, root_dir, text):
+        self.root_dir = root_dir
+        directives = parse_nginx(text)
+        self.server = next((d for d in directives if d.name == 'server'), Directive('server', [], 0, directives))
+        self.maps = {}
+        for d in directives:
+            if d.name == 'map' and len(d.args) == 2:
+                self.maps[d.args[1].lstrip('$')] = (d.args[0], d.children)
+
+    def directives(self, block, name):
+        return [d for d in block.children if d.name == name]
+
+    def setting(self, chain, name, default=None):
+        """
+        The value of a directive as inherited down a chain of blocks.
+        """
+        for block in reversed(chain):
+            found = self.directives(block, name)
+            if found:
+                return found[-1].args
+        return default
+
+    def find_location(self, block, uri):
+        """
+        Returns the chain of location blocks nginx picks for uri inside
+        block: an exact match, else the first matching regex, else the
+        longest prefix, searching nested locations of the winner too.
+        """
+        exact, prefix, regexes = None, None, []
+        for d in self.directives(block, 'location'):
+            if d.args[0] == '=' and len(d.args) > 1:
+                if d.args[1] == uri:
+                    exact = d
+            elif d.args[0] in ('~', '~*') and len(d.args) > 1:
+                regexes.append(d)
+            else:
+                modifier_free = d.args[-1]
+                if uri.startswith(modifier_free) and (prefix is None or len(modifier_free) > len(prefix.args[-1])):
+                    prefix = d
+        if exact:
+            return [exact]
+        if prefix is not None:
+            nested = self.find_location(prefix, uri)
+            if nested:
+                return [prefix] + nested
+            if prefix.args[0] == '^~':
+                return [prefix]
+        for d in regexes:
+            if re.search(d.args[1], uri, re.I if d.args[0] == '~*' else 0):
+                return [d]
+        return [prefix] if prefix is not None else []
+
+    def variable(self, name, state):
+        if name.isdigit():
+            match = state['match']
+            if match and int(name) <= (match.re.groups or 0):
+                return match.group(int(name)) or ''
+            return ''
+        name = name.strip('{}')
+        request = state['request']
+        if name == 'uri':
+            return state['uri']
+        if name in ('args', 'query_string'):
+            return state['args']
+        if name == 'is_args':
+            return '?' if state['args'] else ''
+        if name == 'request_uri':
+            return request.path + (f"?{request.query}" if request.query else '')
+        if name == 'request_filename':
+            return site_file(self.root_dir, state['uri']) or ''
+        if name == 'host':
+            return request.headers.get('host', '').split(':')[0]
+        if name.startswith('http_'):
+            return request.headers.get(name[5:].replace('_', '-'), '')
+        if name in state['vars']:
+            return state['vars'][name]
+        if name in self.maps:
+            return self.map_value(name, state)
+        return ''
+
+    def map_value(self, name, state):
+        source, entries = self.maps[name]
+        value = self.expand(source, state)
+        default = ''
+        for entry in entries:
+            key = entry.name
+            result = entry.args[0] if entry.args else ''
+            if key == 'default':
+                default = result
+            elif key.startswith('~*') and re.search(key[2:], value, re.I):
+                return result
+            elif key.startswith('~') and re.search(key[1:], value):
+                return result
+            elif key == value:
+                return result
+        return default
+
+    def expand(self, text, state):
+        return NGINX_VARIABLE.sub(lambda m: self.variable(m.group(1), state), text)
+
+    def condition(self, args, state):
+        words = ' '.join(args).strip()
+        words = words[1:-1].strip() if words.startswith('(') and words.endswith(')') else words
+        match = re.match(r'^(!?)(-[fdex])\s+(\S+)$', words)
+        if match:
+            path = self.expand(match.group(3), state)
+            test = {'-f': os.path.isfile, '-d': os.path.isdir, '-e': os.path.exists, '-x': os.path.isfile}
+            return test[match.group(2)](path) != bool(match.group(1))
+        match = re.match(r'^(\S+)\s+(!?~\*?|!?=)\s+"?(.*?)"?$', words)
+        if match:
+            value = self.expand(match.group(1), state)
+            operator, pattern = match.group(2), match.group(3)
+            if operator.lstrip('!').startswith('~'):
+                found = re.search(pattern, value, re.I if operator.endswith('*') else 0)
+                if found:
+                    state['match'] = found
+                result = bool(found)
+            else:
+                result = value == pattern
+            return result != operator.startswith('!')
+        value = self.expand(words, state)
+        return value not in ('', '0')
+
+    def run(self, block, state, route):
+        """
+        Runs the rewrite module directives of block in order. Returns
+        'last', 'break', or a finished route, or None to go on to the
+        content phase.
+        """
+        for d in block.children:
+            where = f"nginx:{d.line} {d.source()}"
+            if d.name == 'if':
+                if self.condition(d.args, state):
+                    route.trail.append(where)
+                    outcome = self.run(d, state, route)
+                    if outcome:
+                        return outcome
+            elif d.name == 'break':
+                route.trail.append(where)
+                return 'break'
+            elif d.name == 'set' and len(d.args) == 2:
+                state['vars'][d.args[0].lstrip('$')] = self.expand(d.args[1], state)
+            elif d.name == 'return':
+                route.trail.append(where)
+                code = int(d.args[0]) if d.args[0].isdigit() else 302
+                target = self.expand(d.args[-1], state) if len(d.args) > 1 or not d.args[0].isdigit() else None
+                return route.redirect(code, target) if code in (301, 302, 303, 307, 308) else route.error(code)
+            elif d.name == 'rewrite' and len(d.args) >= 2:
+                match = re.search(d.args[0], state['uri'])
+                if not match:
+                    continue
+                route.trail.append(where)
+                state['match'] = match
+                target = self.expand(d.args[1], state)
+                flag = d.args[2] if len(d.args) > 2 else None
+                if '?' in target:
+                    target, args = target.split('?', 1)
+                    state['args'] = args
+                if SCHEME.match(target) or flag in ('redirect', 'permanent'):
+                    location = target + (f"?{state['args']}" if state['args'] else '')
+                    return route.redirect(301 if flag == 'permanent' else 302, location)
+                state['uri'] = target
+                if flag in ('last', 'break'):
+                    return flag
+        return None
+
+    def route(self, request):
+        route = Route()
+        state = {'request': request, 'uri': request.path, 'args': request.query, 'vars': {}, 'match': None}
+        for cycle in range(MAX_CYCLES):
+            chain = [self.server] + self.find_location(self.server, state['uri'])
+            if len(chain) > 1:
+                route.trail.append(f"nginx:{chain[-1].line} {chain[-1].source()}")
+                modifier = chain[-1].args[0]
+                if modifier in ('~', '~*'):
+                    # A regex location's captures are there for the directives inside it.
+                    state['match'] = re.search(chain[-1].args[1], state['uri'], re.I if modifier == '~*' else 0)
+            # The server's rewrites run once; after that only the chosen
+            # location's own, which nested locations do not inherit.
+            outcome = self.run(self.server, state, route) if cycle == 0 else None
+            if outcome is None and len(chain) > 1:
+                outcome = self.run(chain[-1], state, route)
+            if isinstance(outcome, Route):
+                return outcome
+            if outcome == 'last':
+                continue
+
+            try_files = self.directives(chain[-1], 'try_files')
+            if try_files:
+                d = try_files[-1]
+                route.trail.append(f"nginx:{d.line} {d.source()}")
+                for candidate in d.args[:-1]:
+                    path = self.expand(candidate, state)
+                    kind = file_kind(self.root_dir, path)
+                    if kind == 'file' or (kind == 'dir' and path.endswith('/')):
+                        state['uri'] = path
+                        break
+                else:
+                    # The last parameter is an internal redirect, or a status.
+                    if d.args[-1].startswith('='):
+                        return route.error(int(d.args[-1][1:]))
+                    state['uri'] = self.expand(d.args[-1], state)
+                    continue
+            index = (self.setting(chain, 'index') or ['index.html'])[0]
+            serve_static(self.root_dir, state['uri'], route, index)
+            if route.status is None and route.path != state['uri']:
+                # The index module redirects internally to the folder's index file.
+                state['uri'] = route.path
+                chain = [self.server] + self.find_location(self.server, state['uri'])
+            self.finish(chain, state, route)
+            return route
+        route.trail.append("nginx: rewrite or internal redirection cycle")
+        return route.error(500)
+
+    def finish(self, chain, state, route):
+        for name, sidecar in (('brotli_static', 'br'), ('gzip_static', 'gzip')):
+            if (self.setting(chain, name) or ['off'])[0] == 'on':
+                route.encodings.append(sidecar)
+        # add_header is inherited only by blocks that have none of their own.
+        for block in reversed(chain):
+            headers = self.directives(block, 'add_header')
+            if headers:
+                for d in headers:
+                    value = self.expand(d.args[1], state) if len(d.args) > 1 else ''
+                    if value:
+                        route.headers.append((d.args[0], value))
+                break
+
+
+class HtaccessRules:
+    """
+    Emulates the parts of Apache an .htaccess at the site root uses:
+    mod_rewrite in per-directory context (RewriteCond, RewriteRule with
+    the L, N, QSA, R, T, F and G flags), AddType, AddDefaultCharset, and
+    Header set/append inside <FilesMatch> and <If> sections.
+    """
+
+    name = 'htaccess'
+
+    def __init__(self, root_dir, text):
+        self.root_dir = root_dir
+        self.base = '/'
+        self.rules = []
+        self.headers = []
+        self.types = {}
+        self.charset = None
+        conditions = []
+        scopes = []
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            words = split_apache(line)
+            name = words[0]
+            if name.startswith('</'):
+                if scopes and not name.lower().startswith('</ifmodule'):
+                    scopes.pop()
+            elif name.startswith('<'):
+                section = name[1:].lower()
+                argument = ' '.join(words[1:]).rstrip('>').strip().strip('"')
+                if section == 'filesmatch':
+                    scopes.append(('files', re.compile(argument)))
+                elif section == 'if':
+                    match = re.match(r'%\{REQUEST_URI\}\s*=~\s*m?(.)(.*)\1$', argument)
+                    scopes.append(('uri', re.compile(match.group(2))) if match else ('never', None))
+                elif section != 'ifmodule':
+                    scopes.append(('never', None))
+            elif name == 'RewriteBase':
+                self.base = words[1].rstrip('/') + '/'
+            elif name == 'RewriteCond':
+                conditions.append((words[1], words[2], parse_flags(words[3] if len(words) > 3 else ''), number))
+            elif name == 'RewriteRule':
+                flags = parse_flags(words[3] if len(words) > 3 else '')
+                self.rules.append((words[1], words[2], flags, conditions, number, line))
+                conditions = []
+            elif name == 'Header' and len(words) >= 4:
+                self.headers.append((list(scopes), words[1].lower(), words[2], words[3], number))
+            elif name == 'AddType':
+                for ext in words[2:]:
+                    self.types['.' + ext.lstrip('.').lower()] = words[1]
+            elif name == 'AddDefaultCharset':
+                self.charset = words[1]
+
+    def expand(self, text, state, rule_match, cond_match):
+        def value(m):
+            if m.group(3):
+                return (rule_match.group(int(m.group(3))) or '') if rule_match and \
+                    int(m.group(3)) <= rule_match.re.groups else ''
+            if m.group(4):
+                return (cond_match.group(int(m.group(4))) or '') if cond_match and \
+                    int(m.group(4)) <= cond_match.re.groups else ''
+            name = m.group(2)
+            if m.group(1):
+                return state['request'].headers.get(name.lower(), '')
+            if name == 'REQUEST_URI':
+                return state['uri']
+            if name == 'QUERY_STRING':
+                return state['query']
+            if name == 'REQUEST_FILENAME':
+                return site_file(self.root_dir, state['uri']) or ''
+            if name == 'HTTP_HOST':
+                return state['request'].headers.get('host', '')
+            if name == 'REQUEST_METHOD':
+                return state['request'].method
+            return ''
+        return APACHE_VARIABLE.sub(value, text)
+
+    def conditions_hold(self, conditions, state, rule_match):
+        result, cond_match, pending_or = True, None, False
+        for test, pattern, flags, number in conditions:
+            value = self.expand(test, state, rule_match, cond_match)
+            negate = pattern.startswith('!')
+            pattern = pattern[1:] if negate else pattern
+            if pattern in ('-f', '-d', '-s'):
+                check = {'-f': os.path.isfile, '-d': os.path.isdir,
+                         '-s': lambda p: os.path.isfile(p) and os.path.getsize(p) > 0}[pattern]
+                matched = check(value)
+            else:
+                found = re.search(pattern, value, re.I if 'NC' in flags else 0)
+                matched = bool(found)
+                if found and not negate:
+                    cond_match = found
+            matched = matched != negate
+            result = (result or matched) if pending_or else (result and matched)
+            pending_or = 'OR' in flags
+        return result
+
+    def route(self, request):
+        route = Route()
+        state = {'request': request, 'uri': request.path, 'query': request.query}
+        for cycle in range(MAX_CYCLES):
+            start_uri = state['uri']
+            index = restarts = 0
+            while index < len(self.rules):
+                pattern, substitution, flags, conditions, number, source = self.rules[index]
+                index += 1
+                path = state['uri'][len(self.base):] if state['uri'].startswith(self.base) else state['uri'].lstrip('/')
+                negate = pattern.startswith('!')
+                match = re.search(pattern[1:] if negate else pattern, path, re.I if 'NC' in flags else 0)
+                if bool(match) == negate or not self.conditions_hold(conditions, state, None if negate else match):
+                    continue
+                route.trail.append(f"htaccess:{number} {source}")
+                if 'T' in flags:
+                    route.content_type = flags['T']
+                if 'F' in flags:
+                    return route.error(403)
+                if 'G' in flags:
+                    return route.error(410)
+                if substitution != '-':
+                    target = self.expand(substitution, state, None if negate else match, None)
+                    query = None
+                    if '?' in target:
+                        target, query = target.split('?', 1)
+                        if 'QSA' in flags and state['query']:
+                            query = f"{query}&{state['query']}" if query else state['query']
+                    if 'R' in flags or SCHEME.match(target):
+                        if not SCHEME.match(target) and not target.startswith('/'):
+                            target = self.base + target
+                        query = state['query'] if query is None else query
+                        return route.redirect(int(flags.get('R') or 302), target + (f"?{query}" if query else ''))
+                    state['uri'] = target if target.startswith('/') else self.base + target
+                    if query is not None:
+                        state['query'] = query
+                if 'N' in flags:
+                    restarts += 1
+                    if restarts > MAX_RESTARTS:
+                        route.trail.append("htaccess: too many N restarts")
+                        return route.error(500)
+                    index = 0
+                    continue
+                if 'L' in flags or 'END' in flags:
+                    if 'END' in flags:
+                        return self.finish(state, route)
+                    break
+            # Per-directory rewrites start over on the new URI until it settles.
+            if state['uri'] == start_uri:
+                return self.finish(state, route)
+        route.trail.append("htaccess: too many internal redirects")
+        return route.error(500)
+
+    def finish(self, state, route):
+        serve_static(self.root_dir, state['uri'], route)
+        if route.status is not None:
+            return route
+        name = posixpath.basename(route.path)
+        ext = posixpath.splitext(name)[1].lower()
+        if route.content_type is None and ext in self.types:
+            route.content_type = self.types[ext]
+        if self.charset and route.content_type is None and ext in ('.html', '.txt'):
+            route.content_type = f"{'text/html' if ext == '.html' else 'text/plain'}; charset={self.charset}"
+        for scopes, action, header, value, number in self.headers:
+            if all(kind != 'never' and (pattern.search(name) if kind == 'files' else pattern.search(route.path))
+                   for kind, pattern in scopes):
+                route.trail.append(f"htaccess:{number} Header {action} {header}")
+                if action == 'set':
+                    route.headers = [(h, v) for h, v in route.headers if h.lower() != header.lower()]
+                route.headers.append((header, value))
+        return route
+
+
+def split_apache(line):
+    """
+    Splits an Apache directive line into words, keeping quoted words whole.
+    """
+    return [m.group(1) if m.group(1) is not None else m.group(2)
+            for m in re.finditer(r'"((?:\\.|[^"\\])*)"|(\S+)', line)]
+
+
+def parse_flags(text):
+    flags = {}
+    for flag in text.strip('[]').split(','):
+        if flag:
+            name, _, value = flag.partition('=')
+            flags[name.upper()] = value
+    return flags
+
+
+class RedirectsRules:
+    """
+    Emulates a _redirects file the way static hosts read it: rules in
+    order, * splats and :placeholders, host-qualified sources, query
+    parameter conditions (key=value or key=:placeholder between source
+    and target), 200 rewrites, and rules that only apply when no file
+    matches unless they end in ! to force them. Paths are then served as
+    files, with clean URLs falling back to name.html.
+    """
+
+    name = 'redirects'
+
+    def __init__(self, root_dir, text):
+        self.root_dir = root_dir
+        self.rules = []
+        for number, line in enumerate(text.splitlines(), 1):
+            words = line.split('#', 1)[0].split()
+            query = []
+            while len(words) > 2 and '=' in words[1] and not words[1].startswith('/') and not SCHEME.match(words[1]):
+                query.append(words.pop(1).split('=', 1))
+            if len(words) < 2:
+                continue
+            status = words[2] if len(words) > 2 else '301'
+            force = status.endswith('!')
+            self.rules.append((words[0], query, words[1], int(status.rstrip('!') or 301), force, number,
+                               line.strip()))
+
+    def match_query(self, query, request):
+        """
+        Returns the :placeholder values of the rule's query conditions, or
+        None when a parameter is missing or has another value.
+        """
+        params = dict(parse_qsl(request.query, keep_blank_values=True))
+        values = {}
+        for key, expected in query:
+            if key not in params:
+                return None
+            if expected.startswith(':'):
+                values[expected[1:]] = params[key]
+            elif params[key] != expected:
+                return None
+        return values
+
+    def match(self, source, request):
+        host = None
+        if SCHEME.match(source):
+            scheme, rest = source.split('://', 1)
+            host, _, source = rest.partition('/')
+            source = '/' + source
+            if request.headers.get('host', '').split(':')[0] != host:
+                return None
+        pattern = ''
+        for part in re.split(r'(\*|:\w+)', source):
+            if part == '*':
+                pattern += '(?P<splat>.*)'
+            elif part.startswith(':') and len(part) > 1:
+                pattern += f'(?P<{part[1:]}>[^/]+)'
+            else:
+                pattern += re.escape(part)
+        return re.match(pattern.rstrip('/') + '/?$', request.path)
+
+    def route(self, request):
+        route = Route()
+        exists = file_kind(self.root_dir, request.path) == 'file'
+        for source, query, target, status, force, number, line in self.rules:
+            match = self.match(source, request)
+            if not match or (exists and not force):
+                continue
+            values = self.match_query(query, request)
+            if values is None:
+                continue
+            route.trail.append(f"redirects:{number} {line}")
+            for name, value in list(match.groupdict().items()) + list(values.items()):
+                target = target.replace(f':{name}', value or '')
+            if status in (301, 302, 303, 307, 308):
+                return route.redirect(status, target + (f"?{request.query}" if request.query else ''))
+            serve_static(self.root_dir, target, route)
+            route.file_status = status
+            return route
+        path = request.path
+        if file_kind(self.root_dir, path) is None and file_kind(self.root_dir, path.rstrip('/') + '.html') == 'file':
+            route.trail.append(f"redirects: clean URL {path} -> {path.rstrip('/')}.html")
+            path = path.rstrip('/') + '.html'
+        return serve_static(self.root_dir, path, route)
+
+
+class WebConfigRules:
+    """
+    Emulates the URL Rewrite module of IIS for a web.config at the site
+    root: rewrite maps, inbound rules (match url, conditions matched as
+    patterns or with IsFile/IsDirectory, {R:n}, {C:n} and {map:{...}}
+    templates, Rewrite, Redirect, CustomResponse and AbortRequest actions)
+    and outbound rules that set response headers. Inbound rules run once,
+    in order, each seeing the URL the rules before it rewrote.
+    """
+
+    name = 'web.config'
+
+    def __init__(self, root_dir, text):
+        self.root_dir = root_dir
+        self.maps = {}
+        self.rules = []
+        self.outbound = []
+        try:
+            rewrite = ElementTree.fromstring(text).find('system.webServer/rewrite')
+        except ElementTree.ParseError as e:
+            raise ValueError(f"{WEB_CONFIG} is not well-formed XML: {e}")
+        if rewrite is None:
+            return
+        for rewrite_map in rewrite.findall('rewriteMaps/rewriteMap'):
+            self.maps[rewrite_map.get('name', '').lower()] = (
+                rewrite_map.get('defaultValue', ''),
+                {entry.get('key', ''): entry.get('value', '') for entry in rewrite_map.findall('add')})
+        self.rules = [self.parse_rule(rule) for rule in rewrite.findall('rules/rule')]
+        self.outbound = [self.parse_rule(rule) for rule in rewrite.findall('outboundRules/rule')]
+
+    @staticmethod
+    def parse_rule(rule):
+        match = rule.find('match')
+        conditions = rule.find('conditions')
+        return {
+            'name': rule.get('name', ''),
+            'stop': rule.get('stopProcessing', 'false').lower() == 'true',
+            'match': match.attrib if match is not None else {},
+            'any': conditions is not None and conditions.get('logicalGrouping', '').lower() == 'matchany',
+            'conditions': [c.attrib for c in conditions.findall('add')] if conditions is not None else [],
+            'action': rule.find('action').attrib if rule.find('action') is not None else {'type': 'None'},
+        }
+
+    @staticmethod
+    def pattern_match(attrs, value, key='pattern'):
+        flags = re.I if attrs.get('ignoreCase', 'true').lower() == 'true' else 0
+        return re.search(attrs.get(key, '.*'), value, flags)
+
+    def expand(self, text, state, rule_match, cond_match):
+        def value(m):
+            name = m.group(1)
+            kind, _, rest = name.partition(':')
+            if kind in ('R', 'C') and rest.isdigit():
+                found = rule_match if kind == 'R' else cond_match
+                return (found.group(int(rest)) or '') if found and int(rest) <= found.re.groups else ''
+            if rest or kind.lower() in self.maps:
+                default, entries = self.maps.get(kind.lower(), ('', {}))
+                return entries.get(rest, default)
+            upper = name.upper()
+            if upper == 'URL':
+                return state['uri']
+            if upper == 'QUERY_STRING':
+                return state['query']
+            if upper == 'REQUEST_URI':
+                request = state['request']
+                return request.path + (f"?{request.query}" if request.query else '')
+            if upper == 'REQUEST_FILENAME':
+                return site_file(self.root_dir, state['uri']) or ''
+            if upper == 'REQUEST_METHOD':
+                return state['request'].method
+            if upper == 'HTTPS':
+                return 'off'
+            if upper.startswith('HTTP_'):
+                return state['request'].headers.get(upper[5:].lower().replace('_', '-'), '')
+            if upper.startswith('RESPONSE_'):
+                return state.get('response', {}).get(upper[9:].lower().replace('_', '-'), '')
+            return ''
+        while True:
+            expanded = IIS_VARIABLE.sub(value, text)
+            if expanded == text or '{' not in expanded:
+                return expanded
+            text = expanded
+
+    def conditions_hold(self, rule, state, rule_match):
+        cond_match = None
+        results = []
+        for condition in rule['conditions']:
+            value = self.expand(condition.get('input', ''), state, rule_match, cond_match)
+            kind = condition.get('matchType', 'Pattern').lower()
+            if kind == 'isfile':
+                matched = os.path.isfile(value)
+            elif kind == 'isdirectory':
+                matched = os.path.isdir(value)
+            else:
+                found = self.pattern_match(condition, value)
+                matched = bool(found)
+                if found and condition.get('negate', 'false').lower() != 'true':
+                    cond_match = found
+            matched = matched != (condition.get('negate', 'false').lower() == 'true')
+            results.append(matched)
+            if rule['any'] and matched:
+                return True, cond_match
+            if not rule['any'] and not matched:
+                return False, cond_match
+        return (not rule['any'] or not results), cond_match
+
+    def route(self, request):
+        route = Route()
+        state = {'request': request, 'uri': request.path, 'query': request.query}
+        for rule in self.rules:
+            negate = rule['match'].get('negate', 'false').lower() == 'true'
+            match = self.pattern_match(rule['match'], state['uri'].lstrip('/'), 'url')
+            if bool(match) == negate:
+                continue
+            holds, cond_match = self.conditions_hold(rule, state, None if negate else match)
+            if not holds:
+                continue
+            route.trail.append(f"web.config rule \"{rule['name']}\"")
+            action = rule['action']
+            kind = action.get('type', 'None').lower()
+            append_query = action.get('appendQueryString', 'true').lower() == 'true'
+            if kind in ('rewrite', 'redirect'):
+                target = self.expand(action.get('url', ''), state, None if negate else match, cond_match)
+                target, _, query = target.partition('?')
+                if append_query and state['query']:
+                    query = f"{query}&{state['query']}" if query else state['query']
+                if kind == 'redirect':
+                    if not SCHEME.match(target) and not target.startswith('/'):
+                        target = '/' + target
+                    status = IIS_REDIRECTS.get(action.get('redirectType', 'Permanent').lower(), 301)
+                    return route.redirect(status, target + (f"?{query}" if query else ''))
+                state['uri'] = target if target.startswith('/') else '/' + target
+                state['query'] = query
+            elif kind == 'customresponse':
+                return route.error(int(action.get('statusCode', 200)))
+            elif kind == 'abortrequest':
+                return route.error(400)
+            if rule['stop']:
+                break
+        return self.finish(state, route)
+
+    def finish(self, state, route):
+        serve_static(self.root_dir, state['uri'], route)
+        if route.status is not None:
+            return route
+        guessed = mimetypes.guess_type(route.path)[0] or 'application/octet-stream'
+        state['response'] = {'content-type': guessed}
+        for rule in self.outbound:
+            variable = rule['match'].get('serverVariable', '')
+            if not variable.upper().startswith('RESPONSE_'):
+                continue
+            header = variable[9:].replace('_', '-')
+            current = state['response'].get(header.lower(), '')
+            if not self.pattern_match(rule['match'], current) or not self.conditions_hold(rule, state, None)[0]:
+                continue
+            route.trail.append(f"web.config outbound rule \"{rule['name']}\"")
+            value = rule['action'].get('value', '')
+            state['response'][header.lower()] = value
+            if header.lower() == 'content-type':
+                route.content_type = value
+            else:
+                route.headers = [(h, v) for h, v in route.headers if h.lower() != header.lower()]
+                route.headers.append((header, value))
+        return route
+
+
+RULE_SETS = {'nginx': (NginxRules, NGINX_CONFIG), 'htaccess': (HtaccessRules, HTACCESS),
+             'redirects': (RedirectsRules, REDIRECTS), 'web.config': (WebConfigRules, WEB_CONFIG)}
+
+
+def load_rules(root_dir, name):
+    """
+    Reads the config file of the named rule set from root_dir and returns
+    its emulator.
+    """
+    cls, filename = RULE_SETS[name]
+    path = os.path.join(root_dir, filename)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{filename} not found in {root_dir}")
+    with open(path, 'r', encoding='utf-8') as f:
+        return cls(root_dir, f.read())
+
+
+def split_target(target):
+    """
+    Splits a request target into its decoded, normalized path and raw
+    query string. Raises ValueError for a path normalize_path refuses.
+    """
+    path, _, query = target.partition('?')
+    return normalize_path(unquote(path.split('#', 1)[0]) or '/'), query
@@ -0,0 +1,312 @@
+import argparse
+import glob
+import hashlib
+import html
+import json
+import os
+import re
+import html_stream
+from extract_server_data import SHARED_DIR, SHARED_PREFIX, find_server_data, project_pages
+from fix_pipeline import find_html_files
+
+# The servers rewrite _escaped_fragment_ requests into this folder, with
+# the rules routes.py writes for the snippets found here.
+SNIPPET_DIR = 'snippets'
+INDEX_NAME = 'index.json'
+
+# Bump this whenever the markup changes, so every snippet is rebuilt.
+SNIPPET_VERSION = 1
+
+# Draft.js block types of text widgets and the tag each one becomes.
+BLOCK_TAGS = {'header-one': 'h1', 'header-two': 'h2', 'header-three': 'h3', 'header-four': 'h4',
+              'header-five': 'h5', 'header-six': 'h6', 'unordered-list-item': 'li', 'ordered-list-item': 'li',
+              'blockquote': 'blockquote'}
+TEXT_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'blockquote'}
+
+EXTERNAL_LINK = re.compile(r'^(?:https?:|mailto:|tel:|/)')
+
+
+def load_state(root_dir):
+    """
+    Returns the project state: the inline ServerData of the first page that
+    still has it, or the shared file extract_server_data.py wrote. Widgets
+    moved into page fragments are read back from them.
+    """
+    state = None
+    for filepath in find_html_files(root_dir):
+        with open(filepath, 'rb') as f:
+            found = find_server_data(f.read())
+        if found is not None:
+            state = found[2]
+            break
+    if state is None:
+        for path in sorted(glob.glob(os.path.join(root_dir, SHARED_DIR, SHARED_PREFIX + '*.js'))):
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            state = json.loads(text[text.index('=') + 1:].strip().rstrip(';'))
+            break
+    if state is None:
+        return None
+    for page in state.get('mags', {}).get('mag', {}).get('pages') or []:
+        if isinstance(page, dict) and 'wids' not in page and page.get('widsUrl'):
+            path = os.path.join(root_dir, page['widsUrl'].lstrip('/'))
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    page['wids'] = json.load(f)
+    return state
+
+
+def site_origin(root_dir):
+    """
+    Returns the site's origin from the canonical link of index.html, or ''
+    when it has none, in which case canonical URLs stay relative.
+    """
+    path = os.path.join(root_dir, 'index.html')
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'rb') as f:
+        for token in html_stream.iter_tags(f.read()):
+            if isinstance(token, html_stream.StartTag) and token.name == 'link' and token.get('rel') == 'canonical':
+                match = re.match(r'^(https?://[^/]+)', token.get('href') or '')
+                return match.group(1) if match else ''
+    return ''
+
+
+def page_url(page):
+    """
+    The public URL of a page, as in sitemap.xml: / for the first page and
+    /<pagePath>/ for the others.
+    """
+    if page.get('num') == 1 or not page.get('uri'):
+        return '/'
+    return f"/{(page.get('pagePath') or page['uri']).strip('/')}/"
+
+
+def snippet_path(page):
+    return page.get('htmlUrl') or f"{SNIPPET_DIR}/{(page.get('pagePath') or str(page.get('num'))).strip('/')}.html"
+
+
+def is_hidden(widget, page_id):
+    """
+    Widgets shared between pages keep a hidden flag per page in _hidden,
+    with a 'default' entry for the pages not listed.
+    """
+    flags = {entry.get('pid'): entry.get('value') for entry in widget.get('_hidden') or [] if isinstance(entry, dict)}
+    for pid in (page_id, 'default'):
+        if flags.get(pid) is not None:
+            return bool(flags[pid])
+    return bool(widget.get('hidden'))
+
+
+def local_url(url):
+    """
+    Makes an exported asset path absolute from the site root. Anything that
+    is not a file of the export is dropped.
+    """
+    if not url or re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:|^//', url):
+        return None
+    return '/' + url.lstrip('/')
+
+
+def link_target(link, urls):
+    if not link:
+        return None
+    if link in urls:
+        return urls[link]
+    if EXTERNAL_LINK.match(link):
+        return link
+    return None
+
+
+def text_blocks(widget, urls, tags):
+    """
+    Yields (tag, inner HTML) for each block of a text widget, with its page
+    and URL links as <a> tags.
+    """
+    types = {style.get('key'): style.get('type') for style in widget.get('styles') or []}
+    entities = widget.get('entityMap') or {}
+    for block in widget.get('blocks') or []:
+        text = block.get('text') or ''
+        if not text.strip():
+            continue
+        block_type = types.get(block.get('key'))
+        tag = BLOCK_TAGS.get(block_type) or tags.get(block_type, 'p')
+        links = []
+        for entity_range in block.get('entityRanges') or []:
+            entity = entities.get(str(entity_range.get('key'))) or {}
+            data = entity.get('data') or {}
+            if entity.get('type') != 'LINK':
+                continue
+            href = urls.get(data.get('pageId')) if data.get('type') == 'Page' else link_target(data.get('url'), urls)
+            if href:
+                links.append((entity_range.get('offset', 0), entity_range.get('length', 0), href))
+        parts, pos = [], 0
+        for offset, length, href in sorted(links):
+            if offset < pos:
+                continue
+            parts.append(html.escape(text[pos:offset]))
+            parts.append(f'<a href="{html.escape(href)}">{html.escape(text[offset:offset + length])}</a>')
+            pos = offset + length
+        parts.append(html.escape(text[pos:]))
+        yield tag, ''.join(parts)
+
+
+def widget_markup(widget, urls, tags):
+    """
+    Returns the snippet markup of one widget, or '' for widgets with nothing
+    a crawler can read.
+    """
+    kind = widget.get('type')
+    href = link_target(widget.get('clickLink'), urls)
+    if kind == 'text':
+        blocks = list(text_blocks(widget, urls, tags))
+        markup = ''.join(f"<{tag}>{inner}</{tag}>" for tag, inner in blocks)
+        if any(tag == 'li' for tag, _ in blocks):
+            markup = f"<ul>{markup}</ul>"
+        return markup
+    if kind == 'picture':
+        picture = widget.get('picture') or {}
+        src = local_url(picture.get('finalUrl') or picture.get('url'))
+        if not src:
+            return ''
+        img = (f'<img src="{html.escape(src)}" width="{round(widget.get("w") or 0)}" '
+               f'height="{round(widget.get("h") or 0)}" alt="{html.escape(widget.get("alt") or "")}">')
+        return f'<a href="{html.escape(href)}">{img}</a>' if href else img
+    if kind == 'button' and (widget.get('text') or '').strip():
+        label = html.escape(widget['text'].strip())
+        return f'<p><a href="{html.escape(href)}">{label}</a></p>' if href else f"<p>{label}</p>"
+    return ''
+
+
+def snippet_inputs(page, mag, urls, origin):
+    """
+    Everything the snippet of a page is built from. Its hash decides whether
+    the snippet is rebuilt, so a change to one page only rebuilds that page.
+    """
+    linked = set(re.findall(r'"(?:clickLink|pageId)":\s*"([0-9a-f]{24})"', json.dumps(page)))
+    styles = mag.get('textStyles') or {}
+    tags = {style['name']: style.get('tag') for group in ('global', 'project')
+            for style in styles.get(group) or [] if style.get('name') and style.get('tag') in TEXT_TAGS}
+    return {
+        'version': SNIPPET_VERSION,
+        'page': page,
+        'site_title': mag.get('title') or '',
+        'site_description': mag.get('description') or '',
+        'origin': origin,
+        'urls': {page_id: urls[page_id] for page_id in sorted(linked) if page_id in urls},
+        'tags': tags,
+    }
+
+
+def render_snippet(inputs):
+    page = inputs['page']
+    seo = page.get('seo') or {}
+    title = seo.get('title') or ' | '.join(filter(None, [page.get('title'), inputs['site_title']]))
+    description = seo.get('description') or inputs['site_description']
+    canonical = inputs['origin'] + page_url(page)
+    head = [
+        '<meta charset="utf-8">',
+        f"<title>{html.escape(title)}</title>",
+        f'<meta name="description" content="{html.escape(description)}">',
+        f'<link rel="canonical" href="{html.escape(canonical)}">',
+        f'<meta property="og:title" content="{html.escape(title)}">',
+        f'<meta property="og:description" content="{html.escape(description)}">',
+        f'<meta property="og:url" content="{html.escape(canonical)}">',
+    ]
+    if seo.get('keywords'):
+        head.append(f'<meta name="keywords" content="{html.escape(seo["keywords"])}">')
+    screenshot = local_url(page.get('screenshot'))
+    if screenshot:
+        head.append(f'<meta property="og:image" content="{html.escape(inputs["origin"] + screenshot)}">')
+
+    # Widgets in reading order, top to bottom and then left to right.
+    widgets = sorted((w for w in page.get('wids') or [] if isinstance(w, dict) and not is_hidden(w, page['_id'])),
+                     key=lambda w: (w.get('y') or 0, w.get('x') or 0))
+    body = [widget_markup(widget, inputs['urls'], inputs['tags']) for widget in widgets]
+    heading = f"<h1>{html.escape(page.get('title') or title)}</h1>"
+    return ('<!DOCTYPE html>\n<html>\n<head>\n' + '\n'.join(head) + '\n</head>\n<body>\n' + heading + '\n'
+            + '\n'.join(markup for markup in body if markup) + '\n</body>\n</html>\n').encode('utf-8')
+
+
+def load_index(root_dir):
+    path = os.path.join(root_dir, SNIPPET_DIR, INDEX_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(root_dir, index):
+    path = os.path.join(root_dir, SNIPPET_DIR, INDEX_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    html_stream.remove_sidecars(path)
+
+
+def build_snippets(root_dir, dry_run=False, force=False):
+    """
+    Writes snippets/<page path>.html for every visible page of the project
+    state: its text, images with their dimensions, links and metadata, with
+    no viewer JavaScript. Snippets whose inputs did not change are kept.
+    """
+    state = load_state(root_dir)
+    if state is None:
+        print("Error: no ServerData found, neither inline nor in a shared state file.")
+        return
+    mag = state.get('mags', {}).get('mag', {})
+    pages = [page for page in project_pages(state) if not page.get('hidden') and not page.get('isPrivate')]
+    urls = {page['_id']: page_url(page) for page in pages}
+    origin = site_origin(root_dir)
+    old_index = load_index(root_dir)
+    index = {} if force else old_index
+    new_index = {}
+    built = 0
+
+    for page in pages:
+        path = snippet_path(page)
+        filepath = os.path.join(root_dir, path)
+        print(f"\nProcessing: {path}")
+        try:
+            inputs = snippet_inputs(page, mag, urls, origin)
+            digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+            new_index[path] = digest
+            if index.get(path) == digest and os.path.exists(filepath):
+                print("  - Page state unchanged, kept the existing snippet.")
+                continue
+            data = render_snippet(inputs)
+            built += 1
+            if dry_run:
+                print(f"  - Dry run, {len(data) / 1024:,.1f} KB snippet not saved.")
+                continue
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            html_stream.write_atomic(filepath, data)
+            print(f"  - Saved {len(data) / 1024:,.1f} KB snippet.")
+        except Exception as e:
+            print(f"  - ERROR processing page {path}: {e}")
+
+    for path in sorted(set(old_index) - set(new_index)):
+        print(f"  - Removing stale snippet {path}.")
+        if not dry_run and os.path.exists(os.path.join(root_dir, path)):
+            os.remove(os.path.join(root_dir, path))
+            html_stream.remove_sidecars(os.path.join(root_dir, path))
+    if not dry_run:
+        os.makedirs(os.path.join(root_dir, SNIPPET_DIR), exist_ok=True)
+        save_index(root_dir, new_index)
+    print(f"\n{len(pages)} page(s), {built} snippet(s) built, {len(pages) - built} unchanged.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build static /snippets/ pages for _escaped_fragment_ crawlers.")
+    parser.add_argument('root', nargs='?', default='.', help="Root directory of the exported site.")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would be built without writing anything.")
+    parser.add_argument('--force', action='store_true', help="Rebuild every snippet even if its page did not change.")
+    args = parser.parse_args(argv)
+    build_snippets(args.root, dry_run=args.dry_run, force=args.force)
+
+
+if __name__ == "__main__":
+    main()